@@ -0,0 +1 @@
+# This is an empty __init__.py file
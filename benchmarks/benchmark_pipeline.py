@@ -0,0 +1,351 @@
+"""
+benchmark_pipeline.py
+
+Benchmark suite for the data generation, leakage detection and usage calculation pipeline.
+
+Every scale point simulates a network with a fixed number of endpoints over a fixed number of hours,
+using a fixed topology and simulation seed, and runs each stage of the pipeline on the result. For
+every stage the wall time, the peak traced memory (Python and NumPy allocations, via tracemalloc) and
+the throughput in rows per second are recorded. Tracing allocations slows Python-heavy stages down
+considerably, so peak memory is measured in a separate run from the timed ones. Results can be saved as a baseline and later runs
+compared against it: a run fails when a stage got slower, or used more memory, by more than a
+configurable threshold. Everything runs locally on temporary files.
+
+Functions:
+- build_scale_topology: Builds the network of a scale point.
+- run_scale_point: Runs and measures every stage of the pipeline at one scale point.
+- run_benchmarks: Runs a set of scale points.
+- compare_to_baseline: Lists the stages that regressed against a baseline.
+- load_results: Loads benchmark results from a JSON file.
+- save_results: Saves benchmark results to a JSON file.
+- print_results: Prints the measurements of every stage.
+- main: Entry point for running the benchmarks.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from data_analysis.leakage_detection import detect_leakages, detect_leakages_hierarchical
+from data_analysis.usage_calculation import calculate_endpoint_usage
+from data_analysis.usage_index import load_usage_index, query_usage
+from data_generation.columnar_dataset import cache_path_for, read_dataset, write_dataset_cache
+from data_generation.data_maker_leak import Endpoint, create_junctions_and_endpoints, simulate_network
+from data_generation.network_topology import NetworkTopology, build_topology
+from data_generation.vectorized_simulation import simulate_network_arrays
+
+RESULTS_VERSION = 1
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Every leaf junction serves exactly 100 endpoints, so the endpoint count only depends on the depth
+BENCHMARK_ENDPOINT_MIX = {'Home': (40, 40), 'Factory': (10, 10), 'Agricultural_Channel': (20, 20), 'Fire_Hydrant': (30, 30)}
+ENDPOINT_DEPTHS = {'1k': 1, '100k': 3, '1M': 4}
+HOUR_COUNTS = {'24h': 24, '720h': 720, '8760h': 8760}
+
+# (endpoints, hours) of every scale point; the largest ones need tens of GB of memory
+SCALE_POINTS = {
+    f"{endpoints}-{hours}": (endpoints, hours)
+    for endpoints, hours in [('1k', '24h'), ('1k', '720h'), ('1k', '8760h'),
+                             ('100k', '24h'), ('100k', '720h'), ('1M', '24h')]
+}
+DEFAULT_SCALE_POINTS = ['1k-24h', '1k-720h', '100k-24h']
+
+TOPOLOGY_SEED = 2023
+SIMULATION_SEED = 42
+MASTER_SENSOR_ID = 1000
+# The object engine, the data makers' default, simulates their own small network; it is timed at these endpoint counts
+OBJECT_ENGINE_ENDPOINTS = ['1k']
+START_TIME = datetime(2023, 1, 1, 0, 0)
+LEAKAGE_PROBABILITY = 0.2
+MAX_LEAKAGE_PERCENT = 0.1
+
+def build_scale_topology(endpoints):
+    """
+    Builds the network of a scale point.
+
+    Parameters:
+    - endpoints (str): Endpoint count label, one of ENDPOINT_DEPTHS.
+
+    Returns:
+    - NetworkTopology: A network with a fan-out of 10 and 100 endpoints per leaf junction.
+    """
+    return build_topology(depth=ENDPOINT_DEPTHS[endpoints], fan_out=10,
+                          endpoint_mix=BENCHMARK_ENDPOINT_MIX, seed=TOPOLOGY_SEED)
+
+@contextlib.contextmanager
+def _measure(stage, rows, results, trace_memory):
+    """ Records the wall time, throughput and, when tracing memory, the peak memory of the stage run inside the block. """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        # Keep the stages' own progress messages out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak_memory = None
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        results[stage] = {
+            'seconds': seconds,
+            'peak_memory_bytes': peak_memory,
+            'rows_per_second': rows / seconds if rows and seconds > 0 else None,
+        }
+
+def run_scale_point(name, work_dir, trace_memory=False):
+    """
+    Runs every stage of the pipeline at one scale point and measures it.
+
+    The stages are: building the topology, simulating the network (also with the object engine of the
+    data makers at the 1k scale points, on their own network), writing and reading the CSV dataset, writing and reading its sidecar cache, detecting leakages with the endpoint and the
+    hierarchical mass balance, calculating the usage of every endpoint over the whole time range,
+    and building and querying the prefix-sum usage index.
+
+    Parameters:
+    - name (str): Name of the scale point, one of SCALE_POINTS.
+    - work_dir (str): Directory for the temporary dataset and outputs.
+    - trace_memory (bool): Trace allocations to measure the peak memory of every stage.
+
+    Returns:
+    - Dict[str, Dict[str, float]]: The seconds, rows per second and peak memory in bytes (None when
+      not traced) of every stage.
+    """
+    endpoints, hours = SCALE_POINTS[name]
+    dataset_path = os.path.join(work_dir, f"{name}.csv")
+    results = {}
+
+    with _measure('topology', None, results, trace_memory):
+        topology = build_scale_topology(endpoints)
+    rows = len(topology) * HOUR_COUNTS[hours]
+
+    with _measure('generate', rows, results, trace_memory):
+        data = simulate_network_arrays(topology, Endpoint.USAGE_PARAMETERS, HOUR_COUNTS[hours], START_TIME,
+                                       seed=SIMULATION_SEED, leakage_probability=LEAKAGE_PROBABILITY,
+                                       max_leakage_percent=MAX_LEAKAGE_PERCENT)
+    with _measure('write_csv', rows, results, trace_memory):
+        data.to_csv(dataset_path, index=False)
+    del data
+
+    if endpoints in OBJECT_ENGINE_ENDPOINTS:
+        # The object engine draws its network from `random` too, so the seed fixes its size and readings
+        random.seed(SIMULATION_SEED)
+        object_rows = len(NetworkTopology.from_junctions(*create_junctions_and_endpoints(MASTER_SENSOR_ID))) * HOUR_COUNTS[hours]
+        random.seed(SIMULATION_SEED)
+        with _measure('generate_objects', object_rows, results, trace_memory):
+            data = simulate_network(HOUR_COUNTS[hours], START_TIME, MASTER_SENSOR_ID,
+                                    LEAKAGE_PROBABILITY, MAX_LEAKAGE_PERCENT)
+        del data
+
+    with _measure('read_csv', rows, results, trace_memory):
+        data = read_dataset(dataset_path)
+    with _measure('write_cache', rows, results, trace_memory):
+        write_dataset_cache(data, dataset_path)
+    with _measure('read_cache', rows, results, trace_memory):
+        data = read_dataset(dataset_path, cache=True)
+    with _measure('detect_leakages', rows, results, trace_memory):
+        detect_leakages(data)
+    with _measure('detect_hierarchical', rows, results, trace_memory):
+        detect_leakages_hierarchical(data)
+    from_timestamp, to_timestamp = data['timestamp'].min(), data['timestamp'].max()
+    del data
+
+    with _measure('usage', rows, results, trace_memory):
+        calculate_endpoint_usage(dataset_path, from_timestamp, to_timestamp, output_dir=work_dir)
+    with _measure('usage_index_build', rows, results, trace_memory):
+        index = load_usage_index(dataset_path)
+    with _measure('usage_index_query', rows, results, trace_memory):
+        query_usage(index, from_timestamp, to_timestamp)
+
+    for path in (dataset_path, dataset_path + '.usage_index.npz'):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(cache_path_for(dataset_path), ignore_errors=True)
+    results['rows'] = rows
+    return results
+
+def run_benchmarks(scale_points, repeat=1, measure_memory=True, work_dir=None):
+    """
+    Runs a set of scale points, keeping the fastest of `repeat` timed runs of every stage.
+
+    Parameters:
+    - scale_points (List[str]): Names of the scale points to run.
+    - repeat (int): Number of timed runs per scale point.
+    - measure_memory (bool): Add a run with allocation tracing to measure the peak memory of every stage.
+    - work_dir (str, optional): Directory for the temporary files, defaults to a new temporary directory.
+
+    Returns:
+    - Dict: The results of every scale point together with a description of the environment.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        for name in scale_points:
+            for _ in range(repeat):
+                run = run_scale_point(name, temp_dir)
+                best = results.setdefault(name, run)
+                for stage, measurement in run.items():
+                    if stage != 'rows' and measurement['seconds'] < best[stage]['seconds']:
+                        best[stage] = measurement
+                print(f"{name}: {run['rows']} rows, {sum(m['seconds'] for s, m in run.items() if s != 'rows'):.2f} s")
+            if measure_memory:
+                traced = run_scale_point(name, temp_dir, trace_memory=True)
+                for stage, measurement in results[name].items():
+                    if stage != 'rows':
+                        measurement['peak_memory_bytes'] = traced[stage]['peak_memory_bytes']
+
+    return {
+        'version': RESULTS_VERSION,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+
+def compare_to_baseline(current, baseline, threshold=0.25, memory_threshold=0.25, min_seconds=0.05):
+    """
+    Lists the stages that regressed against a baseline.
+
+    Parameters:
+    - current (Dict): Results from `run_benchmarks`.
+    - baseline (Dict): Baseline results in the same format.
+    - threshold (float): Allowed relative increase of the wall time, e.g. 0.25 for 25%.
+    - memory_threshold (float): Allowed relative increase of the peak memory.
+    - min_seconds (float): Stages faster than this in the baseline are too noisy to compare their time.
+
+    Returns:
+    - List[str]: A description of every regression; empty when nothing regressed.
+    """
+    regressions = []
+    for name, stages in current['results'].items():
+        baseline_stages = baseline['results'].get(name, {})
+        for stage, measurement in stages.items():
+            reference = baseline_stages.get(stage)
+            if stage == 'rows' or reference is None:
+                continue
+            if reference['seconds'] >= min_seconds and measurement['seconds'] > reference['seconds'] * (1 + threshold):
+                regressions.append(f"{name} {stage}: {measurement['seconds']:.3f} s, baseline {reference['seconds']:.3f} s")
+            if (reference['peak_memory_bytes'] and measurement['peak_memory_bytes'] is not None
+                    and measurement['peak_memory_bytes'] > reference['peak_memory_bytes'] * (1 + memory_threshold)):
+                regressions.append(f"{name} {stage}: {measurement['peak_memory_bytes'] / 2**20:.1f} MiB peak memory, "
+                                   f"baseline {reference['peak_memory_bytes'] / 2**20:.1f} MiB")
+    return regressions
+
+def load_results(path):
+    """
+    Loads benchmark results from a JSON file.
+
+    Parameters:
+    - path (str): Path of the JSON file.
+
+    Returns:
+    - Dict: The benchmark results.
+    """
+    with open(path) as results_file:
+        results = json.load(results_file)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError(f"Unsupported benchmark results version in {path}: {results.get('version')}")
+    return results
+
+def save_results(results, path):
+    """
+    Saves benchmark results to a JSON file.
+
+    Parameters:
+    - results (Dict): Results from `run_benchmarks`.
+    - path (str): Path of the JSON file.
+    """
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+        results_file.write('\n')
+
+def print_results(results, baseline=None):
+    """
+    Prints the measurements of every stage, with the change against the baseline if there is one.
+
+    Parameters:
+    - results (Dict): Results from `run_benchmarks`.
+    - baseline (Dict, optional): Baseline results in the same format.
+    """
+    print(f"{'scale point':<12} {'stage':<18} {'seconds':>9} {'peak MiB':>9} {'rows/s':>12} {'vs baseline':>12}")
+    for name, stages in results['results'].items():
+        baseline_stages = baseline['results'].get(name, {}) if baseline else {}
+        for stage, measurement in stages.items():
+            if stage == 'rows':
+                continue
+            change = ''
+            reference = baseline_stages.get(stage)
+            if reference and reference['seconds'] > 0:
+                change = f"{(measurement['seconds'] / reference['seconds'] - 1) * 100:+.1f}%"
+            peak_memory = measurement['peak_memory_bytes']
+            peak_memory = f"{peak_memory / 2**20:.1f}" if peak_memory is not None else '-'
+            rows_per_second = measurement['rows_per_second']
+            rows_per_second = f"{rows_per_second:,.0f}" if rows_per_second is not None else '-'
+            print(f"{name:<12} {stage:<18} {measurement['seconds']:>9.3f} {peak_memory:>9} {rows_per_second:>12} {change:>12}")
+
+def main(argv=None):
+    """
+    Main function to run the benchmarks and compare them against the baseline.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+
+    Returns:
+    - int: 1 when a stage regressed beyond the thresholds, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark data generation, leakage detection and usage calculation.")
+    parser.add_argument('--scale', nargs='+', choices=list(SCALE_POINTS), default=DEFAULT_SCALE_POINTS,
+                        help="Scale points to run, as <endpoints>-<hours>.")
+    parser.add_argument('--repeat', type=int, default=1, help="Timed runs per scale point; the fastest run of every stage is kept.")
+    parser.add_argument('--no-memory', dest='measure_memory', action='store_false',
+                        help="Skip the extra run that measures the peak memory of every stage.")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Baseline results to compare against.")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results of this run as the new baseline.")
+    parser.add_argument('--output', default=None, help="Also write the results of this run to this JSON file.")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="Allowed relative slowdown of a stage before the run fails (default: 0.25).")
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help="Allowed relative increase of a stage's peak memory before the run fails (default: 0.25).")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="Do not compare the time of stages faster than this in the baseline.")
+    parser.add_argument('--work-dir', default=None, help="Directory for temporary datasets (default: the system temporary directory).")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scale, repeat=args.repeat, measure_memory=args.measure_memory, work_dir=args.work_dir)
+    baseline = None if args.save_baseline or not os.path.exists(args.baseline) else load_results(args.baseline)
+    print_results(results, baseline)
+
+    if args.output:
+        save_results(results, args.output)
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        print(f"Baseline saved to {args.baseline}.")
+        return 0
+    if baseline is None:
+        print(f"No baseline found at {args.baseline}; run with --save-baseline to create one.")
+        return 0
+
+    regressions = compare_to_baseline(results, baseline, args.threshold, args.memory_threshold, args.min_seconds)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    print("Benchmarks regressed." if regressions else "No regressions against the baseline.")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
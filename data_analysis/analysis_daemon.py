@@ -0,0 +1,459 @@
+"""
+analysis_daemon.py
+
+Long-running local analysis service that keeps datasets in memory and answers leak detection and
+usage range queries over HTTP, on a TCP port or a Unix socket.
+
+Every dataset is loaded once at startup (through its binary sidecar cache) together with its sensor
+topology and its endpoint readings, which are sliced by binary search when the file is in timestamp
+order, as the data makers write it. Query results are kept in a least
+recently used cache bounded by number of entries and total size. Before answering a query, the
+dataset file's size and modification time are checked: when the file has changed, the dataset is
+reloaded and its cached results are dropped.
+
+Queries are GET requests answered with JSON:
+- /datasets: The served datasets, their size and time range.
+- /sensors?dataset=NAME: The sensors of a dataset with their type, device type and path to the master junction.
+- /leaks?dataset=NAME[&from=TS&to=TS&hierarchical=1&limit=N]: Leak records, as returned by `detect_leakages`.
+- /usage?dataset=NAME&from=TS&to=TS: Water usage per endpoint and the SHA-256 hash of the CSV file
+  `usage_calculation.py` would write for the same range.
+- /stats: Cache statistics and dataset load times.
+
+Classes:
+- ResultCache: LRU cache of encoded query results with an entry and a size bound.
+- LoadedDataset: A dataset held in memory with the structures its queries need.
+- DatasetStore: The served datasets, reloaded when their files change.
+- AnalysisService: Answers queries from the store and the cache.
+
+Functions:
+- serve: Serves the analysis queries over HTTP until interrupted.
+- query_daemon: Sends a query to a running daemon and returns the decoded response.
+- main: Entry point for running the daemon.
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+import numpy as np
+
+from data_analysis.leakage_detection import detect_leakages, detect_leakages_hierarchical
+from data_generation.columnar_dataset import read_dataset
+
+class ResultCache:
+    """
+    Least recently used cache of encoded query results.
+
+    The cache holds at most `max_entries` results and `max_bytes` bytes of them; the least recently used
+    results are evicted first, and results larger than the whole cache are not stored.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """ Returns the cached result for a key, or None, marking it as most recently used. """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        """ Stores a result, evicting the least recently used ones beyond the bounds. """
+        if len(value) > self.max_bytes or self.max_entries <= 0:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = value
+            self.size += len(value)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, dataset):
+        """ Drops every cached result of a dataset. """
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == dataset]:
+                self.size -= len(self.entries.pop(key))
+                self.stats['invalidations'] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes, **self.stats}
+
+def _fingerprint(path):
+    """ Identifies the current version of a dataset file or directory by its size and modification time. """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'manifest.json')
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+class LoadedDataset:
+    """
+    A dataset held in memory, with its sensor topology and its endpoint readings. When the readings are
+    in timestamp order, usage range queries find the rows of the range by binary search.
+    """
+
+    def __init__(self, name, path, use_cache=True):
+        self.name = name
+        self.path = path
+        self.fingerprint = _fingerprint(path)
+        start = time.perf_counter()
+        self.data = read_dataset(path, cache=use_cache)
+
+        self.sensors = (self.data.drop_duplicates('sensor_id')[['sensor_id', 'type', 'device_type', 'path_to_master']]
+                        .sort_values('sensor_id').reset_index(drop=True))
+        self.endpoints = self.data.loc[self.data['type'] == 'Endpoint', ['timestamp', 'sensor_id', 'water_usage']]
+        # Slices of readings in file order sum every sensor's readings in the same order as a full scan
+        self.timestamps_sorted = self.endpoints['timestamp'].is_monotonic_increasing
+        if self.timestamps_sorted:
+            self.endpoint_timestamps = self.endpoints['timestamp'].to_numpy()
+        self.load_seconds = time.perf_counter() - start
+        self.loaded_at = time.time()
+
+    def time_range(self):
+        """ Returns the first and last timestamp of the dataset. """
+        if not len(self.data):
+            return None, None
+        return self.data['timestamp'].min(), self.data['timestamp'].max()
+
+    def usage(self, from_timestamp, to_timestamp):
+        """
+        Calculates the water usage of every endpoint between two timestamps, both inclusive.
+
+        Parameters:
+        - from_timestamp (str): Start of the time range.
+        - to_timestamp (str): End of the time range.
+
+        Returns:
+        - DataFrame: Total water usage per sensor ID, as computed by `usage_calculation.calculate_endpoint_usage`.
+        """
+        if self.timestamps_sorted:
+            first = np.searchsorted(self.endpoint_timestamps, from_timestamp, side='left')
+            last = max(first, np.searchsorted(self.endpoint_timestamps, to_timestamp, side='right'))
+            readings = self.endpoints.iloc[first:last]
+        else:
+            timestamps = self.endpoints['timestamp']
+            readings = self.endpoints[(timestamps >= from_timestamp) & (timestamps <= to_timestamp)]
+        return readings.groupby('sensor_id')['water_usage'].sum().reset_index()
+
+    def leaks(self, from_timestamp=None, to_timestamp=None, hierarchical=False):
+        """
+        Detects leakages, optionally within a time range.
+
+        Parameters:
+        - from_timestamp (str, optional): Start of the time range (inclusive).
+        - to_timestamp (str, optional): End of the time range (inclusive).
+        - hierarchical (bool): Balance every junction against its direct children.
+
+        Returns:
+        - List[Dict]: The leak records.
+        - float: The total leakage amount.
+        """
+        data = self.data
+        if from_timestamp is not None:
+            data = data[data['timestamp'] >= from_timestamp]
+        if to_timestamp is not None:
+            data = data[data['timestamp'] <= to_timestamp]
+        return detect_leakages_hierarchical(data) if hierarchical else detect_leakages(data)
+
+class DatasetStore:
+    """
+    The datasets served by the daemon, by name. A dataset whose file has changed since it was loaded is
+    reloaded on its next query, and `on_reload` is called with its name.
+    """
+
+    def __init__(self, paths, use_cache=True, on_reload=None):
+        self.paths = dict(paths)
+        self.use_cache = use_cache
+        self.on_reload = on_reload
+        self.datasets = {}
+        self.reloads = 0
+        self.lock = threading.Lock()
+
+    def load_all(self):
+        """ Loads every dataset, so that the first queries do not wait for it. """
+        for name in self.paths:
+            self.get(name)
+
+    def get(self, name):
+        """
+        Returns a loaded dataset, loading or reloading it if needed.
+
+        Parameters:
+        - name (str): Name of the dataset.
+
+        Returns:
+        - LoadedDataset: The dataset.
+        """
+        if name not in self.paths:
+            raise KeyError(name)
+        dataset = self.datasets.get(name)
+        if dataset is not None and dataset.fingerprint == _fingerprint(dataset.path):
+            return dataset
+
+        with self.lock:
+            # Another request may have reloaded the dataset in the meantime
+            dataset = self.datasets.get(name)
+            if dataset is None or dataset.fingerprint != _fingerprint(dataset.path):
+                reloading = dataset is not None
+                dataset = self.datasets[name] = LoadedDataset(name, self.paths[name], self.use_cache)
+                if reloading:
+                    self.reloads += 1
+                    if self.on_reload is not None:
+                        self.on_reload(name)
+            return dataset
+
+def _json_value(value):
+    """ Converts NumPy scalars for JSON encoding. """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _encode(result):
+    return json.dumps(result, default=_json_value).encode()
+
+class QueryError(Exception):
+    """ A query that cannot be answered, with the HTTP status to answer it with. """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class AnalysisService:
+    """ Answers analysis queries from the in-memory datasets, through the result cache. """
+
+    def __init__(self, paths, cache_entries=256, cache_bytes=64 << 20, use_cache=True):
+        self.cache = ResultCache(cache_entries, cache_bytes)
+        self.store = DatasetStore(paths, use_cache=use_cache, on_reload=self.cache.invalidate)
+        self.started_at = time.time()
+
+    def handle(self, route, params):
+        """
+        Answers one query.
+
+        Parameters:
+        - route (str): The query path, e.g. '/leaks'.
+        - params (Dict[str, str]): The query parameters.
+
+        Returns:
+        - bytes: The JSON encoded result.
+        """
+        if route == '/datasets':
+            return _encode({name: self._describe(self.store.get(name)) for name in self.store.paths})
+        if route == '/stats':
+            return _encode({'uptime_seconds': time.time() - self.started_at, 'cache': self.cache.to_dict(),
+                            'reloads': self.store.reloads,
+                            'datasets': {name: {'load_seconds': dataset.load_seconds, 'loaded_at': dataset.loaded_at}
+                                         for name, dataset in self.store.datasets.items()}})
+        if route not in ('/leaks', '/usage', '/sensors'):
+            raise QueryError(404, f"Unknown query {route}")
+
+        name = params.get('dataset')
+        if name is None and len(self.store.paths) == 1:
+            name = next(iter(self.store.paths))
+        try:
+            dataset = self.store.get(name)
+        except KeyError:
+            raise QueryError(404, f"Unknown dataset {name}") from None
+
+        # Results are keyed by the version of the file they were computed from
+        key = (route, dataset.name, dataset.fingerprint, tuple(sorted(params.items())))
+        result = self.cache.get(key)
+        if result is None:
+            result = _encode(self._query(route, dataset, params))
+            self.cache.put(key, result)
+        return result
+
+    def _describe(self, dataset):
+        """ Summarizes a loaded dataset. """
+        first, last = dataset.time_range()
+        return {'path': dataset.path, 'rows': len(dataset.data), 'sensors': len(dataset.sensors),
+                'from': first, 'to': last, 'load_seconds': dataset.load_seconds}
+
+    def _query(self, route, dataset, params):
+        """ Computes the result of a dataset query. """
+        if route == '/sensors':
+            return {'dataset': dataset.name, 'sensors': dataset.sensors.to_dict(orient='records')}
+
+        if route == '/usage':
+            if 'from' not in params or 'to' not in params:
+                raise QueryError(400, "Usage queries need 'from' and 'to' timestamps")
+            grouped_data = dataset.usage(params['from'], params['to'])
+            return {
+                'dataset': dataset.name, 'from': params['from'], 'to': params['to'],
+                'usage': grouped_data.to_dict(orient='records'),
+                # Hash of the CSV file usage_calculation.py writes for the same range
+                'sha256': hashlib.sha256(grouped_data.to_csv(index=False).encode()).hexdigest(),
+            }
+
+        try:
+            limit = int(params['limit']) if 'limit' in params else None
+        except ValueError:
+            raise QueryError(400, f"Invalid limit {params['limit']}") from None
+        hierarchical = params.get('hierarchical', '0').lower() in ('1', 'true', 'yes')
+        leakages, total_leakage = dataset.leaks(params.get('from'), params.get('to'), hierarchical=hierarchical)
+        # groupby-style one-element timestamp keys are sent as plain timestamps
+        leaks = [{**leak, 'timestamp': leak['timestamp'][0]} for leak in leakages[:limit]]
+        return {'dataset': dataset.name, 'total_leakage': total_leakage, 'leak_count': len(leakages), 'leaks': leaks}
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    """ Answers GET requests with the JSON result of the service's queries. """
+    service = None
+    quiet = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            status, body = 200, self.service.handle(url.path.rstrip('/') or '/', params)
+        except QueryError as error:
+            status, body = error.status, _encode({'error': str(error)})
+        except Exception as error:
+            status, body = 500, _encode({'error': f"{type(error).__name__}: {error}"})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server on a Unix socket, answering every connection on its own thread. """
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+def serve(service, host='127.0.0.1', port=9760, unix_path=None, quiet=False, ready=None):
+    """
+    Serves the analysis queries over HTTP until interrupted.
+
+    Parameters:
+    - service (AnalysisService): The service answering the queries.
+    - host (str): Host to listen on for TCP connections.
+    - port (int): Port to listen on for TCP connections.
+    - unix_path (str, optional): Listen on this Unix socket path instead of TCP.
+    - quiet (bool): Do not log every request.
+    - ready (Callable, optional): Called with the server once it listens, e.g. to shut it down later.
+    """
+    handler = type('QueryHandler', (_QueryHandler,), {'service': service, 'quiet': quiet})
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        server = _UnixHTTPServer(unix_path, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+    if ready is not None:
+        ready(server)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if unix_path and os.path.exists(unix_path):
+            os.unlink(unix_path)
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP connection over a Unix socket. """
+
+    def __init__(self, unix_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = unix_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+def query_daemon(route, params=None, host='127.0.0.1', port=9760, unix_path=None):
+    """
+    Sends a query to a running daemon.
+
+    Parameters:
+    - route (str): The query path, e.g. '/usage'.
+    - params (Dict[str, str], optional): The query parameters.
+    - host (str): Host of the daemon.
+    - port (int): TCP port of the daemon.
+    - unix_path (str, optional): Connect to this Unix socket instead of TCP.
+
+    Returns:
+    - Tuple[int, Any]: The HTTP status and the decoded JSON result.
+    """
+    connection = _UnixHTTPConnection(unix_path) if unix_path else http.client.HTTPConnection(host, port, timeout=60)
+    try:
+        connection.request('GET', f"{route}?{urlencode(params or {})}")
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+def _dataset_argument(text):
+    """ Parses a NAME=PATH dataset argument; a bare path is named after its file. """
+    name, separator, path = text.partition('=')
+    if not separator:
+        path = text
+        name = os.path.splitext(os.path.basename(os.path.normpath(text)))[0]
+    return name, path
+
+def main(argv=None):
+    """
+    Main function to run the analysis daemon.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(description="Serve leak detection and usage queries on datasets kept in memory.")
+    parser.add_argument('datasets', nargs='+', type=_dataset_argument,
+                        help="Datasets to serve, as NAME=PATH or PATH (named after the file).")
+    parser.add_argument('--host', default='127.0.0.1', help="Host to listen on.")
+    parser.add_argument('--port', type=int, default=9760, help="TCP port to listen on.")
+    parser.add_argument('--unix', default=None, help="Listen on this Unix socket path instead of TCP.")
+    parser.add_argument('--cache-entries', type=int, default=256, help="Maximum number of cached query results.")
+    parser.add_argument('--cache-mb', type=float, default=64, help="Maximum total size of the cached query results in MB.")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Parse CSV datasets without reading or writing their binary sidecar cache.")
+    parser.add_argument('--quiet', action='store_true', help="Do not log every request.")
+    args = parser.parse_args(argv)
+
+    service = AnalysisService(dict(args.datasets), cache_entries=args.cache_entries,
+                              cache_bytes=int(args.cache_mb * (1 << 20)), use_cache=args.use_cache)
+    service.store.load_all()
+    for name, dataset in service.store.datasets.items():
+        print(f"Loaded {name} ({dataset.path}): {len(dataset.data)} rows in {dataset.load_seconds:.2f} s")
+    print(f"Serving on {args.unix or f'http://{args.host}:{args.port}'}")
+    try:
+        serve(service, args.host, args.port, args.unix, quiet=args.quiet)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+baseline_detection.py
+
+This script detects persistent leakages from the residual series of every junction: its reading minus the
+usage it is balanced against (the connected endpoints, or its direct children with `--hierarchical`).
+Unlike `leakage_detection.py`, which flags every hour in which a junction reading exceeds that usage, it
+learns the noise level of every junction and only flags residuals that clearly and persistently exceed it.
+
+Every statistic is a rolling-window operation over the (hours x junctions) residual matrix, on an hourly grid:
+- Noise: the median absolute deviation (MAD) of the residuals around their median over a trailing window of days.
+- Minimum night flow: the smallest residual during the night hours of every day, when legitimate usage and the
+  metering errors that scale with it are lowest, so that a leak makes up most of the flow. Its rolling median
+  over the trailing window tells persistent leaks apart from errors that follow the daily usage pattern.
+- Persistence: the fraction of the last hours in which the residual exceeded the noise threshold.
+
+Functions:
+- residual_matrix: Pivots a dataset into hourly (hours x junctions) residual and outflow matrices.
+- rolling_window_median: Median of the non-missing values of every trailing window of days.
+- rolling_baseline: Computes the rolling residual median, noise level and minimum night flow of every junction.
+- detect_persistent_leakages: Identifies persistent leakages and their confidence.
+- main: Entry point for running the baseline leakage detection.
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from data_analysis.leak_report import FORMATS, build_leak_report, print_report_summary, write_leak_report
+from data_analysis.leakage_detection import junction_endpoint_totals, junction_rollup
+from data_generation.columnar_dataset import TIMESTAMP_FORMAT, read_dataset
+from data_generation.instrumentation import add_metrics_arguments, metrics_session, stage
+
+HOURS_PER_DAY = 24
+# Scales a median absolute deviation to the standard deviation of normally distributed noise
+MAD_SCALE = 1.4826
+
+def residual_matrix(data, hierarchical=False):
+    """
+    Pivots the junction readings and the usage they are balanced against into hourly matrices.
+
+    Rows are the hours from midnight of the first day to the end of the last day, so every day has 24 rows;
+    hours without a reading of a junction are NaN.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information, with hourly timestamps.
+    - hierarchical (bool): Balance every junction against its direct children instead of its connected endpoints.
+
+    Returns:
+    - Dict: The dataset's timestamp of every hour (`timestamps`, None for hours without readings), the
+      `junction_ids` (Index), their `paths`, and the (hours x junctions) `outflow` and `residual` (outflow
+      minus balanced usage) matrices.
+    """
+    if hierarchical:
+        rollup = junction_rollup(data)
+        timestamps, junction_ids = rollup['timestamps'], rollup['junction_ids']
+        usage, timestamp_codes = rollup['children_usage'], rollup['timestamp_codes']
+    else:
+        usage, timestamps, junction_ids, timestamp_codes = junction_endpoint_totals(data)
+
+    hours = pd.to_datetime(pd.Series(np.asarray(timestamps), dtype=object), format=TIMESTAMP_FORMAT)
+    hours = hours.to_numpy().astype('datetime64[h]')
+    if len(np.unique(hours)) != len(hours):
+        raise ValueError("Baseline detection expects at most one reading time per hour.")
+    start = hours.min().astype('datetime64[D]').astype('datetime64[h]') if len(hours) else np.datetime64(0, 'h')
+    grid_rows = (hours - start).astype(np.int64)
+    days = -(-(int(grid_rows.max()) + 1) // HOURS_PER_DAY) if len(hours) else 0
+
+    junction_rows = np.flatnonzero((data['type'] == 'Junction').to_numpy() & (timestamp_codes >= 0))
+    row_codes = timestamp_codes[junction_rows]
+    row_junctions = junction_ids.get_indexer(data['sensor_id'].to_numpy()[junction_rows])
+
+    outflow = np.full((days * HOURS_PER_DAY, len(junction_ids)), np.nan)
+    outflow[grid_rows[row_codes], row_junctions] = data['water_usage'].to_numpy(dtype=np.float64, na_value=np.nan)[junction_rows]
+    balanced_usage = np.full_like(outflow, np.nan)
+    balanced_usage[grid_rows] = usage
+    grid_timestamps = np.full(len(outflow), None, dtype=object)
+    grid_timestamps[grid_rows] = np.asarray(timestamps, dtype=object)
+
+    first_rows = pd.Series(junction_rows).groupby(row_junctions).first()
+    paths = pd.Series(index=range(len(junction_ids)), dtype=object)
+    paths[first_rows.index] = data['path_to_master'].to_numpy()[first_rows.to_numpy()]
+
+    return {
+        'timestamps': grid_timestamps,
+        'junction_ids': junction_ids,
+        'paths': paths.to_numpy(),
+        'outflow': outflow,
+        'residual': outflow - balanced_usage,
+    }
+
+def _median_last_axis(values):
+    """ Median of the non-missing values along the last axis, sorting in place; NaN where all are missing. """
+    values.sort(axis=-1)
+    counts = np.count_nonzero(~np.isnan(values), axis=-1)[..., None]
+    # NaN sorts last, so the middle of the non-missing values is at the same positions as without them
+    lower = np.take_along_axis(values, np.maximum(counts - 1, 0) // 2, axis=-1)[..., 0]
+    upper = np.take_along_axis(values, counts // 2 - (counts == 0), axis=-1)[..., 0]
+    median = (lower + upper) / 2
+    median[counts[..., 0] == 0] = np.nan
+    return median
+
+def rolling_window_median(daily_values, window_days, block_columns=128, deviations=False):
+    """
+    Computes the median of the non-missing values of every trailing window of days, for every junction.
+
+    Parameters:
+    - daily_values (ndarray): A (days x values per day x junctions) array.
+    - window_days (int): Number of days in every window, ending with the current day.
+    - block_columns (int): Number of junctions processed at once, which bounds the memory used.
+    - deviations (bool): Also return the median absolute deviation around every window's median.
+
+    Returns:
+    - ndarray: The (days x junctions) medians, and the median absolute deviations if `deviations` is set.
+    """
+    days, per_day, junctions = daily_values.shape
+    padded = np.concatenate([np.full((window_days - 1, per_day, junctions), np.nan), daily_values])
+    medians = np.empty((days, junctions))
+    spreads = np.empty((days, junctions))
+    for start in range(0, junctions, block_columns):
+        columns = slice(start, start + block_columns)
+        # (days x values per day x junctions x window) view, copied into one row of values per day and junction
+        windows = sliding_window_view(padded[:, :, columns], window_days, axis=0).transpose(0, 2, 3, 1)
+        windows = np.array(windows.reshape(days, windows.shape[1], window_days * per_day))
+        medians[:, columns] = _median_last_axis(windows)
+        if deviations:
+            spreads[:, columns] = _median_last_axis(np.abs(windows - medians[:, columns, None]))
+    return (medians, spreads) if deviations else medians
+
+def rolling_baseline(residual, outflow, window_days=7, night_hours=(2, 5), min_noise=0.01):
+    """
+    Computes the rolling statistics of every junction's residual series, one value per day and junction.
+
+    Parameters:
+    - residual (ndarray): The (hours x junctions) residual matrix of `residual_matrix`.
+    - outflow (ndarray): The (hours x junctions) junction outflow matrix of `residual_matrix`.
+    - window_days (int): Number of days in the trailing window, including the current day.
+    - night_hours (Tuple[int, int]): First and last (exclusive) hour of the night.
+    - min_noise (float): Lower bound of the noise level, as a fraction of the junction's mean outflow,
+      so that a noise-free series does not turn rounding errors into leaks.
+
+    Returns:
+    - Dict: The (days x junctions) rolling `median` of the residuals, the `noise` level (the scaled MAD)
+      and the rolling median of the daily minimum `night_flow`.
+    """
+    days = len(residual) // HOURS_PER_DAY
+    daily_residuals = residual.reshape(days, HOURS_PER_DAY, -1)
+    median, spread = rolling_window_median(daily_residuals, window_days, deviations=True)
+
+    # Mean outflow over the window, from cumulative daily sums and counts
+    daily_outflow = outflow.reshape(days, HOURS_PER_DAY, -1)
+    sums = np.cumsum(np.nansum(daily_outflow, axis=1), axis=0)
+    counts = np.cumsum(np.count_nonzero(~np.isnan(daily_outflow), axis=1), axis=0)
+    sums[window_days:] = sums[window_days:] - sums[:-window_days]
+    counts[window_days:] = counts[window_days:] - counts[:-window_days]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_outflow = sums / counts
+    noise = np.fmax(MAD_SCALE * spread, min_noise * np.abs(mean_outflow))
+    noise = np.fmax(noise, np.finfo(np.float64).tiny)
+
+    # Daily minimum of the night residuals, NaN for nights without readings
+    night = daily_residuals[:, night_hours[0]:night_hours[1]]
+    night_minimum = np.where(np.isnan(night), np.inf, night).min(axis=1)
+    night_minimum[np.isinf(night_minimum) & (night_minimum > 0)] = np.nan
+    night_flow = rolling_window_median(night_minimum[:, None, :], window_days)
+
+    return {'median': median, 'noise': noise, 'night_flow': night_flow}
+
+def detect_persistent_leakages(data, window_days=7, threshold=3.0, persistence=6, min_persistence=0.75,
+                               night_hours=(2, 5), min_noise=0.01, hierarchical=False):
+    """
+    Detects persistent leakages against a rolling per-junction baseline.
+
+    A junction is flagged at an hour when its residual exceeds `threshold` times its noise level and did so
+    in at least `min_persistence` of the last `persistence` hours. The confidence of a leak is the mean of
+    three scores between 0 and 1: how far the residual exceeds the threshold, the fraction of the last hours
+    above it, and how much of it the rolling minimum night flow confirms.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information, with hourly timestamps.
+    - window_days (int): Number of days in the trailing window of the rolling statistics.
+    - threshold (float): Number of noise levels a residual has to exceed.
+    - persistence (int): Number of hours, including the current one, over which persistence is measured.
+    - min_persistence (float): Fraction of those hours in which the threshold must have been exceeded.
+    - night_hours (Tuple[int, int]): First and last (exclusive) hour of the night.
+    - min_noise (float): Lower bound of the noise level, as a fraction of the junction's mean outflow.
+    - hierarchical (bool): Balance every junction against its direct children instead of its connected endpoints.
+
+    Returns:
+    - List[Dict]: Leakage information in the format of `detect_leakages`, with an added `confidence`,
+      ordered by timestamp and junction.
+    - float: The total leakage amount of the flagged leaks.
+    """
+    with stage('detect.residuals') as metrics:
+        matrices = residual_matrix(data, hierarchical=hierarchical)
+        residual, outflow = matrices['residual'], matrices['outflow']
+        metrics.add(rows=len(data), groups=residual.shape[1])
+
+    with stage('detect.baseline') as metrics:
+        baseline = rolling_baseline(residual, outflow, window_days, night_hours, min_noise)
+        metrics.add(rows=residual.size)
+
+    with stage('detect.compare') as metrics:
+        noise = np.repeat(baseline['noise'], HOURS_PER_DAY, axis=0)
+        with np.errstate(invalid='ignore'):
+            scores = residual / noise
+            exceeding = scores > threshold
+
+        # Fraction of the last `persistence` hours above the threshold, from a cumulative count
+        cumulative = np.cumsum(exceeding, axis=0)
+        recent = cumulative.copy()
+        recent[persistence:] -= cumulative[:-persistence]
+        persistent = recent / persistence
+        flagged = exceeding & (persistent >= min_persistence)
+
+        rows, columns = np.nonzero(flagged)
+        amounts = residual[rows, columns]
+        strength = 1 - np.exp(-(scores[rows, columns] - threshold) / threshold)
+        night_flow = np.repeat(baseline['night_flow'], HOURS_PER_DAY, axis=0)[rows, columns]
+        night = np.clip(np.nan_to_num(night_flow / (threshold * noise[rows, columns])), 0, 1)
+        confidence = (strength + persistent[rows, columns] + night) / 3
+
+        timestamps = matrices['timestamps'][rows]
+        percentages = amounts / outflow[rows, columns] * 100
+        metrics.add(rows=residual.size, leaks=len(rows))
+
+    leakages = []
+    total_leakage_amount = 0
+    junction_ids = matrices['junction_ids'][columns].tolist()
+    paths = matrices['paths'][columns]
+    for timestamp, junction_id, amount, percentage, path, score in zip(
+            timestamps, junction_ids, amounts, percentages, paths, confidence):
+        total_leakage_amount += amount
+        leakages.append({
+            'timestamp': (timestamp,),
+            'junction_id': junction_id,
+            'leakage_amount': amount,
+            'leakage_percentage': percentage,
+            'path_to_master': path,
+            'confidence': score
+        })
+
+    return leakages, total_leakage_amount
+
+def main(argv=None):
+    """
+    Main function to execute the baseline leakage detection and write its leak report.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(description="Detect persistent leakages against rolling per-junction baselines.")
+    parser.add_argument('file_path', nargs='?', default='datasets/water_distribution_data_leak.csv',
+                        help="Path to the CSV dataset file or columnar dataset directory.")
+    parser.add_argument('--window-days', type=int, default=7, help="Days in the trailing window of the rolling statistics.")
+    parser.add_argument('--threshold', type=float, default=3.0, help="Noise levels a residual has to exceed.")
+    parser.add_argument('--persistence', type=int, default=6, help="Hours over which persistence is measured.")
+    parser.add_argument('--min-persistence', type=float, default=0.75,
+                        help="Fraction of those hours in which the threshold must have been exceeded.")
+    parser.add_argument('--night-hours', type=int, nargs=2, default=[2, 5], metavar=('FIRST', 'END'),
+                        help="First and last (exclusive) hour of the night used for the minimum night flow.")
+    parser.add_argument('--min-noise', type=float, default=0.01,
+                        help="Lower bound of the noise level, as a fraction of the junction's mean outflow.")
+    parser.add_argument('--min-confidence', type=float, default=0.0, help="Only report leaks with at least this confidence.")
+    parser.add_argument('--hierarchical', action='store_true',
+                        help="Balance every junction against its direct children instead of all endpoints on its path.")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Parse the CSV dataset without reading or writing its binary sidecar cache.")
+    parser.add_argument('--output-dir', default='outputs', help="Directory in which the report tables are saved.")
+    parser.add_argument('--format', dest='formats', nargs='+', choices=FORMATS, default=['csv'],
+                        help="Output formats of the report tables (Parquet needs pyarrow or fastparquet).")
+    parser.add_argument('--top-k', type=int, default=10, help="Number of junctions in the top junctions table.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with metrics_session(args, 'baseline_detection'):
+        with stage('load') as metrics:
+            data = read_dataset(args.file_path, cache=args.use_cache)
+            metrics.add(rows=len(data))
+
+        with stage('detect') as metrics:
+            leakage_info, _ = detect_persistent_leakages(
+                data, window_days=args.window_days, threshold=args.threshold, persistence=args.persistence,
+                min_persistence=args.min_persistence, night_hours=tuple(args.night_hours),
+                min_noise=args.min_noise, hierarchical=args.hierarchical)
+            metrics.add(rows=len(data), leaks=len(leakage_info))
+
+        leaks = pd.DataFrame(leakage_info, columns=['timestamp', 'junction_id', 'leakage_amount', 'leakage_percentage',
+                                                    'path_to_master', 'confidence'])
+        leaks = leaks.astype({'leakage_amount': np.float64, 'leakage_percentage': np.float64, 'confidence': np.float64})
+        leaks['timestamp'] = leaks['timestamp'].str[0]
+        leaks = leaks[leaks['confidence'] >= args.min_confidence].reset_index(drop=True)
+        total_leakage = sum(leaks['leakage_amount'].tolist(), 0)
+
+        report = build_leak_report(leaks, top_k=args.top_k)
+        paths = write_leak_report(report, args.output_dir, args.formats, prefix='baseline_report')
+        print_report_summary(report, total_leakage, paths)
+
+if __name__ == "__main__":
+    main()
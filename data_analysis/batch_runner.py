@@ -0,0 +1,255 @@
+"""
+batch_runner.py
+
+This script analyzes the datasets of several districts at once. It runs leakage detection and the endpoint
+usage calculation for every dataset in a process pool and merges the results into consolidated outputs in
+which every row is tagged with its district:
+
+- batch_leaks.csv: The leaks of every district, in the format of `leakage_detection.leakage_frame`.
+- batch_endpoint_usage.csv: The water usage of every endpoint of every district over the time range.
+- batch_summary.csv: One row per district with its status, error, row, leak and total leakage counts, the
+  hash of its usage output and the time taken by every stage.
+
+A failing dataset is reported in the summary and does not stop the other districts.
+
+Datasets are given as a directory, in which every CSV file and columnar dataset directory is a district named
+after the file, or as a JSON manifest listing `{"district": ..., "path": ...}` entries, optionally with their
+own `from` and `to` timestamps. Relative paths in a manifest are relative to the manifest's directory.
+
+Functions:
+- discover_datasets: Lists the datasets of a directory or a manifest file.
+- analyze_district: Runs leakage detection and usage calculation on the dataset of one district.
+- run_batch: Analyzes many districts in a process pool and collects their results.
+- write_batch_outputs: Writes the consolidated, district-tagged outputs.
+- main: Entry point for running the batch analysis.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+from data_analysis.leakage_detection import leakage_frame
+from data_generation.columnar_dataset import cache_path_for, is_columnar_dataset, read_dataset
+
+SUMMARY_COLUMNS = ['district', 'path', 'status', 'error', 'rows', 'leaks', 'total_leakage', 'endpoints',
+                   'usage_sha256', 'load_seconds', 'detect_seconds', 'usage_seconds', 'total_seconds']
+
+def discover_datasets(source):
+    """
+    Lists the datasets of a directory or a manifest file.
+
+    Parameters:
+    - source (str): A directory of CSV files and columnar dataset directories, or a JSON manifest file
+      holding a list of entries (or an object with a `datasets` list) with a `district` and a `path`.
+
+    Returns:
+    - List[Dict]: One entry per dataset with its `district` and `path`, and `from` / `to` when the
+      manifest gives them, sorted by district.
+    """
+    if os.path.isdir(source):
+        entries = []
+        names = sorted(os.listdir(source))
+        # The binary sidecar caches of CSV datasets are columnar datasets too, but not districts of their own
+        caches = {cache_path_for(os.path.join(source, name)) for name in names if name.endswith('.csv')}
+        for name in names:
+            path = os.path.join(source, name)
+            if name.endswith('.csv') and os.path.isfile(path):
+                entries.append({'district': name[:-len('.csv')], 'path': path})
+            elif os.path.normpath(path) not in caches and is_columnar_dataset(path):
+                entries.append({'district': name, 'path': path})
+    else:
+        with open(source) as manifest_file:
+            manifest = json.load(manifest_file)
+        entries = manifest['datasets'] if isinstance(manifest, dict) else manifest
+        base = os.path.dirname(os.path.abspath(source))
+        entries = [dict(entry, path=os.path.join(base, entry['path'])) for entry in entries]
+
+    districts = [entry['district'] for entry in entries]
+    duplicates = sorted({district for district in districts if districts.count(district) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate district names: {', '.join(duplicates)}")
+    return sorted(entries, key=lambda entry: entry['district'])
+
+def analyze_district(district, path, from_timestamp=None, to_timestamp=None, hierarchical=False, use_cache=False):
+    """
+    Runs leakage detection and usage calculation on the dataset of one district.
+
+    Parameters:
+    - district (str): Name of the district.
+    - path (str): Path to the CSV dataset file or columnar dataset directory.
+    - from_timestamp (str, optional): Start of the usage time range (inclusive), defaults to the first reading.
+    - to_timestamp (str, optional): End of the usage time range (inclusive), defaults to the last reading.
+    - hierarchical (bool): Balance every junction against its direct children instead of all endpoints on its path.
+    - use_cache (bool): Read a CSV dataset through its binary sidecar cache, creating it if needed.
+
+    Returns:
+    - Dict: The `district`, its `leaks` and endpoint `usage` DataFrames, the `total_leakage`, the number
+      of `rows`, the usage output's `usage_sha256` and the `timings` of every stage in seconds.
+    """
+    timings = {}
+    started = time.perf_counter()
+    data = read_dataset(path, cache=use_cache)
+    timings['load'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    leaks, total_leakage = leakage_frame(data, hierarchical=hierarchical)
+    timings['detect'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    selected = data['type'] == 'Endpoint'
+    if from_timestamp is not None:
+        selected &= data['timestamp'] >= from_timestamp
+    if to_timestamp is not None:
+        selected &= data['timestamp'] <= to_timestamp
+    usage = data[selected].groupby('sensor_id')['water_usage'].sum().reset_index()
+    # The hash of the file usage_calculation.py writes for the same range
+    usage_sha256 = hashlib.sha256(usage.to_csv(index=False).encode()).hexdigest()
+    timings['usage'] = time.perf_counter() - started
+
+    return {
+        'district': district,
+        'leaks': leaks,
+        'usage': usage,
+        'total_leakage': total_leakage,
+        'rows': len(data),
+        'usage_sha256': usage_sha256,
+        'timings': timings,
+    }
+
+def run_batch(entries, workers=None, from_timestamp=None, to_timestamp=None, hierarchical=False, use_cache=False,
+              on_result=None):
+    """
+    Analyzes the datasets of many districts in a process pool.
+
+    A district whose analysis raises an exception is recorded as failed; the other districts go on.
+
+    Parameters:
+    - entries (List[Dict]): Datasets as returned by `discover_datasets`.
+    - workers (int, optional): Number of worker processes, defaults to the number of CPUs.
+    - from_timestamp (str, optional): Start of the usage time range for entries that do not give their own.
+    - to_timestamp (str, optional): End of the usage time range for entries that do not give their own.
+    - hierarchical (bool): Balance every junction against its direct children instead of all endpoints on its path.
+    - use_cache (bool): Read CSV datasets through their binary sidecar cache.
+    - on_result (Callable[[Dict], None], optional): Called with every summary row as soon as its district is done.
+
+    Returns:
+    - List[Dict]: The results of the successful districts, as returned by `analyze_district`.
+    - DataFrame: The run summary, one row per district in the order of `entries`.
+    """
+    results = {}
+    summary = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for entry in entries:
+            future = executor.submit(analyze_district, entry['district'], entry['path'],
+                                     entry.get('from', from_timestamp), entry.get('to', to_timestamp),
+                                     hierarchical, use_cache)
+            futures[future] = (entry, time.perf_counter())
+
+        for future in as_completed(futures):
+            entry, submitted = futures[future]
+            row = {'district': entry['district'], 'path': entry['path']}
+            try:
+                result = future.result()
+            except Exception as error:
+                row.update(status='failed', error=f"{type(error).__name__}: {error}")
+            else:
+                results[entry['district']] = result
+                row.update(status='ok', rows=result['rows'], leaks=len(result['leaks']),
+                           total_leakage=result['total_leakage'], endpoints=len(result['usage']),
+                           usage_sha256=result['usage_sha256'])
+                row.update({f"{name}_seconds": seconds for name, seconds in result['timings'].items()})
+            # Time from submission, including the wait for a free worker
+            row['total_seconds'] = time.perf_counter() - submitted
+            summary[entry['district']] = row
+            if on_result is not None:
+                on_result(row)
+
+    order = [entry['district'] for entry in entries]
+    summary = pd.DataFrame([summary[district] for district in order], columns=SUMMARY_COLUMNS)
+    # Failed districts have no counts, keep the others integers
+    summary = summary.astype({'rows': 'Int64', 'leaks': 'Int64', 'endpoints': 'Int64'})
+    return [results[district] for district in order if district in results], summary
+
+def write_batch_outputs(results, summary, output_dir='outputs'):
+    """
+    Writes the consolidated leaks, endpoint usage and run summary, tagging every row with its district.
+
+    Parameters:
+    - results (List[Dict]): Results of the successful districts, as returned by `run_batch`.
+    - summary (DataFrame): The run summary, as returned by `run_batch`.
+    - output_dir (str): Directory in which the files are saved.
+
+    Returns:
+    - List[str]: Paths of the leaks, usage and summary files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, key in (('batch_leaks.csv', 'leaks'), ('batch_endpoint_usage.csv', 'usage')):
+        tables = [result[key].assign(district=result['district']) for result in results]
+        merged = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=['district'])
+        merged = merged[['district'] + [column for column in merged.columns if column != 'district']]
+        path = os.path.join(output_dir, name)
+        merged.to_csv(path, index=False)
+        paths.append(path)
+
+    path = os.path.join(output_dir, 'batch_summary.csv')
+    summary.to_csv(path, index=False)
+    paths.append(path)
+    return paths
+
+def _print_progress(row):
+    """ Prints one line per finished district. """
+    if row['status'] == 'ok':
+        print(f"[ok] {row['district']}: {row['leaks']} leaks, {row['total_leakage']:.2f} units "
+              f"in {row['total_seconds']:.2f}s")
+    else:
+        print(f"[failed] {row['district']}: {row['error']}")
+
+def main(argv=None):
+    """
+    Main function to run the batch analysis of many districts.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+
+    Returns:
+    - int: Exit status, 1 if any district failed.
+    """
+    parser = argparse.ArgumentParser(description="Run leakage detection and usage calculation for many districts.")
+    parser.add_argument('source', help="Directory of datasets, or a JSON manifest of district datasets.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument('--from', dest='from_timestamp', default=None,
+                        help="Start of the usage time range (YYYY-MM-DD HH:MM:SS), defaults to the first reading.")
+    parser.add_argument('--to', dest='to_timestamp', default=None,
+                        help="End of the usage time range (YYYY-MM-DD HH:MM:SS), defaults to the last reading.")
+    parser.add_argument('--hierarchical', action='store_true',
+                        help="Balance every junction against its direct children instead of all endpoints on its path.")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Parse CSV datasets without reading or writing their binary sidecar cache.")
+    parser.add_argument('--output-dir', default='outputs', help="Directory in which the consolidated outputs are saved.")
+    args = parser.parse_args(argv)
+
+    entries = discover_datasets(args.source)
+    print(f"Analyzing {len(entries)} districts from {args.source}")
+    started = time.perf_counter()
+    results, summary = run_batch(entries, workers=args.workers, from_timestamp=args.from_timestamp,
+                                 to_timestamp=args.to_timestamp, hierarchical=args.hierarchical,
+                                 use_cache=args.use_cache, on_result=_print_progress)
+    paths = write_batch_outputs(results, summary, args.output_dir)
+
+    failed = summary[summary['status'] != 'ok']
+    print("-" * 30)
+    print(f"{len(summary) - len(failed)} of {len(summary)} districts analyzed in {time.perf_counter() - started:.2f}s")
+    for row in failed.itertuples(index=False):
+        print(f"Failed: {row.district} ({row.error})")
+    print(f"Outputs written to {', '.join(paths)}")
+    return 1 if len(failed) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+incremental_detection.py
+
+This script detects leakages in an append-only CSV dataset incrementally. After every run it saves a checkpoint
+next to the dataset (`<dataset>.checkpoint.json`) with the byte offset up to which the file was read, the last
+fully processed timestamp and the trailing rows that were not processed yet: the group of the last timestamp,
+which may still grow, and a partially written line. The next run seeks to the offset, analyzes only the new
+complete timestamp groups and appends their leaks to the existing leak output.
+
+The checkpoint also holds digests of the first bytes of the file and of the bytes just before the offset, and
+the size of the leak output. When the dataset was truncated or rewritten, its timestamps go backwards, the leak
+output was changed, or the detection settings differ, the whole dataset is rescanned and the output rewritten.
+
+Functions:
+- checkpoint_path_for: Returns the path at which the checkpoint of a dataset is stored.
+- load_checkpoint: Loads the checkpoint of a dataset.
+- checkpoint_mismatch: Tells why a checkpoint cannot be continued, if it cannot.
+- detect_leakages_incremental: Detects the leakages of the data appended since the last checkpoint.
+- main: Entry point for running the incremental leakage detection.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from data_analysis.leakage_detection import leakage_frame
+from data_generation.columnar_dataset import CSV_DTYPES, is_columnar_dataset
+from data_generation.instrumentation import add_metrics_arguments, metrics_session, stage
+
+CHECKPOINT_VERSION = 1
+# Blank lines parse as rows of missing values, which the int32 sensor ids of CSV_DTYPES cannot hold
+BLOCK_DTYPES = {**CSV_DTYPES, 'sensor_id': 'Int32'}
+# Number of bytes at the start of the file and before the offset whose digests identify the processed data
+DIGEST_BYTES = 1 << 16
+
+def checkpoint_path_for(file_path):
+    """
+    Returns the path at which the checkpoint of a dataset is stored.
+
+    Parameters:
+    - file_path (str): Path to the CSV dataset file.
+
+    Returns:
+    - str: Path of the checkpoint file.
+    """
+    return os.path.normpath(file_path) + '.checkpoint.json'
+
+def _digest(file, start, end):
+    """ SHA-256 of the bytes of an open file between two offsets. """
+    file.seek(start)
+    return hashlib.sha256(file.read(end - start)).hexdigest()
+
+def _file_digests(file, offset):
+    """ Digests of the first bytes of a file and of the bytes before an offset. """
+    return {
+        'head_digest': _digest(file, 0, min(offset, DIGEST_BYTES)),
+        'tail_digest': _digest(file, max(offset - DIGEST_BYTES, 0), offset),
+    }
+
+def load_checkpoint(file_path):
+    """
+    Loads the checkpoint of a dataset.
+
+    Parameters:
+    - file_path (str): Path to the CSV dataset file.
+
+    Returns:
+    - Dict: The checkpoint, or None if there is none or it has another version.
+    """
+    try:
+        with open(checkpoint_path_for(file_path)) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+    return checkpoint if checkpoint.get('version') == CHECKPOINT_VERSION else None
+
+def _save_checkpoint(checkpoint, file_path):
+    """ Writes a checkpoint atomically, so that an interrupted run leaves the previous one intact. """
+    path = checkpoint_path_for(file_path)
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+def checkpoint_mismatch(checkpoint, file_path, output_path, hierarchical=False):
+    """
+    Tells why a checkpoint cannot be continued with the current dataset and leak output.
+
+    Parameters:
+    - checkpoint (Dict): The checkpoint, as returned by `load_checkpoint`.
+    - file_path (str): Path to the CSV dataset file.
+    - output_path (str): Path of the leak output file.
+    - hierarchical (bool): Whether the run balances every junction against its direct children.
+
+    Returns:
+    - str: The reason for a full rescan, or None if the checkpoint can be continued.
+    """
+    if checkpoint is None:
+        return "no checkpoint"
+    if checkpoint['hierarchical'] != hierarchical or checkpoint['output_path'] != os.path.abspath(output_path):
+        return "detection settings changed"
+    if not os.path.exists(output_path) or os.path.getsize(output_path) < checkpoint['output_size']:
+        return "leak output changed"
+    if os.path.getsize(file_path) < checkpoint['offset']:
+        return "dataset truncated"
+    with open(file_path, 'rb') as file:
+        digests = _file_digests(file, checkpoint['offset'])
+    if digests != {name: checkpoint[name] for name in digests}:
+        return "dataset rewritten"
+    return None
+
+def _read_rows(header, lines, skip_blank_lines=True):
+    """ Parses CSV lines with the dataset header, reading blank lines as rows of missing values if not skipped. """
+    return pd.read_csv(io.BytesIO(header + lines), dtype=BLOCK_DTYPES, skip_blank_lines=skip_blank_lines)
+
+def _iter_complete_groups(file, header, carry, end, block_size):
+    """
+    Parses the bytes of a file up to an offset in blocks, yielding DataFrames of complete timestamp groups.
+
+    The rows of the last timestamp read and any partial line are carried over to the next block; the final
+    carry is sent back as the value of the StopIteration, for the next checkpoint.
+    """
+    while True:
+        data = file.read(max(min(block_size, end - file.tell()), 0))
+        buffer = carry + data
+        lines = buffer[:buffer.rfind(b'\n') + 1]
+        carry = buffer[len(lines):]
+        if lines:
+            # Blank lines are kept as rows, so that row k starts after the k-th newline of the block
+            rows = _read_rows(header, lines, skip_blank_lines=False)
+            line_starts = np.concatenate([[0], np.flatnonzero(np.frombuffer(lines, dtype=np.uint8) == ord('\n'))[:-1] + 1])
+
+            # The last group starts after the last row of an earlier timestamp, blank rows are carried with it
+            timestamps = rows['timestamp'].to_numpy()
+            filled = rows['timestamp'].notna().to_numpy()
+            last_group = filled.nonzero()[0][-1] if filled.any() else 0
+            last_timestamp = timestamps[last_group]
+            while last_group > 0 and (not filled[last_group - 1] or timestamps[last_group - 1] == last_timestamp):
+                last_group -= 1
+            if last_group > 0 or not data:
+                carry = lines[line_starts[last_group]:] + carry
+                complete = rows.iloc[:last_group].dropna(how='all').astype(CSV_DTYPES)
+                if len(complete):
+                    yield complete
+            else:
+                # Only one timestamp so far, read on until the next one starts
+                carry = lines + carry
+        if not data:
+            return carry
+
+def _append_leaks(block, output_path, hierarchical):
+    """ Detects the leaks of a block of complete timestamp groups and appends them to the leak output. """
+    with stage('detect') as metrics:
+        leaks, _ = leakage_frame(block, hierarchical=hierarchical)
+        metrics.add(rows=len(block), leaks=len(leaks))
+    with stage('write') as metrics:
+        # The header is written with the first leaks of a new output
+        leaks.to_csv(output_path, mode='a', header=os.path.getsize(output_path) == 0, index=False)
+        metrics.add(rows=len(leaks))
+    return leaks
+
+def detect_leakages_incremental(file_path, output_path='outputs/leak_report_leaks.csv', hierarchical=False,
+                                block_size=64 << 20, flush=False, full=False):
+    """
+    Detects the leakages of the timestamp groups appended to a CSV dataset since its last checkpoint.
+
+    The new leaks are appended to the leak output, and a new checkpoint is saved. The dataset is rescanned
+    completely and the leak output rewritten when the checkpoint cannot be continued (see `checkpoint_mismatch`).
+
+    Parameters:
+    - file_path (str): Path to the append-only CSV dataset file.
+    - output_path (str): Path of the CSV leak output, with the columns of `leakage_detection.leakage_frame`.
+    - hierarchical (bool): Balance every junction against its direct children with `detect_leakages_hierarchical`.
+    - block_size (int): Number of bytes parsed at once, which bounds the memory used.
+    - flush (bool): Also process the trailing timestamp group, for a dataset that will not grow any more.
+    - full (bool): Rescan the whole dataset even if the checkpoint could be continued.
+
+    Returns:
+    - Dict: The run's `mode` ('incremental' or 'full'), the `reason` for a full rescan, the numbers of
+      `bytes_read`, `new_rows` and `new_leaks`, and the cumulative `leaks` count and `total_leakage`.
+    """
+    if is_columnar_dataset(file_path):
+        raise ValueError("Incremental detection needs an append-only CSV dataset, not a columnar dataset.")
+
+    checkpoint = load_checkpoint(file_path)
+    reason = "full rescan requested" if full else checkpoint_mismatch(checkpoint, file_path, output_path, hierarchical)
+    end = os.path.getsize(file_path)
+
+    with open(file_path, 'rb') as file:
+        if reason is None:
+            header = checkpoint['header'].encode('latin-1')
+            carry = checkpoint['carry'].encode('latin-1')
+            offset, last_timestamp = checkpoint['offset'], checkpoint['last_timestamp']
+            leak_count, total_leakage = checkpoint['leaks'], checkpoint['total_leakage']
+            # Drop leaks appended by a run that was interrupted before it saved its checkpoint
+            with open(output_path, 'r+b') as output_file:
+                output_file.truncate(checkpoint['output_size'])
+        else:
+            header = file.readline()
+            carry = b''
+            offset, last_timestamp = file.tell(), None
+            leak_count, total_leakage = 0, 0
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            open(output_path, 'w').close()
+
+        file.seek(offset)
+        groups = _iter_complete_groups(file, header, carry, end, block_size)
+        new_rows = 0
+        new_leaks = 0
+        while True:
+            try:
+                with stage('load') as metrics:
+                    block = next(groups)
+                    metrics.add(rows=len(block))
+            except StopIteration as stop:
+                carry = stop.value
+                break
+            if reason is None and last_timestamp is not None and block['timestamp'].iloc[0] <= last_timestamp:
+                # The timestamps went backwards, so the processed data was not simply appended to
+                run = detect_leakages_incremental(file_path, output_path, hierarchical, block_size, flush, full=True)
+                run['reason'] = "timestamps went backwards"
+                return run
+
+            leaks = _append_leaks(block, output_path, hierarchical)
+            new_rows += len(block)
+            new_leaks += len(leaks)
+            total_leakage = sum(leaks['leakage_amount'].tolist(), total_leakage)
+            last_timestamp = max(block['timestamp'].max(), last_timestamp or '')
+
+        lines = carry[:carry.rfind(b'\n') + 1]
+        if flush and lines.strip():
+            # Process the trailing group too; later rows of its timestamp will trigger a full rescan
+            block = _read_rows(header, lines).dropna(how='all').astype(CSV_DTYPES)
+            leaks = _append_leaks(block, output_path, hierarchical)
+            new_rows += len(block)
+            new_leaks += len(leaks)
+            total_leakage = sum(leaks['leakage_amount'].tolist(), total_leakage)
+            last_timestamp = max(block['timestamp'].max(), last_timestamp or '')
+            carry = carry[len(lines):]
+
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'hierarchical': hierarchical,
+            'output_path': os.path.abspath(output_path),
+            'output_size': os.path.getsize(output_path),
+            'header': header.decode('latin-1'),
+            'offset': end,
+            'last_timestamp': last_timestamp,
+            # Bytes are stored one character each, so that any content survives the JSON round trip
+            'carry': carry.decode('latin-1'),
+            'leaks': leak_count + new_leaks,
+            'total_leakage': total_leakage,
+        }
+        checkpoint.update(_file_digests(file, end))
+    _save_checkpoint(checkpoint, file_path)
+
+    return {
+        'mode': 'incremental' if reason is None else 'full',
+        'reason': reason,
+        'bytes_read': end - offset,
+        'new_rows': new_rows,
+        'new_leaks': new_leaks,
+        'leaks': leak_count + new_leaks,
+        'total_leakage': total_leakage,
+    }
+
+def main(argv=None):
+    """
+    Main function to execute the incremental leakage detection.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(description="Detect leakages in the data appended to a CSV dataset since the last run.")
+    parser.add_argument('file_path', nargs='?', default='datasets/water_distribution_data_leak.csv',
+                        help="Path to the append-only CSV dataset file.")
+    parser.add_argument('--output', default='outputs/leak_report_leaks.csv', help="CSV file to which new leaks are appended.")
+    parser.add_argument('--hierarchical', action='store_true',
+                        help="Balance every junction against its direct children instead of all endpoints on its path.")
+    parser.add_argument('--block-mb', type=int, default=64, help="Megabytes of the dataset parsed at once.")
+    parser.add_argument('--flush', action='store_true',
+                        help="Also process the last timestamp group, for a dataset that will not grow any more.")
+    parser.add_argument('--full', action='store_true', help="Rescan the whole dataset and rewrite the leak output.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with metrics_session(args, 'incremental_detection'):
+        run = detect_leakages_incremental(args.file_path, args.output, hierarchical=args.hierarchical,
+                                          block_size=args.block_mb << 20, flush=args.flush, full=args.full)
+
+    if run['mode'] == 'full':
+        print(f"Full scan ({run['reason']}): {run['bytes_read']} bytes read")
+    else:
+        print(f"Incremental scan: {run['bytes_read']} new bytes read")
+    print(f"New: {run['new_rows']} rows, {run['new_leaks']} leaks appended to {args.output}")
+    print(f"Total Leakage in the System: {run['total_leakage']:.2f} units ({run['leaks']} leaks)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+leak_report.py
+
+This module builds the leakage detection report of a dataset as tables instead of printing every leak.
+The leaks are kept in one DataFrame (see `leakage_detection.leakage_frame`), from which vectorized rollups
+are computed, and every table is written in bulk to CSV, JSON Lines and/or Parquet files.
+
+Tables:
+- leaks: One row per leak, as found by the leakage detection.
+- by_junction: Leak count, total leakage, mean and peak percentage and first and last leak of every junction.
+- by_day: Leak count, total leakage and number of leaking junctions of every day.
+- top_junctions: The junctions with the largest total leakage.
+- runs: Leak-duration runs, the stretches of consecutive readings in which a junction kept leaking.
+
+Functions:
+- junction_rollup_table: Sums the leaks of every junction.
+- daily_rollup_table: Sums the leaks of every day.
+- leak_runs: Finds the runs of consecutive leaking readings of every junction.
+- build_leak_report: Builds all report tables from a leak DataFrame.
+- write_leak_report: Writes the report tables to files.
+- stream_leak_report: Builds and writes the report of leaks that arrive in blocks.
+- print_report_summary: Prints a concise summary of a report.
+"""
+
+import csv
+import importlib.util
+import os
+import numpy as np
+import pandas as pd
+
+from data_generation.columnar_dataset import TIMESTAMP_FORMAT
+from data_generation.instrumentation import stage
+
+REPORT_TABLES = ['leaks', 'by_junction', 'by_day', 'top_junctions', 'runs']
+FORMATS = ['csv', 'jsonl', 'parquet']
+# The data makers record one reading per sensor per hour
+READING_INTERVAL = pd.Timedelta(hours=1)
+
+def _parse_timestamps(timestamps):
+    """ Parses timestamp strings, converting every distinct value only once. """
+    codes, uniques = pd.factorize(np.asarray(timestamps), sort=True)
+    try:
+        parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format=TIMESTAMP_FORMAT).to_numpy()
+    except ValueError:
+        # Datasets from other sources may use another timestamp layout, e.g. ISO 8601 with a 'T'
+        parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format='mixed').to_numpy()
+    return parsed[codes]
+
+def _write_csv(table, path, mode='w'):
+    """ Writes a table like `DataFrame.to_csv(index=False)`, but formats its values with the faster csv module. """
+    columns = []
+    for name in table.columns:
+        values = table[name].tolist()
+        if table[name].isna().any():
+            # to_csv writes missing values as empty fields
+            values = ['' if pd.isna(value) else value for value in values]
+        columns.append(values)
+
+    with open(path, mode, newline='') as file:
+        writer = csv.writer(file, lineterminator=os.linesep)
+        if mode == 'w':
+            writer.writerow(table.columns)
+        writer.writerows(zip(*columns))
+
+def junction_rollup_table(leaks):
+    """
+    Sums the leaks of every junction.
+
+    Parameters:
+    - leaks (DataFrame): Leaks in the format of `leakage_frame`.
+
+    Returns:
+    - DataFrame: One row per junction with its path, leak count, total leakage, mean and peak leakage
+      percentage and the timestamps of its first and last leak, sorted by junction id.
+    """
+    grouped = leaks.groupby('junction_id', sort=True, observed=True)
+    table = grouped.agg(
+        path_to_master=('path_to_master', 'first'),
+        leak_count=('leakage_amount', 'size'),
+        total_leakage=('leakage_amount', 'sum'),
+        mean_percentage=('leakage_percentage', 'mean'),
+        max_percentage=('leakage_percentage', 'max'),
+        first_leak=('timestamp', 'min'),
+        last_leak=('timestamp', 'max'),
+    )
+    return table.reset_index()
+
+def _leak_days(leaks):
+    """ Returns the day of every leak. """
+    # Timestamps are 'YYYY-MM-DD HH:MM:SS' strings, so the day is their first ten characters
+    codes, uniques = pd.factorize(np.asarray(leaks['timestamp']), sort=True)
+    return np.asarray([timestamp[:10] for timestamp in uniques], dtype=object)[codes]
+
+def daily_rollup_table(leaks):
+    """
+    Sums the leaks of every day.
+
+    Parameters:
+    - leaks (DataFrame): Leaks in the format of `leakage_frame`.
+
+    Returns:
+    - DataFrame: One row per day with its leak count, total leakage and number of leaking junctions.
+    """
+    grouped = leaks.assign(date=_leak_days(leaks)).groupby('date', sort=True)
+    table = grouped.agg(
+        leak_count=('leakage_amount', 'size'),
+        total_leakage=('leakage_amount', 'sum'),
+        leaking_junctions=('junction_id', 'nunique'),
+    )
+    return table.reset_index()
+
+def _reading_interval(interval):
+    """ Returns the time between consecutive readings as a numpy timedelta, `READING_INTERVAL` by default. """
+    return np.timedelta64(pd.Timedelta(READING_INTERVAL if interval is None else interval).to_timedelta64())
+
+def leak_runs(leaks, interval=None):
+    """
+    Finds the leak-duration runs: the stretches in which a junction leaked at consecutive readings.
+
+    Two leaks of a junction belong to the same run when their timestamps are `interval` apart.
+
+    Parameters:
+    - leaks (DataFrame): Leaks in the format of `leakage_frame`.
+    - interval (Timedelta, optional): Time between consecutive readings of the dataset, defaults to
+      `READING_INTERVAL`. It is not inferred from the leaks, whose timestamps can be further apart.
+
+    Returns:
+    - DataFrame: One row per run with the junction id, the first and last leaking timestamp, the number of
+      leaking readings, the duration in hours, the total leakage and the peak percentage of the run, sorted
+      by junction id and start.
+    """
+    columns = ['junction_id', 'start', 'end', 'readings', 'duration_hours', 'total_leakage', 'max_percentage']
+    if not len(leaks):
+        return pd.DataFrame(columns=columns)
+
+    moments = _parse_timestamps(leaks['timestamp'])
+    interval = _reading_interval(interval)
+
+    junctions = leaks['junction_id'].to_numpy()
+    order = np.lexsort((moments, junctions))
+    junctions = junctions[order]
+    moments = moments[order]
+
+    # A run starts at the first leak of a junction and wherever the previous leak is more than one reading back
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (junctions[1:] != junctions[:-1]) | (moments[1:] - moments[:-1] != interval)
+    run_ids = np.cumsum(starts) - 1
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(order)) - 1
+
+    amounts = leaks['leakage_amount'].to_numpy(dtype=np.float64)[order]
+    percentages = leaks['leakage_percentage'].to_numpy(dtype=np.float64)[order]
+    max_percentage = np.full(len(first), -np.inf)
+    np.maximum.at(max_percentage, run_ids, percentages)
+
+    timestamps = np.asarray(leaks['timestamp'], dtype=object)[order]
+    readings = last - first + 1
+    return pd.DataFrame({
+        'junction_id': junctions[first],
+        'start': timestamps[first],
+        'end': timestamps[last],
+        'readings': readings,
+        'duration_hours': (moments[last] - moments[first] + interval) / np.timedelta64(1, 'h'),
+        'total_leakage': np.bincount(run_ids, weights=amounts),
+        'max_percentage': max_percentage,
+    }, columns=columns)
+
+def build_leak_report(leaks, top_k=10, interval=None):
+    """
+    Builds all report tables from a leak DataFrame.
+
+    Parameters:
+    - leaks (DataFrame): Leaks in the format of `leakage_frame`.
+    - top_k (int): Number of junctions in the top junctions table.
+    - interval (Timedelta, optional): Time between consecutive readings, see `leak_runs`.
+
+    Returns:
+    - Dict[str, DataFrame]: The report tables, keyed by the names in `REPORT_TABLES`.
+    """
+    with stage('report.rollup') as metrics:
+        by_junction = junction_rollup_table(leaks)
+        report = {
+            'leaks': leaks,
+            'by_junction': by_junction,
+            'by_day': daily_rollup_table(leaks),
+            'top_junctions': by_junction.nlargest(top_k, 'total_leakage').reset_index(drop=True),
+            'runs': leak_runs(leaks, interval),
+        }
+        metrics.add(rows=len(leaks), groups=len(by_junction))
+    return report
+
+def _check_formats(formats):
+    """ Raises if a report format is unknown or its writer is not installed. """
+    unknown = sorted(set(formats) - set(FORMATS))
+    if unknown:
+        raise ValueError(f"Unknown report format(s): {', '.join(unknown)}")
+    if 'parquet' in formats and not any(importlib.util.find_spec(engine) for engine in ('pyarrow', 'fastparquet')):
+        raise ImportError("Parquet output requires the pyarrow or fastparquet package.")
+
+def write_leak_report(report, output_dir='outputs', formats=('csv',), prefix='leak_report'):
+    """
+    Writes every report table to one file per format, named `<prefix>_<table>.<format>`.
+
+    Parameters:
+    - report (Dict[str, DataFrame]): Report tables as returned by `build_leak_report`.
+    - output_dir (str): Directory in which the files are saved.
+    - formats (Sequence[str]): Any of 'csv', 'jsonl' and 'parquet'. Parquet needs pyarrow or fastparquet.
+    - prefix (str): Prefix of the file names.
+
+    Returns:
+    - List[str]: Paths of the written files.
+    """
+    _check_formats(formats)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    with stage('report.write') as metrics:
+        for name, table in report.items():
+            for output_format in formats:
+                path = os.path.join(output_dir, f"{prefix}_{name}.{output_format}")
+                if output_format == 'csv':
+                    _write_csv(table, path)
+                elif output_format == 'jsonl':
+                    table.to_json(path, orient='records', lines=True, double_precision=15)
+                else:
+                    table.to_parquet(path, index=False)
+                paths.append(path)
+            metrics.add(rows=len(table))
+    return paths
+
+def _append_leaks(leaks, path, output_format, parquet_writers, first):
+    """ Writes a block of leaks to a leaks table file, creating the file with the first block. """
+    if output_format == 'csv':
+        _write_csv(leaks, path, mode='w' if first else 'a')
+    elif output_format == 'jsonl':
+        leaks.to_json(path, orient='records', lines=True, double_precision=15, mode='w' if first else 'a')
+    elif importlib.util.find_spec('pyarrow'):
+        import pyarrow
+        import pyarrow.parquet
+        # Every block becomes a row group of one file
+        table = pyarrow.Table.from_pandas(leaks, preserve_index=False)
+        if first:
+            parquet_writers[path] = pyarrow.parquet.ParquetWriter(path, table.schema)
+        parquet_writers[path].write_table(table)
+    else:
+        leaks.to_parquet(path, index=False, engine='fastparquet', append=not first)
+
+def _junction_totals(leaks):
+    """ Sums the leaks of every junction, with the percentage sum from which the mean is derived. """
+    return leaks.groupby('junction_id', sort=True, observed=True).agg(
+        path_to_master=('path_to_master', 'first'),
+        leak_count=('leakage_amount', 'size'),
+        total_leakage=('leakage_amount', 'sum'),
+        percentage_sum=('leakage_percentage', 'sum'),
+        max_percentage=('leakage_percentage', 'max'),
+        first_leak=('timestamp', 'min'),
+        last_leak=('timestamp', 'max'),
+    )
+
+# How the junction totals of two blocks of leaks are combined
+_JUNCTION_TOTALS_MERGE = {
+    'path_to_master': 'first',
+    'leak_count': 'sum',
+    'total_leakage': 'sum',
+    'percentage_sum': 'sum',
+    'max_percentage': 'max',
+    'first_leak': 'min',
+    'last_leak': 'max',
+}
+
+def _merge_runs(runs, interval):
+    """ Merges the runs of a junction that continue one another, like a run split between two blocks of leaks. """
+    starts = _parse_timestamps(runs['start'])
+    ends = _parse_timestamps(runs['end'])
+    junctions = runs['junction_id'].to_numpy()
+    order = np.lexsort((starts, junctions))
+    runs = runs.iloc[order].reset_index(drop=True)
+    junctions, starts, ends = junctions[order], starts[order], ends[order]
+
+    continued = np.zeros(len(runs), dtype=bool)
+    continued[1:] = (junctions[1:] == junctions[:-1]) & (starts[1:] - ends[:-1] == interval)
+    grouped = runs.groupby(np.cumsum(~continued), sort=True)
+    return grouped.agg(
+        junction_id=('junction_id', 'first'),
+        start=('start', 'first'),
+        end=('end', 'last'),
+        readings=('readings', 'sum'),
+        duration_hours=('duration_hours', 'sum'),
+        total_leakage=('total_leakage', 'sum'),
+        max_percentage=('max_percentage', 'max'),
+    ).reset_index(drop=True)
+
+def stream_leak_report(frames, output_dir='outputs', formats=('csv',), prefix='leak_report', top_k=10, interval=None):
+    """
+    Builds and writes the report of leaks that arrive in blocks, without holding all of them in memory.
+
+    Every block is appended to the leaks table files as it arrives, and only the per-junction and per-day
+    totals and the runs are kept and merged from block to block. The blocks must be in timestamp order,
+    like those of `leakage_detection.iter_leakage_frames`, so that a day or a run continued by the next
+    block is always the last one kept. Totals are summed block by block, so they can differ from those of
+    `build_leak_report` in the last digits; the total leakage amount is the same to the last bit.
+
+    Parameters:
+    - frames (Iterable[DataFrame]): Blocks of leaks in the format of `leakage_frame`.
+    - output_dir (str): Directory in which the files are saved.
+    - formats (Sequence[str]): Any of 'csv', 'jsonl' and 'parquet'. Parquet needs pyarrow or fastparquet.
+    - prefix (str): Prefix of the file names.
+    - top_k (int): Number of junctions in the top junctions table.
+    - interval (Timedelta, optional): Time between consecutive readings, see `leak_runs`.
+
+    Returns:
+    - Tuple[Dict[str, DataFrame], float, List[str]]: The report tables other than the leaks, the total
+      leakage amount and the paths of the written files.
+    """
+    _check_formats(formats)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = [os.path.join(output_dir, f"{prefix}_leaks.{output_format}") for output_format in formats]
+    interval = _reading_interval(interval)
+
+    total_leakage = 0
+    template = None
+    parquet_writers = {}
+    junction_totals = None
+    day_tables = []
+    # Junctions leaking on the last day seen, which the next block can continue
+    open_day_junctions = set()
+    closed_runs = []
+    open_runs = None
+    try:
+        for leaks in frames:
+            if template is None:
+                template = leaks.iloc[:0]
+            if not len(leaks):
+                continue
+
+            with stage('report.write') as metrics:
+                for path, output_format in zip(paths, formats):
+                    _append_leaks(leaks, path, output_format, parquet_writers, first=junction_totals is None)
+                metrics.add(rows=len(leaks))
+
+            with stage('report.rollup') as metrics:
+                # Accumulate in record order, like `leakage_frame`, so the total is the same to the last bit
+                total_leakage = sum(leaks['leakage_amount'].tolist(), total_leakage)
+
+                totals = _junction_totals(leaks)
+                if junction_totals is not None:
+                    totals = pd.concat([junction_totals, totals]).groupby(level=0, sort=True).agg(_JUNCTION_TOTALS_MERGE)
+                junction_totals = totals
+
+                days = _leak_days(leaks)
+                junction_ids = leaks['junction_id'].to_numpy()
+                table = daily_rollup_table(leaks)
+                first_day, last_day = table['date'].iat[0], table['date'].iat[-1]
+                continued = bool(day_tables) and day_tables[-1]['date'].iat[-1] == first_day
+                if continued:
+                    previous = day_tables.pop()
+                    open_day_junctions |= set(junction_ids[days == first_day].tolist())
+                    table.loc[0, 'leak_count'] += previous['leak_count'].iat[-1]
+                    table.loc[0, 'total_leakage'] += previous['total_leakage'].iat[-1]
+                    table.loc[0, 'leaking_junctions'] = len(open_day_junctions)
+                    day_tables.append(previous.iloc[:-1])
+                if not continued or first_day != last_day:
+                    open_day_junctions = set(junction_ids[days == last_day].tolist())
+                day_tables.append(table)
+
+                # Only the last run of a junction can be continued by the next block
+                runs = leak_runs(leaks, interval)
+                if open_runs is not None:
+                    runs = _merge_runs(pd.concat([open_runs, runs], ignore_index=True), interval)
+                last = ~runs['junction_id'].duplicated(keep='last').to_numpy()
+                closed_runs.append(runs[~last])
+                open_runs = runs[last]
+                metrics.add(rows=len(leaks), groups=len(junction_totals))
+    finally:
+        for writer in parquet_writers.values():
+            writer.close()
+
+    if template is None:
+        template = pd.DataFrame(columns=['timestamp', 'junction_id', 'leakage_amount', 'leakage_percentage', 'path_to_master'])
+    if junction_totals is None:
+        # No leaks at all: the tables have no rows, as those of `build_leak_report`
+        report = build_leak_report(template, top_k, interval)
+        del report['leaks']
+        with stage('report.write'):
+            for path, output_format in zip(paths, formats):
+                _append_leaks(template, path, output_format, parquet_writers, first=True)
+            for writer in parquet_writers.values():
+                writer.close()
+    else:
+        by_junction = junction_totals.assign(
+            mean_percentage=junction_totals['percentage_sum'] / junction_totals['leak_count'],
+        )[['path_to_master', 'leak_count', 'total_leakage', 'mean_percentage', 'max_percentage', 'first_leak', 'last_leak']]
+        by_junction = by_junction.reset_index()
+        runs = pd.concat(closed_runs + [open_runs], ignore_index=True)
+        report = {
+            'by_junction': by_junction,
+            'by_day': pd.concat(day_tables, ignore_index=True),
+            'top_junctions': by_junction.nlargest(top_k, 'total_leakage').reset_index(drop=True),
+            'runs': _merge_runs(runs, interval),
+        }
+    paths += write_leak_report(report, output_dir, formats, prefix)
+    return report, total_leakage, paths
+
+def print_report_summary(report, total_leakage, paths=()):
+    """
+    Prints a concise summary of a leak report: counts, the worst junctions, the longest run and the total.
+
+    Parameters:
+    - report (Dict[str, DataFrame]): Report tables as returned by `build_leak_report` or `stream_leak_report`.
+    - total_leakage (float): The total leakage amount.
+    - paths (Sequence[str]): Paths of the written report files.
+    """
+    # The leaks table itself is not needed, a streamed report does not keep it
+    by_junction = report['by_junction']
+    print("Leakage Detection Report:")
+    print("-" * 30)
+    if len(by_junction):
+        print(f"Leaks: {by_junction['leak_count'].sum()} at {len(by_junction)} junctions on {len(report['by_day'])} days "
+              f"({by_junction['first_leak'].min()} to {by_junction['last_leak'].max()})")
+
+        top = report['top_junctions']
+        print(f"Top {len(top)} junctions by total leakage:")
+        for row in top.itertuples(index=False):
+            print(f"  {row.junction_id}: {row.total_leakage:.2f} units in {row.leak_count} leaks "
+                  f"(peak {row.max_percentage:.2f}%)")
+
+        runs = report['runs']
+        longest = runs.iloc[int(np.argmax(runs['readings'].to_numpy()))]
+        print(f"Longest leak run: junction {longest['junction_id']}, {longest['duration_hours']:g} hours "
+              f"from {longest['start']} to {longest['end']}")
+    else:
+        print("No leaks found.")
+    print("-" * 30)
+
+    if paths:
+        print(f"Report written to {len(paths)} files in {os.path.dirname(paths[0]) or '.'}")
+    print(f"Total Leakage in the System: {total_leakage:.2f} units")
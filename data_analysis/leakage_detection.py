@@ -4,34 +4,208 @@ leakage_detection.py
 This script analyzes a dataset from a water distribution network to detect and report potential leakages.
 It considers discrepancies in expected and actual water flows to identify the location and severity of leakages.
 
+Leakages are detected with a matrix engine: readings are pivoted into a timestamp x endpoint-path
+matrix once, multiplied by a sparse endpoint-to-junction incidence matrix derived from `path_to_master`,
+and every junction reading is then compared against its endpoint total in a single vectorized step.
+`detect_leakages_hierarchical` instead rolls the readings up the network tree, so that every junction is
+compared against its direct children and only reports its own leakage.
+
 Functions:
+- build_incidence_matrix: Builds the sparse endpoint-path x junction incidence matrix.
+- junction_endpoint_totals: Computes the connected endpoint usage of every junction at every timestamp.
 - detect_leakages: Identifies potential leakages and their details.
+- detect_leakages_loop: Reference per-timestamp, per-junction implementation of detect_leakages.
+- build_junction_tree: Derives the parent and depth of every sensor from the path_to_master tokens.
+- junction_rollup: Balances every junction against its direct children and its subtree, for all timestamps.
+- detect_leakages_hierarchical: Identifies the leakage of every junction relative to its direct children.
+- leakage_frame: Detects leakages and returns them as a DataFrame.
+- iter_timestamp_groups: Reads a dataset in chunks and yields blocks of complete timestamp groups.
+- detect_leakages_streaming: Detects leakages chunk by chunk with memory bounded by the chunk size.
+- iter_leakage_frames: Detects leakages chunk by chunk and yields them as DataFrames.
 - main: Entry point for running the leakage detection analysis.
 """
 
+import argparse
+import numpy as np
 import pandas as pd
+from scipy import sparse
+
+from data_analysis.leak_report import FORMATS, build_leak_report, print_report_summary, stream_leak_report, write_leak_report
+from data_generation.columnar_dataset import iter_dataset_chunks, read_dataset
+from data_generation.instrumentation import add_metrics_arguments, metrics_session, stage, timed_iter
+
+def build_incidence_matrix(endpoint_paths, junction_ids):
+    """
+    Builds the sparse incidence matrix linking endpoint paths to the junctions they are connected to.
+
+    An endpoint path is connected to a junction when the junction's sensor id occurs in the path string,
+    which is the same substring rule `detect_leakages_loop` applies with `str.contains`. Instead of scanning
+    every path once per junction, every substring of a path with the length of a junction id is looked up
+    in a dictionary, so the cost is linear in the total length of the unique paths.
+
+    Parameters:
+    - endpoint_paths (Sequence[str]): Unique `path_to_master` values of the endpoints.
+    - junction_ids (Sequence): Unique junction sensor ids.
+
+    Returns:
+    - scipy.sparse.csr_matrix: A (len(endpoint_paths) x len(junction_ids)) matrix of ones and zeros.
+    """
+    junction_index = {str(junction_id): column for column, junction_id in enumerate(junction_ids)}
+    id_lengths = sorted({len(key) for key in junction_index})
+
+    rows = []
+    columns = []
+    for row, path in enumerate(endpoint_paths):
+        path = str(path)
+        matched = set()
+        for length in id_lengths:
+            for start in range(len(path) - length + 1):
+                column = junction_index.get(path[start:start + length])
+                if column is not None:
+                    matched.add(column)
+        rows.extend([row] * len(matched))
+        columns.extend(matched)
+
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, columns)),
+        shape=(len(endpoint_paths), len(junction_index))
+    )
+
+def junction_endpoint_totals(data):
+    """
+    Computes, for every timestamp and junction, the total usage of the endpoints connected to the junction.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information.
+
+    Returns:
+    - Tuple[ndarray, Index, Index, ndarray]: The (timestamps x junctions) endpoint totals, the sorted unique
+      timestamps, the unique junction ids, and the timestamp code of every row of `data` (-1 for rows without
+      a timestamp).
+    """
+    timestamp_codes, timestamps = pd.factorize(data['timestamp'], sort=True)
+    is_junction = (data['type'] == 'Junction').to_numpy()
+    is_endpoint = (data['type'] == 'Endpoint').to_numpy()
+    has_timestamp = timestamp_codes >= 0
+
+    junction_ids = pd.unique(data['sensor_id'].to_numpy()[is_junction & has_timestamp])
+
+    endpoint_rows = is_endpoint & has_timestamp
+    path_codes, endpoint_paths = pd.factorize(data['path_to_master'].to_numpy()[endpoint_rows])
+    endpoint_usage = data['water_usage'].to_numpy(dtype=np.float64, na_value=np.nan)[endpoint_rows]
+    valid = path_codes >= 0
+    endpoint_usage = np.nan_to_num(endpoint_usage[valid], nan=0.0)
+
+    # Pivot the endpoint readings into a timestamp x endpoint-path matrix; duplicate cells are summed
+    usage_matrix = sparse.csr_matrix(
+        (endpoint_usage, (timestamp_codes[endpoint_rows][valid], path_codes[valid])),
+        shape=(len(timestamps), len(endpoint_paths))
+    )
+    with stage('detect.incidence') as metrics:
+        incidence = build_incidence_matrix(endpoint_paths, junction_ids)
+        metrics.add(rows=len(endpoint_paths))
+    totals = np.asarray((usage_matrix @ incidence).todense())
+
+    return totals, timestamps, pd.Index(junction_ids), timestamp_codes
+
+def _leak_columns(data):
+    """ Compares every junction reading against its connected endpoint total and returns the leak columns. """
+    with stage('detect.aggregate') as metrics:
+        totals, timestamps, junction_ids, timestamp_codes = junction_endpoint_totals(data)
+        metrics.add(rows=len(data), groups=len(timestamps))
+
+    with stage('detect.compare') as metrics:
+        # Junction rows in the order the per-timestamp groups visit them
+        junction_rows = np.flatnonzero((data['type'] == 'Junction').to_numpy() & (timestamp_codes >= 0))
+        junction_rows = junction_rows[np.argsort(timestamp_codes[junction_rows], kind='stable')]
+
+        row_timestamps = timestamp_codes[junction_rows]
+        row_junctions = junction_ids.get_indexer(data['sensor_id'].to_numpy()[junction_rows])
+        junction_outflow = data['water_usage'].to_numpy(dtype=np.float64, na_value=np.nan)[junction_rows]
+        total_usage_endpoints = totals[row_timestamps, row_junctions]
+
+        leaking = junction_outflow > total_usage_endpoints
+        leakage_amounts = junction_outflow[leaking] - total_usage_endpoints[leaking]
+        leakage_percentages = (leakage_amounts / junction_outflow[leaking]) * 100
+
+        leaking_rows = junction_rows[leaking]
+        metrics.add(rows=len(junction_rows), leaks=len(leaking_rows))
+
+        return {
+            'timestamp': timestamps[row_timestamps[leaking]],
+            'junction_id': data['sensor_id'].iloc[leaking_rows],
+            'leakage_amount': leakage_amounts,
+            'leakage_percentage': leakage_percentages,
+            'path_to_master': data['path_to_master'].iloc[leaking_rows],
+        }
+
+def _leak_records(columns):
+    """ Converts leak columns into the list of leak records and the total leakage amount. """
+    names = list(columns)
+    values = [columns[name].tolist() if isinstance(columns[name], pd.Series) else columns[name] for name in names]
+
+    leakages = []
+    total_leakage_amount = 0
+    for row in zip(*values):
+        leak = dict(zip(names, row))
+        total_leakage_amount += leak['leakage_amount']
+        # groupby(['timestamp']) keys are one-element tuples, keep the same shape for callers
+        leak['timestamp'] = (leak['timestamp'],)
+        leakages.append(leak)
+
+    return leakages, total_leakage_amount
+
+def _leak_frame(columns):
+    """ Converts leak columns into a leak DataFrame and the total leakage amount. """
+    frame = pd.DataFrame({
+        name: column.to_numpy() if isinstance(column, (pd.Series, pd.Index)) else column
+        for name, column in columns.items()
+    })
+    # Accumulate in record order, like the report loop, so the total is the same to the last bit
+    total_leakage_amount = sum(columns['leakage_amount'].tolist(), 0)
+    return frame, total_leakage_amount
 
 def detect_leakages(data):
     """
     Detects leakages in the network based on discrepancies in water flows.
 
+    Produces the same leak records, in the same order, as `detect_leakages_loop`.
+
     Parameters:
     - data (DataFrame): The dataset containing water flow information.
 
     Returns:
     - List[Dict]: A list of dictionaries containing leakage information.
+    - float: The total leakage amount.
+    """
+    return _leak_records(_leak_columns(data))
+
+def detect_leakages_loop(data):
+    """
+    Detects leakages by scanning every junction of every timestamp group.
+
+    This is the original implementation of `detect_leakages`; it is kept as a reference for the matrix engine.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information.
+
+    Returns:
+    - List[Dict]: A list of dictionaries containing leakage information.
+    - float: The total leakage amount.
     """
     leakages = []
     total_leakage_amount = 0
     grouped_data = data.groupby(['timestamp'])
 
-    for timestamp, group in grouped_data:
+    for timestamp, group in timed_iter('detect_loop.groupby', grouped_data, rows=lambda item: len(item[1])):
         junctions = group[group['type'] == 'Junction']
         endpoints = group[group['type'] == 'Endpoint']
 
         for _, junction in junctions.iterrows():
             junction_outflow = junction['water_usage']
-            connected_endpoints = endpoints[endpoints['path_to_master'].str.contains(str(junction['sensor_id']))]
+            with stage('detect_loop.contains') as metrics:
+                connected_endpoints = endpoints[endpoints['path_to_master'].str.contains(str(junction['sensor_id']))]
+                metrics.add(rows=len(endpoints))
             total_usage_endpoints = connected_endpoints['water_usage'].sum()
 
             if junction_outflow > total_usage_endpoints:
@@ -48,25 +222,322 @@ def detect_leakages(data):
 
     return leakages, total_leakage_amount
 
-def main():
+def build_junction_tree(sensor_ids, paths):
     """
-    Main function to execute leakage detection.
+    Derives the network tree from the `path_to_master` values of the sensors.
+
+    Paths are split into their '->' separated sensor ids, so a junction only ever matches its exact id
+    (1001 is not mistaken for part of 10010). The parent of a sensor is the id before it on its path.
+
+    Parameters:
+    - sensor_ids (Sequence): Unique sensor ids.
+    - paths (Sequence[str]): The `path_to_master` of every sensor.
+
+    Returns:
+    - Tuple[ndarray, ndarray]: The index of every sensor's parent in `sensor_ids` (-1 for the master
+      junction or a parent without readings) and every sensor's depth below the master junction.
     """
-    # Load the dataset
-    file_path = 'datasets/water_distribution_data_leak.csv'
-    data = pd.read_csv(file_path)
+    sensor_index = {str(sensor_id): node for node, sensor_id in enumerate(sensor_ids)}
+    parents = np.full(len(sensor_ids), -1, dtype=np.int64)
+    depths = np.zeros(len(sensor_ids), dtype=np.int64)
+    for node, path in enumerate(paths):
+        tokens = [token.strip() for token in str(path).split('->')]
+        depths[node] = len(tokens) - 1
+        if len(tokens) > 1:
+            parents[node] = sensor_index.get(tokens[-2], -1)
+    return parents, depths
+
+def junction_rollup(data):
+    """
+    Balances every junction against its direct children and its whole subtree, for all timestamps at once.
+
+    The readings are pivoted into a sparse timestamp x sensor matrix and multiplied by the sparse
+    child-to-parent matrix of the tree, which gives the inflow each junction passes on to its direct
+    children. The endpoint usage below every junction is then accumulated level by level, bottom-up,
+    so the whole rollup costs O(rows + timestamps x junctions) for a tree of any depth.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information.
+
+    Returns:
+    - Dict: The sorted unique `timestamps`, the `junction_ids` (Index), the (timestamps x junctions)
+      `children_usage` (sum of the readings of the direct children) and `subtree_usage` (sum of the
+      endpoint readings in the junction's subtree), and the `timestamp_codes` of the rows of `data`.
+    """
+    timestamp_codes, timestamps = pd.factorize(data['timestamp'], sort=True)
+    sensor_codes, sensor_ids = pd.factorize(data['sensor_id'])
+    usage = np.nan_to_num(data['water_usage'].to_numpy(dtype=np.float64, na_value=np.nan), nan=0.0)
+    valid = (timestamp_codes >= 0) & (sensor_codes >= 0)
+
+    # Path and kind of every sensor, taken from its first row
+    codes, first_rows = np.unique(sensor_codes, return_index=True)
+    first_rows = first_rows[codes >= 0]
+    paths = data['path_to_master'].to_numpy()[first_rows]
+    is_junction = (data['type'].to_numpy()[first_rows] == 'Junction')
+    parents, depths = build_junction_tree(sensor_ids, paths)
+
+    junction_nodes = np.flatnonzero(is_junction)
+    junction_columns = np.full(len(sensor_ids), -1, dtype=np.int64)
+    junction_columns[junction_nodes] = np.arange(len(junction_nodes))
+
+    # Child-to-parent matrix over the sensors whose parent is a junction with readings
+    parent_columns = np.where(parents >= 0, junction_columns[parents], -1)
+    has_parent = np.flatnonzero(parent_columns >= 0)
+    child_to_parent = sparse.csr_matrix(
+        (np.ones(len(has_parent)), (has_parent, parent_columns[has_parent])),
+        shape=(len(sensor_ids), len(junction_nodes))
+    )
+    readings = sparse.csr_matrix(
+        (usage[valid], (timestamp_codes[valid], sensor_codes[valid])),
+        shape=(len(timestamps), len(sensor_ids))
+    )
+    children_usage = np.asarray((readings @ child_to_parent).todense())
+
+    # Endpoint usage of the direct children, then every junction's subtree added to its parent, deepest level first
+    endpoint_to_parent = sparse.diags((~is_junction).astype(np.float64)) @ child_to_parent
+    subtree_usage = np.asarray((readings @ endpoint_to_parent).todense())
+    child_junctions = junction_nodes[parent_columns[junction_nodes] >= 0]
+    for depth in np.unique(depths[child_junctions])[::-1]:
+        level = child_junctions[depths[child_junctions] == depth]
+        np.add.at(subtree_usage.T, parent_columns[level], subtree_usage[:, junction_columns[level]].T)
+
+    return {
+        'timestamps': timestamps,
+        'junction_ids': pd.Index(sensor_ids[junction_nodes]),
+        'children_usage': children_usage,
+        'subtree_usage': subtree_usage,
+        'timestamp_codes': timestamp_codes,
+    }
+
+def _hierarchical_leak_columns(data):
+    """ Compares every junction reading against its direct children and returns the leak columns. """
+    with stage('detect.rollup') as metrics:
+        rollup = junction_rollup(data)
+        metrics.add(rows=len(data), groups=len(rollup['timestamps']))
+    timestamp_codes = rollup['timestamp_codes']
 
-    # Detect leakages
-    leakage_info, total_leakage = detect_leakages(data)
+    with stage('detect.compare') as metrics:
+        # Junction rows in the order the per-timestamp groups visit them
+        junction_rows = np.flatnonzero((data['type'] == 'Junction').to_numpy() & (timestamp_codes >= 0))
+        junction_rows = junction_rows[np.argsort(timestamp_codes[junction_rows], kind='stable')]
 
-    # Print the results
-    print("Leakage Detection Report:")
+        row_timestamps = timestamp_codes[junction_rows]
+        row_junctions = rollup['junction_ids'].get_indexer(data['sensor_id'].to_numpy()[junction_rows])
+        junction_outflow = data['water_usage'].to_numpy(dtype=np.float64, na_value=np.nan)[junction_rows]
+        children_usage = rollup['children_usage'][row_timestamps, row_junctions]
+        subtree_usage = rollup['subtree_usage'][row_timestamps, row_junctions]
+
+        leaking = junction_outflow > children_usage
+        leakage_amounts = junction_outflow[leaking] - children_usage[leaking]
+        leakage_percentages = (leakage_amounts / junction_outflow[leaking]) * 100
+        subtree_leakage_amounts = junction_outflow[leaking] - subtree_usage[leaking]
+
+        leaking_rows = junction_rows[leaking]
+        metrics.add(rows=len(junction_rows), leaks=len(leaking_rows))
+
+        return {
+            'timestamp': rollup['timestamps'][row_timestamps[leaking]],
+            'junction_id': data['sensor_id'].iloc[leaking_rows],
+            'leakage_amount': leakage_amounts,
+            'leakage_percentage': leakage_percentages,
+            'path_to_master': data['path_to_master'].iloc[leaking_rows],
+            'subtree_leakage_amount': subtree_leakage_amounts,
+        }
+
+def detect_leakages_hierarchical(data):
+    """
+    Detects leakages with a bottom-up mass balance over the network tree.
+
+    Every junction reading is compared against the sum of the readings of its direct children, junctions
+    and endpoints alike, so each junction only reports the water lost between itself and its children;
+    the master junction is compared against the local junctions rather than against every endpoint.
+    The leak records have the format of `detect_leakages`, with the leak of the junction's whole subtree
+    (its reading minus the endpoint usage below it) added as `subtree_leakage_amount`.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information.
+
+    Returns:
+    - List[Dict]: A list of dictionaries containing leakage information.
+    - float: The total leakage amount, the sum of the junctions' own leaks.
+    """
+    return _leak_records(_hierarchical_leak_columns(data))
+
+def leakage_frame(data, hierarchical=False):
+    """
+    Detects leakages like `detect_leakages`, but returns the leaks as one DataFrame instead of a list of records.
+
+    Building the columns directly avoids creating a dictionary per leak, which dominates on large datasets.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information.
+    - hierarchical (bool): Balance every junction against its direct children, like `detect_leakages_hierarchical`.
+
+    Returns:
+    - DataFrame: One row per leak, with the columns of the leak records and plain timestamp strings.
+    - float: The total leakage amount.
+    """
+    return _leak_frame(_hierarchical_leak_columns(data) if hierarchical else _leak_columns(data))
+
+def iter_timestamp_groups(file_path, chunksize):
+    """
+    Reads a CSV or columnar dataset in chunks and yields DataFrames that only contain complete timestamp groups.
+
+    The rows of the trailing timestamp of every chunk are carried over and prepended to the next chunk,
+    so a group split across a chunk boundary is always processed as a whole. The dataset is expected to
+    keep the rows of a timestamp contiguous, as the data makers write them.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - chunksize (int): Number of rows read per chunk.
+
+    Yields:
+    - DataFrame: A block of rows made of whole timestamp groups.
+    """
+    carry = None
+    for chunk in iter_dataset_chunks(file_path, chunksize):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+
+        timestamps = chunk['timestamp'].to_numpy()
+        changes = np.flatnonzero(timestamps[1:] != timestamps[:-1]) + 1
+        trailing_start = changes[-1] if len(changes) else 0
+
+        carry = chunk.iloc[trailing_start:]
+        if trailing_start:
+            yield chunk.iloc[:trailing_start]
+
+    if carry is not None and len(carry):
+        yield carry
+
+def detect_leakages_streaming(file_path, chunksize=100000, hierarchical=False):
+    """
+    Detects leakages in a dataset that is read in chunks, yielding leak records as soon as they are found.
+
+    Each block of complete timestamp groups is analyzed with `detect_leakages`, so peak memory depends on
+    the chunk size rather than on the size of the file.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - chunksize (int): Number of rows read per chunk.
+    - hierarchical (bool): Balance every junction against its direct children with `detect_leakages_hierarchical`.
+
+    Yields:
+    - Dict: Leakage information, in the same format as the records returned by `detect_leakages`.
+    """
+    for block in timed_iter('load', iter_timestamp_groups(file_path, chunksize)):
+        with stage('detect') as metrics:
+            leakages, _ = detect_leakages_hierarchical(block) if hierarchical else detect_leakages(block)
+            metrics.add(rows=len(block), leaks=len(leakages))
+        yield from leakages
+
+def iter_leakage_frames(file_path, chunksize=100000, hierarchical=False):
+    """
+    Detects leakages in a dataset that is read in chunks, yielding the leaks of every block as a DataFrame.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - chunksize (int): Number of rows read per chunk.
+    - hierarchical (bool): Balance every junction against its direct children with `detect_leakages_hierarchical`.
+
+    Yields:
+    - DataFrame: The leaks of a block of complete timestamp groups, in the format of `leakage_frame`.
+    """
+    for block in timed_iter('load', iter_timestamp_groups(file_path, chunksize)):
+        with stage('detect') as metrics:
+            leaks, _ = leakage_frame(block, hierarchical=hierarchical)
+            metrics.add(rows=len(block), leaks=len(leaks))
+        yield leaks
+
+def print_leak(leak):
+    """
+    Prints a single leak record of the leakage detection report.
+
+    Parameters:
+    - leak (Dict): Leakage information as returned by `detect_leakages`.
+    """
+    print(f"Timestamp: {leak['timestamp']}\nJunction ID: {leak['junction_id']}\nLeakage: {leak['leakage_amount']} units ({leak['leakage_percentage']:.2f}%)\nPath to Master: {leak['path_to_master']}")
     print("-" * 30)
-    for leak in leakage_info:
-        print(f"Timestamp: {leak['timestamp']}\nJunction ID: {leak['junction_id']}\nLeakage: {leak['leakage_amount']} units ({leak['leakage_percentage']:.2f}%)\nPath to Master: {leak['path_to_master']}")
-        print("-" * 30)
 
-    print(f"Total Leakage in the System: {total_leakage:.2f} units")
+def _print_leaks(leaks):
+    """ Prints every leak of a leak DataFrame with `print_leak`. """
+    for leak in leaks.to_dict('records'):
+        leak['timestamp'] = (leak['timestamp'],)
+        print_leak(leak)
+
+def _printed_leaks(frames):
+    """ Prints the leaks of every block of leaks before passing the block on. """
+    for leaks in frames:
+        _print_leaks(leaks)
+        yield leaks
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments of the leakage detection script.
+
+    Parameters:
+    - argv (List[str], optional): Arguments to parse, defaults to `sys.argv[1:]`.
+
+    Returns:
+    - Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Detect leakages in a water distribution dataset.")
+    parser.add_argument('file_path', nargs='?', default='datasets/water_distribution_data_leak.csv',
+                        help="Path to the CSV dataset file or columnar dataset directory.")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Stream the dataset in chunks of this many rows instead of loading it at once.")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Parse the CSV dataset without reading or writing its binary sidecar cache.")
+    parser.add_argument('--hierarchical', action='store_true',
+                        help="Balance every junction against its direct children instead of all endpoints on its path.")
+    parser.add_argument('--output-dir', default='outputs', help="Directory in which the report tables are saved.")
+    parser.add_argument('--format', dest='formats', nargs='+', choices=FORMATS, default=['csv'],
+                        help="Output formats of the report tables (Parquet needs pyarrow or fastparquet).")
+    parser.add_argument('--top-k', type=int, default=10, help="Number of junctions in the top junctions table.")
+    parser.add_argument('--print-leaks', action='store_true',
+                        help="Also print every leak record before the summary.")
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Main function to execute leakage detection.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    args = parse_args(argv)
+
+    with metrics_session(args, 'leakage_detection'):
+        if args.chunksize:
+            # Stream the dataset and write the leaks of every block as it is detected
+            frames = iter_leakage_frames(args.file_path, args.chunksize, hierarchical=args.hierarchical)
+            if args.print_leaks:
+                frames = _printed_leaks(frames)
+            report, total_leakage, paths = stream_leak_report(frames, args.output_dir, args.formats, top_k=args.top_k)
+            with stage('report') as metrics:
+                print_report_summary(report, total_leakage, paths)
+                metrics.add(leaks=int(report['by_junction']['leak_count'].sum()))
+            return
+
+        # Load the dataset
+        with stage('load') as metrics:
+            data = read_dataset(args.file_path, cache=args.use_cache)
+            metrics.add(rows=len(data))
+
+        # Detect leakages
+        with stage('detect') as metrics:
+            leaks, total_leakage = leakage_frame(data, hierarchical=args.hierarchical)
+            metrics.add(rows=len(data), leaks=len(leaks))
+
+        # Write the report tables in bulk and print a summary
+        report = build_leak_report(leaks, top_k=args.top_k)
+        paths = write_leak_report(report, args.output_dir, args.formats)
+        with stage('report') as metrics:
+            if args.print_leaks:
+                _print_leaks(leaks)
+            print_report_summary(report, total_leakage, paths)
+            metrics.add(leaks=len(leaks))
 
 if __name__ == "__main__":
     main()
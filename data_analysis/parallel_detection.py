@@ -0,0 +1,163 @@
+"""
+parallel_detection.py
+
+This script detects leakages on several CPU cores. The timestamp groups of a dataset are independent, so the
+CSV file is split into contiguous byte ranges that each hold whole timestamp groups, and every range is
+analyzed by a worker of a process pool. Workers read and parse their byte range of the file themselves, so
+only the range bounds are sent to them and only their leaks are sent back.
+
+The shard results are merged in timestamp order and the total leakage is accumulated over the merged leaks in
+that order, so the output is identical to that of the serial `leakage_detection.leakage_frame`.
+
+Functions:
+- shard_byte_ranges: Splits a CSV dataset into byte ranges of whole timestamp groups.
+- detect_shard: Detects the leakages of one byte range of a CSV dataset.
+- leakage_frame_parallel: Detects the leakages of a CSV dataset with a process pool.
+- main: Entry point for running the parallel leakage detection.
+"""
+
+import argparse
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from data_analysis.leak_report import FORMATS, build_leak_report, print_report_summary, write_leak_report
+from data_analysis.leakage_detection import leakage_frame
+from data_generation.columnar_dataset import CSV_DTYPES, is_columnar_dataset
+from data_generation.instrumentation import add_metrics_arguments, metrics_session, stage
+
+def _next_group_start(file):
+    """ Reads whole lines from the current position of a file up to the start of the next timestamp group. """
+    position = file.tell()
+    line = file.readline()
+    timestamp = line.split(b',', 1)[0]
+    while line and line.split(b',', 1)[0] == timestamp:
+        position = file.tell()
+        line = file.readline()
+    return position
+
+def shard_byte_ranges(file_path, shards):
+    """
+    Splits a CSV dataset into contiguous byte ranges of nearly equal size that each hold whole timestamp groups.
+
+    Every range ends at the start of the first line whose timestamp differs from that of the line around its
+    target size. The dataset is expected to keep the rows of a timestamp contiguous, as the data makers write them.
+
+    Parameters:
+    - file_path (str): Path to the CSV dataset file.
+    - shards (int): Number of ranges to aim for; large timestamp groups can make them fewer.
+
+    Returns:
+    - bytes: The header line of the file.
+    - List[Tuple[int, int]]: The (start, end) byte offsets of every non-empty range, in file order.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        header = file.readline()
+        bounds = [file.tell()]
+        for shard in range(1, shards):
+            target = bounds[0] + (size - bounds[0]) * shard // shards
+            if target <= bounds[-1]:
+                continue
+            # Move to the start of the first line at or after the target, then past its timestamp group
+            file.seek(target - 1)
+            file.readline()
+            boundary = _next_group_start(file)
+            if bounds[-1] < boundary < size:
+                bounds.append(boundary)
+        bounds.append(size)
+    return header, [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def detect_shard(file_path, header, start, end, hierarchical=False):
+    """
+    Reads, parses and analyzes one byte range of a CSV dataset.
+
+    Parameters:
+    - file_path (str): Path to the CSV dataset file.
+    - header (bytes): The header line of the file.
+    - start (int): Offset of the first byte of the range.
+    - end (int): Offset after the last byte of the range.
+    - hierarchical (bool): Balance every junction against its direct children with `detect_leakages_hierarchical`.
+
+    Returns:
+    - DataFrame: The leaks of the range, in the format of `leakage_frame`.
+    """
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    block = pd.read_csv(io.BytesIO(header + data), dtype=CSV_DTYPES)
+    leaks, _ = leakage_frame(block, hierarchical=hierarchical)
+    return leaks
+
+def leakage_frame_parallel(file_path, workers=None, shards=None, hierarchical=False):
+    """
+    Detects the leakages of a CSV dataset with a process pool, one contiguous timestamp range per task.
+
+    Parameters:
+    - file_path (str): Path to the CSV dataset file.
+    - workers (int, optional): Number of worker processes, defaults to the number of CPUs.
+    - shards (int, optional): Number of byte ranges, defaults to four per worker so that the workers stay busy.
+    - hierarchical (bool): Balance every junction against its direct children with `detect_leakages_hierarchical`.
+
+    Returns:
+    - DataFrame: One row per leak, identical to the leaks `leakage_frame` finds in the whole dataset.
+    - float: The total leakage amount.
+    """
+    if is_columnar_dataset(file_path):
+        raise ValueError("Parallel detection reads byte ranges of a CSV dataset, not a columnar dataset.")
+    workers = workers or os.cpu_count() or 1
+    header, ranges = shard_byte_ranges(file_path, shards or 4 * workers)
+    # A dataset without readings still gets one (empty) range, for a leak frame with the right columns
+    ranges = ranges or [(len(header), len(header))]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(detect_shard, file_path, header, start, end, hierarchical) for start, end in ranges]
+        frames = [future.result() for future in futures]
+
+    with stage('merge') as metrics:
+        # Shards without leaks are left out, as their empty columns have no types to merge
+        leaks = pd.concat([frame for frame in frames if len(frame)] or frames[:1], ignore_index=True)
+        timestamps = leaks['timestamp'].to_numpy()
+        if len(timestamps) and not (timestamps[1:] >= timestamps[:-1]).all():
+            # Ranges follow the file order; a dataset that is not in time order is merged like the serial sort
+            leaks = leaks.sort_values('timestamp', kind='stable', ignore_index=True)
+        # Accumulate in record order, like the serial path, so the total is the same to the last bit
+        total_leakage = sum(leaks['leakage_amount'].tolist(), 0)
+        metrics.add(leaks=len(leaks), groups=len(frames))
+    return leaks, total_leakage
+
+def main(argv=None):
+    """
+    Main function to execute the parallel leakage detection and write its leak report.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(description="Detect leakages in a CSV dataset on several CPU cores.")
+    parser.add_argument('file_path', nargs='?', default='datasets/water_distribution_data_leak.csv',
+                        help="Path to the CSV dataset file.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="Number of timestamp ranges the dataset is split into (default: four per worker).")
+    parser.add_argument('--hierarchical', action='store_true',
+                        help="Balance every junction against its direct children instead of all endpoints on its path.")
+    parser.add_argument('--output-dir', default='outputs', help="Directory in which the report tables are saved.")
+    parser.add_argument('--format', dest='formats', nargs='+', choices=FORMATS, default=['csv'],
+                        help="Output formats of the report tables (Parquet needs pyarrow or fastparquet).")
+    parser.add_argument('--top-k', type=int, default=10, help="Number of junctions in the top junctions table.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with metrics_session(args, 'parallel_detection'):
+        with stage('detect') as metrics:
+            leaks, total_leakage = leakage_frame_parallel(args.file_path, workers=args.workers, shards=args.shards,
+                                                          hierarchical=args.hierarchical)
+            metrics.add(leaks=len(leaks))
+
+        report = build_leak_report(leaks, top_k=args.top_k)
+        paths = write_leak_report(report, args.output_dir, args.formats)
+        print_report_summary(report, total_leakage, paths)
+
+if __name__ == "__main__":
+    main()
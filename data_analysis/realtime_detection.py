@@ -0,0 +1,349 @@
+"""
+realtime_detection.py
+
+Event-driven leak detection over a live stream of sensor readings, built on asyncio.
+
+Readings are ingested one at a time and grouped into per-timestamp windows. A window is evaluated
+with the same mass balance as `detect_leakages` as soon as every known sensor has reported for its
+timestamp, or when its grace period expires. Readings may arrive out of order; windows that have been
+evaluated are evicted, and late readings for them are counted and dropped, so the state stays bounded.
+
+Readings are CSV lines with the dataset columns (timestamp, sensor_id, path_to_master, type,
+device_type, water_usage), optionally followed by the Unix time at which they were emitted, as written by
+`data_generation/feed_generator.py`; the latency from emission to evaluation is then measured. They can
+come from a local TCP or Unix socket, a pipe or a file that is still being written, or from a CSV file
+replayed as a stand-in for the sensor feed. Malformed lines are counted and skipped.
+
+Classes:
+- RealtimeLeakDetector: Keeps per-timestamp windows and emits leak records.
+
+Functions:
+- parse_reading: Parses one CSV line into a reading.
+- replay_csv: Feeds the rows of a CSV file to a detector, optionally paced.
+- serve_socket: Feeds readings received on a local socket to a detector.
+- tail_feed: Feeds readings written to a pipe or a growing file to a detector.
+- main: Entry point for running the real-time detector.
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import stat
+import sys
+import time
+from collections import OrderedDict, deque
+import numpy as np
+import pandas as pd
+
+from data_analysis.leakage_detection import detect_leakages, print_leak
+from data_analysis.usage_sketches import QuantileSketch, RollingUsageSketch, save_sketch
+from data_generation.columnar_dataset import read_dataset
+
+FIELDNAMES = ['timestamp', 'sensor_id', 'path_to_master', 'type', 'device_type', 'water_usage']
+
+def parse_reading(line):
+    """
+    Parses one CSV line with the dataset columns, and optionally an emission time, into a reading.
+
+    Parameters:
+    - line (str): A CSV line, without the trailing newline.
+
+    Returns:
+    - Dict or None: The reading, with an `emitted_at` Unix time if the line has one, or None for blank and header lines.
+
+    Raises:
+    - ValueError: If the line has the wrong number of fields or a field is not a number where one is expected.
+    """
+    fields = next(csv.reader([line]), None)
+    if not fields or fields[0] == 'timestamp':
+        return None
+    if len(fields) not in (len(FIELDNAMES), len(FIELDNAMES) + 1):
+        raise ValueError(f"Expected {len(FIELDNAMES)} or {len(FIELDNAMES) + 1} fields, got {len(fields)}")
+    reading = dict(zip(FIELDNAMES, fields))
+    reading['sensor_id'] = int(reading['sensor_id'])
+    reading['water_usage'] = float(reading['water_usage'])
+    if len(fields) > len(FIELDNAMES):
+        reading['emitted_at'] = float(fields[len(FIELDNAMES)])
+    return reading
+
+class RealtimeLeakDetector:
+    """
+    Groups streamed readings into per-timestamp windows and runs the leak mass balance on each.
+
+    The set of sensors expected in every window is learned from the readings seen so far, unless it is
+    given up front. While it is being learned, the first window can only close when its grace period
+    expires; later windows close as soon as all sensors seen so far have reported. Leak records are
+    passed to `on_leak` in the format returned by `detect_leakages`, and the readings of every evaluated
+    window to `on_window` as a DataFrame, e.g. to update a `usage_sketches.RollingUsageSketch`. For readings
+    that carry their emission time, the latency until their window is evaluated is kept in `latency`.
+    """
+
+    def __init__(self, on_leak=print_leak, grace_seconds=5.0, expected_sensors=None,
+                 max_open_windows=1024, closed_history=4096, on_window=None):
+        self.on_leak = on_leak
+        self.on_window = on_window
+        self.grace_seconds = grace_seconds
+        self.expected_sensors = set(expected_sensors or ())
+        self.learn_sensors = expected_sensors is None
+        self.sensors_known = not self.learn_sensors
+        self.max_open_windows = max_open_windows
+        # Open windows in order of first arrival: timestamp -> (first arrival time, {sensor_id: reading})
+        self.windows = OrderedDict()
+        self.closed = set()
+        self.closed_order = deque(maxlen=closed_history)
+        self.total_leakage = 0
+        self.latency = QuantileSketch()
+        self.stats = {'readings': 0, 'late_readings': 0, 'malformed_readings': 0, 'windows_completed': 0,
+                      'windows_expired': 0, 'leaks': 0}
+
+    def ingest(self, reading, now=None):
+        """
+        Adds one reading to its timestamp's window, evaluating the window if it is now complete.
+
+        Parameters:
+        - reading (Dict): A reading with the dataset columns.
+        - now (float, optional): Arrival time on the monotonic clock, defaults to the current time.
+        """
+        now = time.monotonic() if now is None else now
+        timestamp = reading['timestamp']
+        self.stats['readings'] += 1
+        if timestamp in self.closed:
+            self.stats['late_readings'] += 1
+            return
+
+        if self.learn_sensors:
+            self.expected_sensors.add(reading['sensor_id'])
+        window = self.windows.get(timestamp)
+        if window is None:
+            window = self.windows[timestamp] = (now, {})
+            if len(self.windows) > self.max_open_windows:
+                self._close(next(iter(self.windows)), expired=True)
+        # A repeated reading replaces the earlier one
+        window[1][reading['sensor_id']] = reading
+
+        if self.sensors_known and timestamp in self.windows and self.expected_sensors.issubset(window[1]):
+            self._close(timestamp, expired=False)
+
+    def ingest_line(self, line, now=None):
+        """
+        Parses one CSV line of the feed and ingests its reading. Malformed lines are counted and skipped,
+        so that one bad line does not stop a long-running detector.
+
+        Parameters:
+        - line (str or bytes): A CSV line, with or without the trailing newline.
+        - now (float, optional): Arrival time on the monotonic clock, defaults to the current time.
+        """
+        try:
+            if isinstance(line, bytes):
+                line = line.decode()
+            reading = parse_reading(line.rstrip('\r\n'))
+        except ValueError:
+            self.stats['malformed_readings'] += 1
+            return
+        if reading is not None:
+            self.ingest(reading, now)
+
+    def expire(self, now=None):
+        """
+        Evaluates every window whose grace period has expired.
+
+        Parameters:
+        - now (float, optional): Current time on the monotonic clock.
+        """
+        now = time.monotonic() if now is None else now
+        expired = [timestamp for timestamp, (first_arrival, _) in self.windows.items()
+                   if now - first_arrival >= self.grace_seconds]
+        for timestamp in expired:
+            # Closing the first window can close others that were already complete
+            if timestamp in self.windows:
+                self._close(timestamp, expired=True)
+
+    def flush(self):
+        """ Evaluates all open windows, e.g. at the end of a replay. """
+        for timestamp in list(self.windows):
+            if timestamp in self.windows:
+                self._close(timestamp, expired=True)
+
+    def _close(self, timestamp, expired):
+        """ Evaluates a window, emits its leaks and evicts it. """
+        _, readings = self.windows.pop(timestamp)
+        if len(self.closed_order) == self.closed_order.maxlen:
+            self.closed.discard(self.closed_order[0])
+        self.closed_order.append(timestamp)
+        self.closed.add(timestamp)
+        self.stats['windows_expired' if expired else 'windows_completed'] += 1
+        learned = not self.sensors_known
+        self.sensors_known = True
+
+        window = pd.DataFrame(list(readings.values()), columns=FIELDNAMES)
+        leakages, total_leakage = detect_leakages(window)
+        self.total_leakage += total_leakage
+        self.stats['leaks'] += len(leakages)
+        for leak in leakages:
+            self.on_leak(leak)
+        if self.on_window is not None:
+            self.on_window(window)
+        emitted = [reading['emitted_at'] for reading in readings.values() if 'emitted_at' in reading]
+        if emitted:
+            self.latency.update(time.time() - np.asarray(emitted))
+
+        if learned:
+            # Windows that filled up while the sensors were being learned were never checked, close them now
+            complete = [other for other, (_, other_readings) in self.windows.items()
+                        if self.expected_sensors.issubset(other_readings)]
+            for other in complete:
+                self._close(other, expired=False)
+
+    async def run_expiry(self, interval=0.5):
+        """ Periodically evaluates expired windows until cancelled. """
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
+
+async def replay_csv(file_path, detector, rate=None):
+    """
+    Feeds the rows of a CSV dataset to a detector, standing in for a live sensor feed.
+
+    Parameters:
+    - file_path (str): Path to the CSV dataset.
+    - detector (RealtimeLeakDetector): The detector to feed.
+    - rate (float, optional): Readings per second; None replays as fast as possible.
+    """
+    started = time.monotonic()
+    # Lines are decoded by the detector, so that one undecodable line is skipped like any malformed one
+    with open(file_path, 'rb') as csvfile:
+        for row_number, line in enumerate(csvfile):
+            detector.ingest_line(line)
+            # Pace against the schedule rather than per row, so the time spent ingesting does not slow the replay
+            ahead = started + (row_number + 1) / rate - time.monotonic() if rate else 0
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+            elif row_number % 1000 == 0:
+                # Let the expiry task run during fast replays
+                await asyncio.sleep(0)
+    detector.flush()
+
+async def serve_socket(detector, host='127.0.0.1', port=9750, unix_path=None):
+    """
+    Feeds readings received as CSV lines on a local TCP or Unix socket to a detector, until cancelled.
+
+    Parameters:
+    - detector (RealtimeLeakDetector): The detector to feed.
+    - host (str): Host to listen on for TCP connections.
+    - port (int): Port to listen on for TCP connections.
+    - unix_path (str, optional): Listen on this Unix socket path instead of TCP.
+    """
+    async def handle_connection(reader, writer):
+        try:
+            while line := await reader.readline():
+                detector.ingest_line(line)
+        finally:
+            writer.close()
+
+    if unix_path:
+        server = await asyncio.start_unix_server(handle_connection, path=unix_path)
+    else:
+        server = await asyncio.start_server(handle_connection, host, port)
+    async with server:
+        await server.serve_forever()
+
+async def tail_feed(file_path, detector, poll_interval=0.1):
+    """
+    Feeds the readings written to a pipe or to a growing file to a detector.
+
+    A pipe (or '-' for standard input) is read until its writer closes it. A regular file is followed
+    like `tail -f` from its first line, until cancelled.
+
+    Parameters:
+    - file_path (str): Path of a named pipe or file, or '-' for standard input.
+    - detector (RealtimeLeakDetector): The detector to feed.
+    - poll_interval (float): Seconds to wait for a regular file to grow.
+    """
+    if file_path == '-' or stat.S_ISFIFO(os.stat(file_path).st_mode):
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        pipe = sys.stdin if file_path == '-' else open(file_path, 'rb')
+        await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        while line := await reader.readline():
+            detector.ingest_line(line)
+        detector.flush()
+        return
+
+    with open(file_path, 'rb') as feed:
+        pending = b''
+        while True:
+            line = feed.readline()
+            if not line.endswith(b'\n'):
+                # Wait for the rest of a partially written line
+                pending += line
+                await asyncio.sleep(poll_interval)
+                continue
+            detector.ingest_line(pending + line)
+            pending = b''
+
+async def _run(args):
+    """ Runs the detector on the selected source. """
+    expected_sensors = None
+    if args.sensors_from:
+        expected_sensors = set(read_dataset(args.sensors_from)['sensor_id'].unique().tolist())
+    sketch = RollingUsageSketch(args.sketch_window_hours) if args.sketch else None
+    detector = RealtimeLeakDetector(grace_seconds=args.grace, expected_sensors=expected_sensors,
+                                    on_window=sketch.update if sketch is not None else None)
+    expiry_task = asyncio.create_task(detector.run_expiry())
+    started = time.perf_counter()
+    try:
+        if args.source == 'replay':
+            await replay_csv(args.file_path, detector, rate=args.rate)
+        elif args.source == 'tail':
+            await tail_feed(args.file_path, detector)
+        else:
+            await serve_socket(detector, args.host, args.port, args.unix)
+    finally:
+        expiry_task.cancel()
+        print(f"Total Leakage in the System: {detector.total_leakage:.2f} units")
+        print(f"Stream statistics: {detector.stats}")
+        elapsed = time.perf_counter() - started
+        print(f"Throughput: {detector.stats['readings'] / elapsed:.0f} readings/s over {elapsed:.2f}s")
+        if detector.latency.count:
+            latency = detector.latency
+            print(f"Latency from emission to evaluation: p50 {latency.quantile(0.5) * 1000:.1f} ms, "
+                  f"p99 {latency.quantile(0.99) * 1000:.1f} ms, max {latency.max * 1000:.1f} ms "
+                  f"({latency.count} readings)")
+        if sketch is not None:
+            save_sketch(sketch, args.sketch)
+            print(f"Usage sketch of the last {args.sketch_window_hours} hours saved to {args.sketch}")
+
+def main(argv=None):
+    """
+    Main function to run real-time leakage detection on a replayed file or a local socket.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(description="Detect leakages in real time from a stream of sensor readings.")
+    parser.add_argument('--grace', type=float, default=5.0,
+                        help="Seconds to wait for missing readings before a timestamp is evaluated anyway.")
+    parser.add_argument('--sensors-from', default=None,
+                        help="Dataset listing the sensors expected at every timestamp (default: learned from the stream).")
+    parser.add_argument('--sketch', default=None,
+                        help="Keep a rolling usage sketch of the evaluated windows and save it to this JSON file on exit.")
+    parser.add_argument('--sketch-window-hours', type=int, default=24, help="Rolling window of the usage sketch in hours.")
+    sources = parser.add_subparsers(dest='source', required=True)
+    replay = sources.add_parser('replay', help="Replay a CSV dataset as a sensor feed.")
+    replay.add_argument('file_path', help="Path to the CSV dataset.")
+    replay.add_argument('--rate', type=float, default=None, help="Readings per second (default: as fast as possible).")
+    tail = sources.add_parser('tail', help="Read CSV lines from a pipe, standard input or a growing file.")
+    tail.add_argument('file_path', help="Path of a named pipe or file, or '-' for standard input.")
+    serve = sources.add_parser('serve', help="Read CSV lines from a local socket.")
+    serve.add_argument('--host', default='127.0.0.1', help="Host to listen on.")
+    serve.add_argument('--port', type=int, default=9750, help="TCP port to listen on.")
+    serve.add_argument('--unix', default=None, help="Listen on this Unix socket path instead of TCP.")
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(_run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
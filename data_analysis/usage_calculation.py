@@ -3,59 +3,167 @@ usage_calculation.py
 
 This script calculates the water usage at different endpoints in a water distribution
 network over a specified time range. It outputs the calculated usage data and its hash
-to a CSV file located in the 'outputs' directory.
+to a CSV file located in the 'outputs' directory. The time range can be given on the
+command line for batch use, and repeated queries can be answered from a persisted
+prefix-sum index (see usage_index.py).
 
 Functions:
+- sum_endpoint_usage_chunked: Sums endpoint usage over a time range, reading the dataset in chunks.
+- timestamp_range_chunked: Finds the time range of a dataset, reading it in chunks.
 - calculate_endpoint_usage: Calculates and outputs water usage at endpoints.
 """
 
+import argparse
 import os
 import pandas as pd
 import hashlib
 
-def calculate_endpoint_usage(file_path):
+from data_analysis.usage_index import load_usage_index, query_usage
+from data_generation.columnar_dataset import iter_dataset_chunks, read_dataset
+from data_generation.instrumentation import add_metrics_arguments, metrics_session, stage, timed_iter
+
+def sum_endpoint_usage_chunked(file_path, from_timestamp, to_timestamp, chunksize):
+    """
+    Sums the water usage of every endpoint within a time range, reading the dataset in chunks.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - from_timestamp (str): Start of the time range (inclusive).
+    - to_timestamp (str): End of the time range (inclusive).
+    - chunksize (int): Number of rows read per chunk.
+
+    Returns:
+    - DataFrame: Total water usage per sensor ID, with the same layout as the in-memory calculation.
+    """
+    partial_sums = []
+    chunks = iter_dataset_chunks(file_path, chunksize, usecols=['timestamp', 'sensor_id', 'type', 'water_usage'])
+    for chunk in timed_iter('load', chunks):
+        with stage('aggregate') as metrics:
+            filtered_chunk = chunk[(chunk['timestamp'] >= from_timestamp) & (chunk['timestamp'] <= to_timestamp) & (chunk['type'] == 'Endpoint')]
+            partial_sums.append(filtered_chunk.groupby('sensor_id')['water_usage'].sum())
+            metrics.add(rows=len(filtered_chunk), groups=len(partial_sums[-1]))
+
+    # Combining the per-chunk totals; their size depends on the number of sensors, not on the file size
+    return pd.concat(partial_sums).groupby(level=0).sum().rename_axis('sensor_id').reset_index()
+
+def timestamp_range_chunked(file_path, chunksize):
+    """
+    Finds the min and max timestamp of a dataset, reading it in chunks.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - chunksize (int): Number of rows read per chunk.
+
+    Returns:
+    - Tuple[str, str]: The min and max timestamp.
+    """
+    min_timestamp = None
+    max_timestamp = None
+    for chunk in timed_iter('scan_time_range', iter_dataset_chunks(file_path, chunksize, usecols=['timestamp'])):
+        chunk_min = chunk['timestamp'].min()
+        chunk_max = chunk['timestamp'].max()
+        min_timestamp = chunk_min if min_timestamp is None else min(min_timestamp, chunk_min)
+        max_timestamp = chunk_max if max_timestamp is None else max(max_timestamp, chunk_max)
+    return min_timestamp, max_timestamp
+
+def calculate_endpoint_usage(file_path, from_timestamp=None, to_timestamp=None, chunksize=None, use_index=False, output_dir='outputs',
+                             use_cache=False):
     """
     Calculates water usage at endpoints within a specified time range and saves the data to a CSV file in the 'outputs' directory. Also, computes and prints the hash of the output data.
 
+    The time range is asked for interactively unless both timestamps are given.
+
     Parameters:
-    - file_path (str): Path to the dataset file.
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - from_timestamp (str, optional): Start of the time range (inclusive), format YYYY-MM-DD HH:MM:SS.
+    - to_timestamp (str, optional): End of the time range (inclusive), format YYYY-MM-DD HH:MM:SS.
+    - chunksize (int, optional): Read the dataset in chunks of this many rows instead of loading it at once.
+    - use_index (bool): Answer the query from the dataset's persisted prefix-sum usage index, building it if needed.
+    - output_dir (str): Directory in which the results are saved.
+    - use_cache (bool): Read a CSV dataset through its binary sidecar cache, creating it if needed.
+
+    Returns:
+    - Tuple[str, str]: Path of the output file and its SHA-256 hash.
     """
     # Load the dataset
-    data = pd.read_csv(file_path)
+    data = None
+    index = None
+    if use_index:
+        with stage('load_index'):
+            index = load_usage_index(file_path)
+        min_timestamp = index['timestamps'][0] if len(index['timestamps']) else None
+        max_timestamp = index['timestamps'][-1] if len(index['timestamps']) else None
+    elif chunksize:
+        min_timestamp, max_timestamp = timestamp_range_chunked(file_path, chunksize)
+    else:
+        with stage('load') as metrics:
+            data = read_dataset(file_path, cache=use_cache)
+            metrics.add(rows=len(data))
 
-    # Calculating the min and max timestamp values for guidance
-    min_timestamp = data['timestamp'].min()
-    max_timestamp = data['timestamp'].max()
+        # Calculating the min and max timestamp values for guidance
+        min_timestamp = data['timestamp'].min()
+        max_timestamp = data['timestamp'].max()
 
-    print("Available time range for water usage calculation:")
-    print(f"From: {min_timestamp}")
-    print(f"To:   {max_timestamp}")
-    from_timestamp = input("Enter the 'from' timestamp (format YYYY-MM-DD HH:MM:SS): ")
-    to_timestamp = input("Enter the 'to' timestamp (format YYYY-MM-DD HH:MM:SS): ")
+    if from_timestamp is None or to_timestamp is None:
+        print("Available time range for water usage calculation:")
+        print(f"From: {min_timestamp}")
+        print(f"To:   {max_timestamp}")
+        from_timestamp = input("Enter the 'from' timestamp (format YYYY-MM-DD HH:MM:SS): ")
+        to_timestamp = input("Enter the 'to' timestamp (format YYYY-MM-DD HH:MM:SS): ")
 
-    # Filtering the data based on the provided time range
-    filtered_data = data[(data['timestamp'] >= from_timestamp) & (data['timestamp'] <= to_timestamp) & (data['type'] == 'Endpoint')]
+    if use_index:
+        # Two lookups per endpoint in the cumulative usage index
+        with stage('aggregate') as metrics:
+            grouped_data = query_usage(index, from_timestamp, to_timestamp)
+            metrics.add(groups=len(grouped_data))
+    elif chunksize:
+        grouped_data = sum_endpoint_usage_chunked(file_path, from_timestamp, to_timestamp, chunksize)
+    else:
+        with stage('aggregate') as metrics:
+            # Filtering the data based on the provided time range
+            filtered_data = data[(data['timestamp'] >= from_timestamp) & (data['timestamp'] <= to_timestamp) & (data['type'] == 'Endpoint')]
 
-    # Grouping the data by sensor ID and calculating total water usage for each endpoint
-    grouped_data = filtered_data.groupby('sensor_id')['water_usage'].sum().reset_index()
+            # Grouping the data by sensor ID and calculating total water usage for each endpoint
+            grouped_data = filtered_data.groupby('sensor_id')['water_usage'].sum().reset_index()
+            metrics.add(rows=len(filtered_data), groups=len(grouped_data))
 
     # Create 'outputs' directory if it doesn't exist
-    output_dir = 'outputs'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     # Saving the results to a CSV file in the 'outputs' directory
     output_file_path = os.path.join(output_dir, 'endpoint_water_usage.csv')
-    grouped_data.to_csv(output_file_path, index=False)
+    with stage('write_output') as metrics:
+        grouped_data.to_csv(output_file_path, index=False)
+        metrics.add(rows=len(grouped_data))
 
     # Calculate and print the hash of the output file
-    with open(output_file_path, 'rb') as file:
-        file_content = file.read()
-    hash_result = hashlib.sha256(file_content).hexdigest()
+    with stage('hash'):
+        with open(output_file_path, 'rb') as file:
+            file_content = file.read()
+        hash_result = hashlib.sha256(file_content).hexdigest()
 
     print(f"Water usage at endpoints has been calculated and stored in {output_file_path}.")
     print(f"The SHA-256 hash of the output file is: {hash_result}")
+    return output_file_path, hash_result
 
 if __name__ == "__main__":
-    file_path = 'datasets/water_distribution_data.csv'  # Replace with the actual path to your dataset
-    calculate_endpoint_usage(file_path)
+    parser = argparse.ArgumentParser(description="Calculate the water usage at endpoints over a time range.")
+    parser.add_argument('file_path', nargs='?', default='datasets/water_distribution_data.csv',
+                        help="Path to the CSV dataset file or columnar dataset directory.")
+    parser.add_argument('--from', dest='from_timestamp', default=None,
+                        help="Start of the time range (YYYY-MM-DD HH:MM:SS); prompted for if omitted.")
+    parser.add_argument('--to', dest='to_timestamp', default=None,
+                        help="End of the time range (YYYY-MM-DD HH:MM:SS); prompted for if omitted.")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Read the dataset in chunks of this many rows instead of loading it at once.")
+    parser.add_argument('--index', dest='use_index', action='store_true',
+                        help="Use the prefix-sum usage index stored next to the dataset, building it if needed.")
+    parser.add_argument('--output-dir', default='outputs', help="Directory in which the results are saved.")
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help="Parse the CSV dataset without reading or writing its binary sidecar cache.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    with metrics_session(args, 'usage_calculation'):
+        calculate_endpoint_usage(args.file_path, args.from_timestamp, args.to_timestamp, chunksize=args.chunksize,
+                                 use_index=args.use_index, output_dir=args.output_dir, use_cache=args.use_cache)
@@ -4,24 +4,221 @@ usage_calculation.py
 This script calculates the water usage at different endpoints in a water distribution
 network and returns the hash of the calculated usage data.
 
+The CSV data can be passed as a string, as a bytes-like buffer, as an open file or as a file
+path; buffers and files are parsed without first being copied into an intermediate string, and
+file paths are memory-mapped. Many payloads can be hashed concurrently with the batch entry point.
+
+It also offers an incremental Merkle mode: a Merkle tree over the per-sensor usage totals whose
+root is updated in time proportional to newly appended readings, and which can prove the
+inclusion of a single sensor's total with a logarithmic number of hashes.
+
+Classes:
+- UsageMerkleTree: Merkle tree over per-sensor usage totals.
+
 Functions:
 - calculate_endpoint_usage: Calculates and returns the hash of water usage at endpoints.
+- calculate_endpoint_usage_batch: Hashes many payloads on a process pool, returning digests in input order.
+- calculate_endpoint_usage_merkle: Calculates and returns the Merkle root of water usage at endpoints.
+- verify_usage_proof: Verifies that a sensor's total is included under a Merkle root.
 """
 
 
+import io
+import os
 import pandas as pd
 import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from io import StringIO
 
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+class _BufferReader(io.RawIOBase):
+    """ Read-only binary stream over a bytes-like buffer that hands out slices without copying the whole buffer. """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        size = min(len(target), len(self._view) - self._position)
+        target[:size] = self._view[self._position:self._position + size]
+        self._position += size
+        return size
+
+def _read_usage_csv(csv_data):
+    """
+    Reads CSV formatted data into a DataFrame.
+
+    Parameters:
+    - csv_data (str, bytes-like, os.PathLike or file object): The CSV data. A str is always the CSV
+      content itself; file paths must be given as os.PathLike objects such as pathlib.Path.
+
+    Returns:
+    - DataFrame: The parsed data.
+    """
+    if isinstance(csv_data, str):
+        return pd.read_csv(StringIO(csv_data))
+    if isinstance(csv_data, (bytes, bytearray, memoryview)):
+        return pd.read_csv(io.BufferedReader(_BufferReader(csv_data)))
+    if isinstance(csv_data, os.PathLike):
+        return pd.read_csv(csv_data, memory_map=True)
+    if hasattr(csv_data, 'read'):
+        return pd.read_csv(csv_data)
+    raise TypeError(f"Unsupported CSV data of type {type(csv_data).__name__}")
+
+def _endpoint_totals(csv_data):
+    """ Parses CSV formatted data and sums the water usage of every endpoint. """
+    data = _read_usage_csv(csv_data)
+    filtered_data = data[data['type'] == 'Endpoint']
+    return filtered_data.groupby('sensor_id')['water_usage'].sum()
+
+def _leaf_hash(sensor_id, total):
+    """ Hashes one sensor's total into a Merkle leaf. """
+    return hashlib.sha256(LEAF_PREFIX + f"{int(sensor_id)},{float(total)!r}".encode()).digest()
+
+def _node_hash(left, right):
+    """ Hashes two child nodes into their parent node. """
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+class UsageMerkleTree:
+    """
+    Merkle tree over per-sensor water usage totals, with leaves ordered by sensor ID.
+
+    Every leaf commits to one sensor's total. Adding readings for known sensors only rehashes the
+    paths from their leaves to the root; readings for a new sensor insert a leaf and rebuild the tree.
+    A level with an odd number of nodes promotes its last node unchanged to the next level.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.sensor_ids = []
+        self.positions = {}
+        self.levels = [[]]
+
+    def _rebuild(self):
+        """ Rebuilds every level of the tree from the sorted leaves. """
+        self.sensor_ids = sorted(self.totals)
+        self.positions = {sensor_id: position for position, sensor_id in enumerate(self.sensor_ids)}
+        level = [_leaf_hash(sensor_id, self.totals[sensor_id]) for sensor_id in self.sensor_ids]
+        self.levels = [level]
+        while len(level) > 1:
+            level = [_node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    def _update_leaf(self, sensor_id):
+        """ Rehashes the path from one sensor's leaf to the root. """
+        position = self.positions[sensor_id]
+        self.levels[0][position] = _leaf_hash(sensor_id, self.totals[sensor_id])
+        for depth in range(1, len(self.levels)):
+            position //= 2
+            left = self.levels[depth - 1][2 * position]
+            has_right = 2 * position + 1 < len(self.levels[depth - 1])
+            self.levels[depth][position] = _node_hash(left, self.levels[depth - 1][2 * position + 1]) if has_right else left
+
+    def add_totals(self, totals):
+        """
+        Adds usage to the sensors' totals and updates the tree.
+
+        Parameters:
+        - totals (Mapping[int, float]): Additional water usage per sensor ID.
+        """
+        new_sensors = False
+        for sensor_id, total in totals.items():
+            sensor_id = int(sensor_id)
+            new_sensors = new_sensors or sensor_id not in self.totals
+            self.totals[sensor_id] = float(self.totals.get(sensor_id, 0.0) + total)
+
+        if new_sensors:
+            self._rebuild()
+        else:
+            for sensor_id in totals.keys():
+                self._update_leaf(int(sensor_id))
+
+    def append_csv(self, csv_data):
+        """
+        Adds the endpoint readings of CSV formatted data to the tree.
+
+        Parameters:
+        - csv_data (str, bytes-like, os.PathLike or file object): CSV formatted data, e.g. the readings of the latest hour.
+        """
+        self.add_totals(_endpoint_totals(csv_data).to_dict())
+
+    def root(self):
+        """
+        Returns the hex digest of the Merkle root, or the hash of empty input for an empty tree.
+        """
+        if not self.totals:
+            return hashlib.sha256(b'').hexdigest()
+        return self.levels[-1][0].hex()
+
+    def proof(self, sensor_id):
+        """
+        Builds the inclusion proof of one sensor's total.
+
+        Parameters:
+        - sensor_id (int): The sensor ID.
+
+        Returns:
+        - List[Tuple[str, str]]: Sibling hashes from the leaf upwards, each with the side ('left' or 'right') it is on.
+        """
+        position = self.positions[int(sensor_id)]
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = position ^ 1
+            if sibling < len(level):
+                proof.append(('left' if sibling < position else 'right', level[sibling].hex()))
+            position //= 2
+        return proof
+
+def verify_usage_proof(root, sensor_id, total, proof):
+    """
+    Verifies that a sensor's total is included under a Merkle root.
+
+    Parameters:
+    - root (str): Hex digest of the Merkle root.
+    - sensor_id (int): The sensor ID.
+    - total (float): The sensor's claimed total water usage.
+    - proof (List[Tuple[str, str]]): The inclusion proof from `UsageMerkleTree.proof`.
+
+    Returns:
+    - bool: True if the proof leads from the sensor's leaf to the root.
+    """
+    node = _leaf_hash(sensor_id, total)
+    for side, sibling in proof:
+        sibling = bytes.fromhex(sibling)
+        node = _node_hash(sibling, node) if side == 'left' else _node_hash(node, sibling)
+    return node.hex() == root
+
+def calculate_endpoint_usage_merkle(csv_data):
+    """
+    Calculates water usage at endpoints within the entire dataset and returns the Merkle root of the per-sensor totals.
+
+    Parameters:
+    - csv_data (str, bytes-like, os.PathLike or file object): CSV formatted data.
+
+    Returns:
+    - str: Hex digest of the Merkle root.
+    """
+    tree = UsageMerkleTree()
+    tree.append_csv(csv_data)
+    return tree.root()
+
 def calculate_endpoint_usage(csv_data):
     """
     Calculates water usage at endpoints within the entire dataset and returns the SHA-256 hash of the calculated data.
 
     Parameters:
-    - csv_data (str): String containing CSV formatted data.
+    - csv_data (str, bytes-like, os.PathLike or file object): String containing CSV formatted data, a
+      buffer or open file holding it, or the path of a CSV file (as an os.PathLike object).
     """
-    # Read the dataset from the CSV string
-    data = pd.read_csv(StringIO(csv_data))
+    # Read the dataset from the CSV string, buffer or file
+    data = _read_usage_csv(csv_data)
 
     # Filter data to include only 'Endpoint' type
     filtered_data = data[data['type'] == 'Endpoint']
@@ -35,6 +232,25 @@ def calculate_endpoint_usage(csv_data):
 
     return hash_result
 
+def calculate_endpoint_usage_batch(payloads, max_workers=None):
+    """
+    Calculates the hash of water usage at endpoints for many payloads concurrently on a process pool.
+
+    Parameters:
+    - payloads (Iterable): CSV payloads, each accepted by `calculate_endpoint_usage`. Open files cannot be
+      sent to worker processes and must be passed as paths; memoryviews are sent as bytes.
+    - max_workers (int, optional): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+    - List[str]: The SHA-256 hash of every payload, in input order.
+    """
+    payloads = [bytes(payload) if isinstance(payload, memoryview) else payload for payload in payloads]
+    workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Send the payloads in a few batches per worker instead of one round trip each
+        chunksize = max(1, len(payloads) // (4 * workers))
+        return list(executor.map(calculate_endpoint_usage, payloads, chunksize=chunksize))
+
 if __name__ == "__main__":
     # Example CSV data as a string
     csv_data = """
@@ -183,4 +399,4 @@ if __name__ == "__main__":
 2023-01-01 00:00:00,1000,Junction,Master,8114.332102795825
 """
 
-print(calculate_endpoint_usage(csv_data))
+    print(calculate_endpoint_usage(csv_data))
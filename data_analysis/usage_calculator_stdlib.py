@@ -0,0 +1,472 @@
+"""
+usage_calculator_stdlib.py
+
+Standard-library implementation of `usage_calculator_module.calculate_endpoint_usage`, for environments
+where importing pandas costs more than hashing the data, such as small deterministic VMs.
+
+The CSV data is streamed with the `csv` module and summed per sensor in a single pass, without
+materializing a table. The digest is byte-identical to the pandas implementation, because every step
+of it is reproduced:
+- Column types are inferred like pandas' C parser: a column is int64 if every value is an integer,
+  float64 if every value is numeric or missing, and text otherwise.
+- Floats are parsed with the same algorithm as pandas' default ("high" precision) converter, which
+  differs from Python's correctly rounded `float()` in the last bit for some inputs.
+- Totals are accumulated with the compensated (Kahan) summation of pandas' grouped sum, in row order.
+- Sensors are sorted by their parsed IDs, and totals are formatted like `DataFrame.to_csv`.
+
+Supported inputs are those produced by the data makers and by hand-written CSVs: integer or float
+sensor IDs (below 2**53), text sensor IDs, and numeric water usage. A water usage column that is not
+numeric raises a ValueError instead of reproducing pandas' summation of strings.
+
+Running the module with `--verify` compares its digests against the pandas implementation over
+generated datasets and randomized CSVs.
+
+Functions:
+- calculate_endpoint_usage: Calculates and returns the hash of water usage at endpoints, without pandas.
+- endpoint_usage_totals: Returns the per-sensor totals as they are serialized for the hash.
+- verify_against_pandas: Compares the digests of both implementations over generated datasets.
+- main: Entry point for hashing files or running the differential verification.
+"""
+
+import argparse
+import contextlib
+import csv
+from datetime import datetime
+import hashlib
+import io
+import math
+import os
+import pathlib
+import random
+import re
+import sys
+
+# Values read as missing by pandas.read_csv with its default settings
+NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND',
+                       '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+INF_VALUES = {'inf': float('inf'), '+inf': float('inf'), 'infinity': float('inf'), '+infinity': float('inf'),
+              '-inf': float('-inf'), '-infinity': float('-inf')}
+
+# Column kinds, in the order in which a column is widened
+_INT, _FLOAT, _TEXT = 0, 1, 2
+# Kinds of values that do not decide a column's kind on their own
+_MISSING, _LARGE_INT = 3, 4
+
+_MAX_DIGITS = 17
+_POWERS_OF_TEN = [float(f"1e{exponent}") for exponent in range(309)]
+_INT_PATTERN = re.compile(r'[ \t\n\v\f\r]*([+-]?[0-9]+)[ \t\n\v\f\r]*\Z')
+_FLOAT_PATTERN = re.compile(r'[ \t\n\v\f\r]*([+-]?)([0-9]*)(?:\.([0-9]*))?(?:[eE]([+-]?[0-9]+))?[ \t\n\v\f\r]*\Z')
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+_VALUE_CACHE_SIZE = 65536
+
+def _parse_float(token):
+    """ Parses a float exactly like pandas' default converter (precise_xstrtod), or returns None. """
+    match = _FLOAT_PATTERN.match(token)
+    if match is None:
+        return INF_VALUES.get(token.lower())
+    sign, integer_digits, fraction_digits, exponent_text = match.groups()
+    fraction_digits = fraction_digits or ''
+    if not integer_digits and not fraction_digits:
+        return INF_VALUES.get(token.lower())
+
+    # At most 17 significant digits are used, leading zeros included; the rest only shift the exponent
+    if len(integer_digits) >= _MAX_DIGITS:
+        digits = integer_digits[:_MAX_DIGITS]
+        exponent = len(integer_digits) - _MAX_DIGITS
+    else:
+        used_fraction = fraction_digits[:_MAX_DIGITS - len(integer_digits)]
+        digits = integer_digits + used_fraction
+        exponent = -len(used_fraction)
+    if exponent_text:
+        # Exponents of any length are read; beyond a few hundred they only decide between zero and infinity
+        exponent_digits = exponent_text.lstrip('+-').lstrip('0')
+        exponent_value = int(exponent_digits or '0') if len(exponent_digits) < 10 else 10 ** 9
+        exponent += -exponent_value if exponent_text[0] == '-' else exponent_value
+
+    # The digits are accumulated in floating point; the first 15 fit exactly
+    number = float(int(digits[:15]))
+    for digit in digits[15:]:
+        number = number * 10.0 + (ord(digit) - 48)
+    if sign == '-':
+        number = -number
+
+    if exponent > 308:
+        # Out of range: infinite, except for a zero mantissa
+        return 0.0 if number == 0 else math.copysign(math.inf, number)
+    if exponent > 0:
+        number *= _POWERS_OF_TEN[exponent]
+    elif exponent < -308:
+        if exponent < -616:
+            number = 0.0
+        else:
+            number /= _POWERS_OF_TEN[-308 - exponent]
+            number /= _POWERS_OF_TEN[308]
+    else:
+        number /= _POWERS_OF_TEN[-exponent]
+    return number
+
+def _parse_value(token):
+    """
+    Parses one field of a numeric column.
+
+    Returns:
+    - Tuple[int, int or None, float or None]: The kind of the value, its integer value (None unless it is
+      an int64) and its float value (NaN if missing, None if not numeric).
+    """
+    if token in NA_VALUES:
+        return _MISSING, None, float('nan')
+    match = _INT_PATTERN.match(token)
+    if match is not None:
+        integer = int(match.group(1))
+        if _INT64_MIN <= integer <= _INT64_MAX:
+            return _INT, integer, _parse_float(token)
+        return _LARGE_INT, None, _parse_float(token)
+    number = _parse_float(token)
+    if number is None:
+        return _TEXT, None, None
+    return _FLOAT, None, number
+
+def _widen(column_kind, integers_only, value_kind, column):
+    """
+    Widens a column's kind for a value, as pandas' C parser would infer it.
+
+    pandas first reads a column as int64, skipping missing values, and stops at the first value that is not
+    an integer: a float makes it read the column as float64, but an integer beyond int64 makes it fall back
+    to uint64 or to Python objects, which are not reproduced here.
+
+    Returns:
+    - Tuple[int, bool]: The column's kind, and whether all values read so far were integers or missing.
+    """
+    if value_kind == _TEXT:
+        return _TEXT, False
+    if value_kind == _LARGE_INT and integers_only:
+        raise ValueError(f"Integers beyond int64 in the {column} column are not supported")
+    return max(column_kind, _FLOAT), integers_only and value_kind == _MISSING
+
+def _format_float(number):
+    """ Formats a float like DataFrame.to_csv, which writes missing values as empty fields. """
+    return '' if number != number else repr(number)
+
+def _to_int64(number):
+    """ Wraps an integer around to int64, like an overflowing pandas sum. """
+    return (number - _INT64_MIN) % 2 ** 64 + _INT64_MIN
+
+@contextlib.contextmanager
+def _open_text(csv_data):
+    """
+    Opens CSV data as a text stream, without closing files that were passed in open.
+
+    Parameters:
+    - csv_data (str, bytes-like, os.PathLike or file object): The CSV data. A str is always the CSV
+      content itself; file paths must be given as os.PathLike objects such as pathlib.Path.
+
+    Yields:
+    - TextIO: The CSV text.
+    """
+    if isinstance(csv_data, str):
+        yield io.StringIO(csv_data, newline='')
+    elif isinstance(csv_data, (bytes, bytearray, memoryview)):
+        with io.TextIOWrapper(io.BytesIO(csv_data), encoding='utf-8-sig', newline='') as stream:
+            yield stream
+    elif isinstance(csv_data, os.PathLike):
+        with open(csv_data, encoding='utf-8-sig', newline='') as stream:
+            yield stream
+    elif hasattr(csv_data, 'read'):
+        if isinstance(csv_data, io.TextIOBase):
+            yield csv_data
+        else:
+            stream = io.TextIOWrapper(csv_data, encoding='utf-8-sig', newline='')
+            try:
+                yield stream
+            finally:
+                # Hand the binary file back to the caller instead of closing it with the wrapper
+                stream.detach()
+    else:
+        raise TypeError(f"Unsupported CSV data of type {type(csv_data).__name__}")
+
+def _sum_endpoints(stream, text_sensor_ids=False):
+    """
+    Sums the water usage of every endpoint in one pass over a CSV text stream.
+
+    Parameters:
+    - stream (TextIO): The CSV text.
+    - text_sensor_ids (bool): Group by the sensor IDs as text, for a sensor_id column that is not numeric.
+
+    Returns:
+    - Tuple or None: The totals by sensor ID, each as [Kahan sum, compensation, integer sum], and the kinds
+      of the sensor_id and water_usage columns; None if the sensor_id column turns out not to be numeric.
+    """
+    reader = csv.reader(stream)
+    # Like pandas, skip blank and whitespace-only lines; the first other line is the header
+    header = next((record for record in reader if record and (len(record) > 1 or record[0].strip(' \t'))), None)
+    if header is None:
+        raise ValueError("No columns to parse from file")
+    header[0] = header[0].removeprefix('\ufeff')
+    for column in ('type', 'sensor_id', 'water_usage'):
+        if column not in header:
+            raise KeyError(column)
+    type_column, sensor_column, usage_column = header.index('type'), header.index('sensor_id'), header.index('water_usage')
+    width = len(header)
+
+    totals = {}
+    sensor_kind = usage_kind = _INT
+    sensor_integers = usage_integers = True
+    sensor_values = {}
+    usage_values = {}
+    for record in reader:
+        if len(record) != width:
+            if not record or (len(record) == 1 and not record[0].strip(' \t')):
+                continue
+            if len(record) > width:
+                raise ValueError(f"Expected {width} fields in line {reader.line_num}, saw {len(record)}")
+            # Missing trailing fields are read as missing values
+            record += [''] * (width - len(record))
+
+        # Column kinds are inferred from every row, not just the endpoints
+        token = record[usage_column]
+        usage = usage_values.get(token)
+        if usage is None:
+            usage = _parse_value(token)
+            if usage[0] == _TEXT:
+                raise ValueError(f"Non-numeric water usage {token!r} in line {reader.line_num} is not supported")
+            if len(usage_values) >= _VALUE_CACHE_SIZE:
+                usage_values.clear()
+            usage_values[token] = usage
+        if usage[0] != usage_kind and usage[0] != _INT:
+            usage_kind, usage_integers = _widen(usage_kind, usage_integers, usage[0], 'water_usage')
+
+        token = record[sensor_column]
+        if text_sensor_ids:
+            sensor_id = None if token in NA_VALUES else token
+        else:
+            sensor = sensor_values.get(token)
+            if sensor is None:
+                sensor = _parse_value(token)
+                if len(sensor_values) >= _VALUE_CACHE_SIZE:
+                    sensor_values.clear()
+                sensor_values[token] = sensor
+            if sensor[0] != sensor_kind and sensor[0] != _INT:
+                if sensor[0] == _TEXT:
+                    return None
+                sensor_kind, sensor_integers = _widen(sensor_kind, sensor_integers, sensor[0], 'sensor_id')
+            # Integer and float IDs of the same value compare and hash equal, so they share a group
+            sensor_id = sensor[1] if sensor[1] is not None else sensor[2]
+            if sensor_id != sensor_id:
+                sensor_id = None
+
+        if record[type_column] != 'Endpoint' or sensor_id is None:
+            continue
+        total = totals.get(sensor_id)
+        if total is None:
+            total = totals[sensor_id] = [0.0, 0.0, 0]
+        number = usage[2]
+        if number == number:
+            # Compensated summation, step by step as in pandas' group_sum, which drops an infinite or NaN compensation
+            corrected = number - total[1]
+            accumulated = total[0] + corrected
+            compensation = accumulated - total[0] - corrected
+            total[1] = compensation if compensation - compensation == 0.0 else 0.0
+            total[0] = accumulated
+        if usage[1] is not None:
+            total[2] += usage[1]
+
+    return totals, (_TEXT if text_sensor_ids else sensor_kind), usage_kind
+
+def endpoint_usage_totals(csv_data):
+    """
+    Calculates the total water usage of every endpoint, formatted as in the CSV data that is hashed.
+
+    Parameters:
+    - csv_data (str, bytes-like, os.PathLike or file object): CSV formatted data. Open files whose
+      sensor IDs are not numeric are read twice and must be seekable.
+
+    Returns:
+    - List[Tuple[str, str]]: The sensor ID and total of every endpoint, sorted by sensor ID.
+    """
+    start = csv_data.tell() if hasattr(csv_data, 'read') and csv_data.seekable() else None
+    with _open_text(csv_data) as stream:
+        summed = _sum_endpoints(stream)
+    if summed is None:
+        # The sensor_id column holds text, so pandas groups the raw IDs; read the data again for them
+        if hasattr(csv_data, 'read'):
+            if start is None:
+                raise ValueError("Text sensor IDs require reading the CSV data twice, but the file is not seekable")
+            csv_data.seek(start)
+        with _open_text(csv_data) as stream:
+            summed = _sum_endpoints(stream, text_sensor_ids=True)
+    totals, sensor_kind, usage_kind = summed
+
+    rows = []
+    for sensor_id in sorted(totals):
+        total = totals[sensor_id]
+        if sensor_kind == _FLOAT:
+            sensor_id = _format_float(float(sensor_id))
+        rows.append((str(sensor_id), str(_to_int64(total[2])) if usage_kind == _INT else _format_float(total[0])))
+    return rows
+
+def calculate_endpoint_usage(csv_data):
+    """
+    Calculates water usage at endpoints within the entire dataset and returns the SHA-256 hash of the calculated data.
+
+    The digest is identical to that of `usage_calculator_module.calculate_endpoint_usage`.
+
+    Parameters:
+    - csv_data (str, bytes-like, os.PathLike or file object): String containing CSV formatted data, a
+      buffer or open file holding it, or the path of a CSV file (as an os.PathLike object).
+
+    Returns:
+    - str: Hex digest of the per-endpoint totals.
+    """
+    # Serialize the totals like DataFrame.to_csv(index=False, header=False)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator=os.linesep).writerows(endpoint_usage_totals(csv_data))
+    return hashlib.sha256(buffer.getvalue().encode()).hexdigest()
+
+def _random_number(rng, integer):
+    """ Formats a random usage value in one of the many ways a CSV writer or a person might. """
+    if integer:
+        value = rng.choice([0, rng.randint(0, 1000), rng.randint(-10 ** 6, 10 ** 6), rng.randint(0, 10 ** 17)])
+        return rng.choice(['{}', '+{}', ' {} ', '00{}']).format(value) if value >= 0 else str(value)
+    value = rng.choice([rng.uniform(0, 1000), rng.uniform(-1e6, 1e6), rng.random() * 10 ** rng.randint(-30, 30),
+                        float(rng.randint(0, 10 ** 17)), rng.random() / 3])
+    style = rng.randrange(8)
+    if style == 0:
+        return f"{value:.3f}"
+    if style == 1:
+        return f"{value:.17g}"
+    if style == 2:
+        return f"{value:e}"
+    if style == 3:
+        return f"{value:.{rng.randint(17, 25)}f}".rstrip('0')
+    if style == 4:
+        return f"00{abs(value):.{rng.randint(1, 20)}f}"
+    if style == 5:
+        return f"{value:.17E}"
+    if style == 6:
+        return rng.choice(['', 'NaN', 'nan', 'NA', 'inf', '-Infinity', '1e-320', '5e-324', '1.7976931348623157e308'])
+    return repr(value)
+
+def _random_csv(rng):
+    """ Builds a randomized CSV dataset covering the parsing, typing and summation corner cases. """
+    integer_usage = rng.random() < 0.3
+    sensor_style = rng.choice(['int', 'int', 'float', 'missing', 'text'])
+    sensors = rng.sample(range(1, 10 ** rng.randint(2, 9)), rng.randint(1, 40))
+    lines = ['timestamp,sensor_id,path_to_master,type,device_type,water_usage']
+    for row in range(rng.randint(0, 400)):
+        sensor_id = rng.choice(sensors)
+        if sensor_style == 'float' and rng.random() < 0.3:
+            sensor_id = f"{sensor_id}.0"
+        elif sensor_style == 'missing' and rng.random() < 0.05:
+            sensor_id = ''
+        elif sensor_style == 'text':
+            sensor_id = f"S-{sensor_id}" if rng.random() < 0.5 else sensor_id
+        sensor_type = rng.choice(['Endpoint', 'Endpoint', 'Endpoint', 'Junction', 'NA', '"Endpoint"'])
+        usage = _random_number(rng, integer_usage)
+        lines.append(f"2023-01-01 {row % 24:02d}:00:00,{sensor_id},\"1000->{sensor_id}\",{sensor_type},Home,{usage}")
+        if rng.random() < 0.02:
+            lines.append(rng.choice(['', '   ']))
+    line_end = rng.choice(['\n', '\r\n'])
+    return ('\ufeff' if rng.random() < 0.1 else '') + line_end.join(lines) + rng.choice([line_end, ''])
+
+def _generated_datasets(seed, work_dir):
+    """ Yields (name, path) of datasets written by both data maker engines with one seed. """
+    from data_generation import data_maker_leak, data_maker_no_leak
+    from data_generation.network_topology import build_topology
+
+    random.seed(seed)
+    start_time = datetime(2023, 1, 1)
+    datasets = [
+        ('object_leak', data_maker_leak.simulate_network(24, start_time, 1000, 0.2, 0.1)),
+        ('object_no_leak', data_maker_no_leak.simulate_network(24, start_time, 1000)),
+        ('vectorized_leak', data_maker_leak.simulate_network_vectorized(48, start_time, 1000, 0.2, 0.1, seed=seed)),
+        ('vectorized_no_leak', data_maker_no_leak.simulate_network_vectorized(48, start_time, 1000, seed=seed)),
+        ('vectorized_depth_3', data_maker_leak.simulate_network_vectorized(
+            24, start_time, 1000, 0.2, 0.1, seed=seed, topology=build_topology(depth=3, fan_out=(2, 4), seed=seed))),
+    ]
+    for name, data in datasets:
+        path = os.path.join(work_dir, f"{name}_{seed}.csv")
+        data_maker_leak.output_dataset(data, path)
+        yield f"{name} (seed {seed})", path
+
+def verify_against_pandas(seeds=(0, 1, 2), random_cases=300):
+    """
+    Compares the digests of this implementation and of `usage_calculator_module` on the same inputs.
+
+    The inputs are datasets generated by both data maker engines, passed as a path, a str, bytes and an
+    open file, and randomized CSVs covering number formats, missing values, column types and line endings.
+    This imports pandas and NumPy.
+
+    Parameters:
+    - seeds (Iterable[int]): Seeds of the generated datasets and of the randomized CSVs.
+    - random_cases (int): Number of randomized CSVs per seed.
+
+    Returns:
+    - Tuple[int, List[str]]: The number of inputs compared and a description of every mismatch.
+    """
+    import tempfile
+    from data_analysis import usage_calculator_module
+
+    def outcome(function, csv_data):
+        try:
+            return function(csv_data)
+        except (KeyError, ValueError) as error:
+            return f"error: {type(error).__name__}"
+
+    compared = 0
+    mismatches = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for seed in seeds:
+            for name, path in _generated_datasets(seed, work_dir):
+                with open(path, 'rb') as csvfile:
+                    content = csvfile.read()
+                expected = usage_calculator_module.calculate_endpoint_usage(pathlib.Path(path))
+                with open(path, 'rb') as csvfile:
+                    inputs = {'path': pathlib.Path(path), 'str': content.decode(), 'bytes': content, 'file': csvfile}
+                    for form, csv_data in inputs.items():
+                        compared += 1
+                        digest = calculate_endpoint_usage(csv_data)
+                        if digest != expected:
+                            mismatches.append(f"{name} as {form}: {digest} != {expected}")
+
+            rng = random.Random(seed)
+            for case in range(random_cases):
+                csv_text = _random_csv(rng)
+                compared += 1
+                expected = outcome(usage_calculator_module.calculate_endpoint_usage, csv_text)
+                digest = outcome(calculate_endpoint_usage, csv_text)
+                if digest != expected:
+                    mismatches.append(f"random CSV {case} (seed {seed}): {digest} != {expected}")
+    return compared, mismatches
+
+def main(argv=None):
+    """
+    Main function to hash CSV files without pandas, or to verify the digests against the pandas implementation.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+
+    Returns:
+    - int: The exit status, 1 if the verification found a mismatch.
+    """
+    parser = argparse.ArgumentParser(description="Hash the water usage at endpoints using only the standard library.")
+    parser.add_argument('file_paths', nargs='*', help="CSV files to hash.")
+    parser.add_argument('--verify', action='store_true',
+                        help="Compare the digests with the pandas implementation on generated datasets (needs pandas).")
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2], help="Seeds of the verification datasets.")
+    parser.add_argument('--cases', type=int, default=300, help="Randomized CSVs per seed for the verification.")
+    args = parser.parse_args(argv)
+    if not args.file_paths and not args.verify:
+        parser.error("give CSV files to hash, or --verify")
+
+    for file_path in args.file_paths:
+        print(f"{calculate_endpoint_usage(pathlib.Path(file_path))}  {file_path}")
+    if args.verify:
+        compared, mismatches = verify_against_pandas(args.seeds, args.cases)
+        for mismatch in mismatches:
+            print(f"MISMATCH {mismatch}")
+        print(f"Compared {compared} inputs: {len(mismatches)} mismatches.")
+        return 1 if mismatches else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+usage_index.py
+
+Prefix-sum time index for answering endpoint usage range queries without rescanning the dataset.
+
+The index holds, for every endpoint sensor, the cumulative water usage (and the cumulative number
+of readings) over the sorted unique timestamps of the dataset. The usage of every endpoint between
+two timestamps is then the difference of two rows of the cumulative matrix, found with two binary
+searches, so a query costs O(sensors) instead of a full scan and groupby. The index is persisted
+next to the dataset and rebuilt automatically when the dataset's size or modification time changes.
+
+Sums are computed as differences of running totals: they are exact for integer-valued readings and
+equal to the direct sum up to floating point rounding otherwise.
+
+Functions:
+- index_path_for: Returns the path at which the index of a dataset is stored.
+- build_usage_index: Builds the cumulative usage index of a dataset.
+- save_usage_index: Persists an index next to its dataset.
+- load_usage_index: Loads the persisted index of a dataset, building it when missing or stale.
+- query_usage: Calculates the usage of every endpoint between two timestamps.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from data_generation.columnar_dataset import read_dataset
+
+INDEX_VERSION = 1
+
+def index_path_for(file_path):
+    """
+    Returns the path at which the usage index of a dataset is stored.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+
+    Returns:
+    - str: Path of the index file.
+    """
+    return os.path.normpath(file_path) + '.usage_index.npz'
+
+def _source_fingerprint(file_path):
+    """ Identifies the current version of a dataset by its size and modification time. """
+    if os.path.isdir(file_path):
+        file_path = os.path.join(file_path, 'manifest.json')
+    stat = os.stat(file_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def build_usage_index(data):
+    """
+    Builds the cumulative usage index of a dataset.
+
+    Parameters:
+    - data (DataFrame): The dataset containing water flow information.
+
+    Returns:
+    - Dict[str, ndarray]: The sorted unique timestamps, the sorted endpoint sensor IDs, and the
+      (timestamps + 1) x sensors cumulative usage and reading counts, starting with a row of zeros.
+    """
+    endpoints = data[data['type'] == 'Endpoint']
+    timestamp_codes, timestamps = pd.factorize(endpoints['timestamp'], sort=True)
+    sensor_codes, sensor_ids = pd.factorize(endpoints['sensor_id'], sort=True)
+
+    usage = endpoints['water_usage'].to_numpy()
+    # Keep integer readings integral, so that query results have the dtype a groupby sum would give
+    value_dtype = np.int64 if np.issubdtype(usage.dtype, np.integer) else np.float64
+    valid = (timestamp_codes >= 0) & (sensor_codes >= 0) & ~pd.isna(usage)
+
+    cells = timestamp_codes[valid] * len(sensor_ids) + sensor_codes[valid]
+    shape = (len(timestamps), len(sensor_ids))
+    usage_matrix = np.zeros(shape[0] * shape[1], dtype=value_dtype)
+    np.add.at(usage_matrix, cells, usage[valid].astype(value_dtype))
+    count_matrix = np.bincount(cells, minlength=shape[0] * shape[1]).astype(np.int32)
+
+    cumulative_usage = np.zeros((shape[0] + 1, shape[1]), dtype=value_dtype)
+    cumulative_counts = np.zeros((shape[0] + 1, shape[1]), dtype=np.int32)
+    np.cumsum(usage_matrix.reshape(shape), axis=0, out=cumulative_usage[1:])
+    np.cumsum(count_matrix.reshape(shape), axis=0, out=cumulative_counts[1:])
+
+    return {
+        'timestamps': np.asarray(timestamps),
+        'sensor_ids': np.asarray(sensor_ids),
+        'cumulative_usage': cumulative_usage,
+        'cumulative_counts': cumulative_counts,
+    }
+
+def save_usage_index(index, file_path):
+    """
+    Persists a usage index next to its dataset, together with the dataset's fingerprint.
+
+    Parameters:
+    - index (Dict[str, ndarray]): The index from `build_usage_index`.
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    """
+    np.savez(index_path_for(file_path), version=np.array(INDEX_VERSION), source=_source_fingerprint(file_path),
+             timestamps=index['timestamps'].astype(str), sensor_ids=index['sensor_ids'],
+             cumulative_usage=index['cumulative_usage'], cumulative_counts=index['cumulative_counts'])
+
+def load_usage_index(file_path, data=None):
+    """
+    Loads the persisted usage index of a dataset, building and saving it when it is missing or stale.
+
+    Parameters:
+    - file_path (str): Path to the dataset file or columnar dataset directory.
+    - data (DataFrame, optional): The already loaded dataset, used if the index has to be built.
+
+    Returns:
+    - Dict[str, ndarray]: The usage index.
+    """
+    index_path = index_path_for(file_path)
+    if os.path.exists(index_path):
+        with np.load(index_path) as stored:
+            if int(stored['version']) == INDEX_VERSION and np.array_equal(stored['source'], _source_fingerprint(file_path)):
+                return {name: stored[name] for name in ('timestamps', 'sensor_ids', 'cumulative_usage', 'cumulative_counts')}
+
+    index = build_usage_index(read_dataset(file_path) if data is None else data)
+    save_usage_index(index, file_path)
+    return index
+
+def query_usage(index, from_timestamp, to_timestamp):
+    """
+    Calculates the total water usage of every endpoint between two timestamps, both inclusive.
+
+    Parameters:
+    - index (Dict[str, ndarray]): The usage index.
+    - from_timestamp (str): Start of the time range.
+    - to_timestamp (str): End of the time range.
+
+    Returns:
+    - DataFrame: Total water usage per sensor ID of the endpoints with readings in the range,
+      with the same layout as a groupby over the filtered dataset.
+    """
+    timestamps = index['timestamps']
+    first = np.searchsorted(timestamps, from_timestamp, side='left')
+    last = np.searchsorted(timestamps, to_timestamp, side='right')
+    if last < first:
+        last = first
+
+    totals = index['cumulative_usage'][last] - index['cumulative_usage'][first]
+    reported = (index['cumulative_counts'][last] - index['cumulative_counts'][first]) > 0
+
+    return pd.DataFrame({'sensor_id': index['sensor_ids'][reported], 'water_usage': totals[reported]})
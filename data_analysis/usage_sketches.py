@@ -0,0 +1,525 @@
+"""
+usage_sketches.py
+
+Single-pass, fixed-memory summaries of endpoint usage, as an alternative to the exact per-sensor totals of
+`usage_calculation.py` when only the top consumers and the usage distributions are needed, possibly in real time.
+
+- Heavy hitters: a Space-Saving summary keeps the `capacity` sensors with the largest total usage. Every kept
+  total is an upper bound of the true total that overestimates it by at most the recorded error.
+- Quantiles: a DDSketch per device type (Home, Factory, Agricultural_Channel, Fire_Hydrant) answers quantile
+  queries of the hourly readings with a bounded relative error, in a bounded number of logarithmic bins.
+- Rolling window: the readings of every hour are summarized separately, and the summaries of the last hours
+  of the window are merged on demand; older hours are evicted.
+
+Every sketch is updated with whole chunks of rows at once, can be merged with a sketch of other shards, files
+or runs, and can be serialized to JSON and loaded again, so that partial results can be combined later.
+
+Classes:
+- SpaceSaving: Heavy hitters of weighted keys.
+- QuantileSketch: DDSketch of a stream of values.
+- UsageSketch: Heavy hitters of the endpoint totals and quantiles of the readings per device type.
+- RollingUsageSketch: Usage sketches of the last hours of a rolling window.
+
+Functions:
+- save_sketch: Writes a sketch to a JSON file.
+- load_sketch: Reads a sketch from a JSON file.
+- sketch_dataset: Updates a sketch with a dataset in a single pass over its chunks.
+- print_sketch_summary: Prints the top consumers and the quantiles per device type.
+- main: Entry point for building, merging and reporting sketches.
+"""
+
+import argparse
+import json
+import math
+import numpy as np
+import pandas as pd
+
+from data_generation.columnar_dataset import iter_dataset_chunks
+
+SKETCH_VERSION = 1
+SKETCH_COLUMNS = ['timestamp', 'sensor_id', 'type', 'device_type', 'water_usage']
+
+class SpaceSaving:
+    """
+    Space-Saving summary of the keys with the largest total weight, in at most `capacity` counters.
+
+    Batches are summarized exactly and merged into the counters like another summary: the totals of both are
+    added, a key missing from a full summary is counted with that summary's smallest total (and the same error),
+    and the `capacity` largest totals are kept. Every total is thus an upper bound of the key's true total, and
+    the total minus its error is a lower bound.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.float64)
+        self.errors = np.empty(0, dtype=np.float64)
+        self.total = 0.0
+
+    def _floor(self):
+        """ Upper bound of the total of any key that is not kept. """
+        return float(self.counts.min()) if len(self.keys) >= self.capacity else 0.0
+
+    def _merge_arrays(self, keys, counts, errors, floor, total):
+        """ Merges another summary, given as arrays, into this one. """
+        union = np.union1d(self.keys, keys)
+        merged_counts = np.zeros(len(union))
+        merged_errors = np.zeros(len(union))
+        for summary_keys, summary_counts, summary_errors, summary_floor in (
+                (self.keys, self.counts, self.errors, self._floor()), (keys, counts, errors, floor)):
+            positions = np.searchsorted(union, summary_keys)
+            present = np.zeros(len(union), dtype=bool)
+            present[positions] = True
+            merged_counts[~present] += summary_floor
+            merged_errors[~present] += summary_floor
+            merged_counts[positions] += summary_counts
+            merged_errors[positions] += summary_errors
+
+        # Keep the largest totals, breaking ties by key so that the result does not depend on the merge order
+        order = np.lexsort((union, -merged_counts))[:self.capacity]
+        self.keys, self.counts, self.errors = union[order], merged_counts[order], merged_errors[order]
+        self.total += total
+
+    def update(self, keys, weights):
+        """
+        Adds a batch of weighted keys.
+
+        Parameters:
+        - keys (ndarray): Integer keys, e.g. sensor IDs.
+        - weights (ndarray): Non-negative weight of every key occurrence, e.g. its usage.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        valid = ~np.isnan(weights)
+        batch_keys, inverse = np.unique(np.asarray(keys, dtype=np.int64)[valid], return_inverse=True)
+        batch_counts = np.bincount(inverse, weights=weights[valid], minlength=len(batch_keys))
+        self._merge_arrays(batch_keys, batch_counts, np.zeros(len(batch_keys)), 0.0, float(batch_counts.sum()))
+
+    def merge(self, other):
+        """
+        Merges another summary into this one.
+
+        Parameters:
+        - other (SpaceSaving): A summary of another part of the stream.
+        """
+        self._merge_arrays(other.keys, other.counts, other.errors, other._floor(), other.total)
+
+    def top(self, k=10):
+        """
+        Returns the keys with the largest totals.
+
+        Parameters:
+        - k (int): Number of keys.
+
+        Returns:
+        - DataFrame: The key, estimated total and maximum overestimate of the top `k` keys, largest first.
+        """
+        return pd.DataFrame({'sensor_id': self.keys[:k], 'water_usage': self.counts[:k], 'error': self.errors[:k]})
+
+    def to_dict(self):
+        """ Returns the summary as a JSON-serializable dictionary. """
+        return {'capacity': self.capacity, 'keys': self.keys.tolist(), 'counts': self.counts.tolist(),
+                'errors': self.errors.tolist(), 'total': self.total}
+
+    @classmethod
+    def from_dict(cls, state):
+        """ Restores a summary from `to_dict` output. """
+        summary = cls(state['capacity'])
+        summary.keys = np.asarray(state['keys'], dtype=np.int64)
+        summary.counts = np.asarray(state['counts'], dtype=np.float64)
+        summary.errors = np.asarray(state['errors'], dtype=np.float64)
+        summary.total = state['total']
+        return summary
+
+class QuantileSketch:
+    """
+    DDSketch of a stream of values: quantiles with a relative error of at most `relative_accuracy`.
+
+    Values are counted in logarithmic bins, bin i holding the values in (gamma^(i-1), gamma^i] with
+    gamma = (1 + accuracy) / (1 - accuracy); negative values are binned by magnitude and values near zero
+    counted apart. When a store exceeds `max_bins`, its bins of smallest magnitude are collapsed into one,
+    which only affects the accuracy of the lowest quantiles.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _add_bins(self, store, magnitudes):
+        """ Counts magnitudes in the bins of a store. """
+        indexes, counts = np.unique(np.ceil(np.log(magnitudes) / np.log(self.gamma)).astype(np.int64), return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+        self._collapse(store)
+
+    def _collapse(self, store):
+        """ Folds the bins of smallest magnitude into one until the store fits in `max_bins`. """
+        if len(store) > self.max_bins:
+            indexes = sorted(store)
+            folded = indexes[:len(indexes) - self.max_bins + 1]
+            store[folded[-1]] = sum(store.pop(index) for index in folded[:-1]) + store[folded[-1]]
+
+    def update(self, values):
+        """
+        Adds a batch of values; missing values are ignored.
+
+        Parameters:
+        - values (ndarray): The values.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        tiny = np.finfo(np.float64).tiny
+        self._add_bins(self.positive, values[values > tiny])
+        self._add_bins(self.negative, -values[values < -tiny])
+        self.zero_count += int(np.count_nonzero(np.abs(values) <= tiny))
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        """
+        Merges another sketch with the same relative accuracy into this one.
+
+        Parameters:
+        - other (QuantileSketch): A sketch of another part of the stream.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only quantile sketches with the same relative accuracy can be merged.")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+            self._collapse(store)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Estimates a quantile.
+
+        Parameters:
+        - q (float): The quantile, between 0 and 1.
+
+        Returns:
+        - float: The estimated value, or NaN for an empty sketch.
+        """
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        # Ascending values: negative bins from the largest magnitude down, the zeros, then the positive bins
+        bins = [(-index, self.negative[index], -1) for index in sorted(self.negative, reverse=True)]
+        bins.append((None, self.zero_count, 0))
+        bins += [(index, self.positive[index], 1) for index in sorted(self.positive)]
+        for index, count, sign in bins:
+            seen += count
+            if seen > rank:
+                if sign == 0:
+                    return 0.0
+                magnitude = 2 * self.gamma ** (sign * index) / (self.gamma + 1)
+                return min(max(sign * magnitude, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        """ Returns the sketch as a JSON-serializable dictionary. """
+        return {'relative_accuracy': self.relative_accuracy, 'max_bins': self.max_bins,
+                'positive': {str(index): count for index, count in self.positive.items()},
+                'negative': {str(index): count for index, count in self.negative.items()},
+                'zero_count': self.zero_count, 'count': self.count, 'sum': self.sum,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, state):
+        """ Restores a sketch from `to_dict` output. """
+        sketch = cls(state['relative_accuracy'], state['max_bins'])
+        sketch.positive = {int(index): count for index, count in state['positive'].items()}
+        sketch.negative = {int(index): count for index, count in state['negative'].items()}
+        sketch.zero_count, sketch.count, sketch.sum = state['zero_count'], state['count'], state['sum']
+        if sketch.count:
+            sketch.min, sketch.max = state['min'], state['max']
+        return sketch
+
+class UsageSketch:
+    """
+    Fixed-memory summary of endpoint readings: the heavy hitters of the per-sensor usage totals and the
+    distribution of the readings of every device type.
+    """
+
+    def __init__(self, capacity=100, relative_accuracy=0.01):
+        self.capacity = capacity
+        self.relative_accuracy = relative_accuracy
+        self.heavy_hitters = SpaceSaving(capacity)
+        self.device_quantiles = {}
+        self.rows = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def update(self, chunk):
+        """
+        Adds a chunk of dataset rows; only endpoint readings are summarized.
+
+        Parameters:
+        - chunk (DataFrame): Rows with at least the timestamp, sensor_id, type, device_type and water_usage columns.
+        """
+        endpoints = chunk[(chunk['type'] == 'Endpoint').to_numpy()]
+        if not len(endpoints):
+            return
+        usage = endpoints['water_usage'].to_numpy(dtype=np.float64, na_value=np.nan)
+        self.heavy_hitters.update(endpoints['sensor_id'].to_numpy(), usage)
+
+        device_codes, device_types = pd.factorize(endpoints['device_type'])
+        for code, device_type in enumerate(device_types):
+            sketch = self.device_quantiles.get(device_type)
+            if sketch is None:
+                sketch = self.device_quantiles[device_type] = QuantileSketch(self.relative_accuracy)
+            sketch.update(usage[device_codes == code])
+
+        self.rows += len(endpoints)
+        first, last = endpoints['timestamp'].min(), endpoints['timestamp'].max()
+        self.first_timestamp = first if self.first_timestamp is None else min(self.first_timestamp, first)
+        self.last_timestamp = last if self.last_timestamp is None else max(self.last_timestamp, last)
+
+    def merge(self, other):
+        """
+        Merges another usage sketch into this one.
+
+        Parameters:
+        - other (UsageSketch): A sketch of other shards, files or runs.
+        """
+        self.heavy_hitters.merge(other.heavy_hitters)
+        for device_type, sketch in other.device_quantiles.items():
+            if device_type in self.device_quantiles:
+                self.device_quantiles[device_type].merge(sketch)
+            else:
+                self.device_quantiles[device_type] = QuantileSketch.from_dict(sketch.to_dict())
+        self.rows += other.rows
+        for name, pick in (('first_timestamp', min), ('last_timestamp', max)):
+            values = [value for value in (getattr(self, name), getattr(other, name)) if value is not None]
+            setattr(self, name, pick(values) if values else None)
+
+    def quantiles(self, qs=(0.5, 0.9, 0.99)):
+        """
+        Estimates quantiles of the readings of every device type.
+
+        Parameters:
+        - qs (Sequence[float]): The quantiles.
+
+        Returns:
+        - DataFrame: One row per device type with its reading count, mean and the estimated quantiles.
+        """
+        rows = []
+        for device_type in sorted(self.device_quantiles):
+            sketch = self.device_quantiles[device_type]
+            row = {'device_type': device_type, 'readings': sketch.count,
+                   'mean': sketch.sum / sketch.count if sketch.count else math.nan}
+            row.update({f"q{q:g}": sketch.quantile(q) for q in qs})
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def to_dict(self):
+        """ Returns the sketch as a JSON-serializable dictionary. """
+        return {'kind': 'usage', 'capacity': self.capacity, 'relative_accuracy': self.relative_accuracy,
+                'heavy_hitters': self.heavy_hitters.to_dict(),
+                'device_quantiles': {name: sketch.to_dict() for name, sketch in self.device_quantiles.items()},
+                'rows': self.rows, 'first_timestamp': self.first_timestamp, 'last_timestamp': self.last_timestamp}
+
+    @classmethod
+    def from_dict(cls, state):
+        """ Restores a sketch from `to_dict` output. """
+        sketch = cls(state['capacity'], state['relative_accuracy'])
+        sketch.heavy_hitters = SpaceSaving.from_dict(state['heavy_hitters'])
+        sketch.device_quantiles = {name: QuantileSketch.from_dict(quantile_state)
+                                   for name, quantile_state in state['device_quantiles'].items()}
+        sketch.rows = state['rows']
+        sketch.first_timestamp, sketch.last_timestamp = state['first_timestamp'], state['last_timestamp']
+        return sketch
+
+class RollingUsageSketch:
+    """
+    Usage sketches of the last `window_hours` hours: one sketch per hour, merged when the window is queried.
+    Hours that fall out of the window behind the latest reading are evicted, so memory stays bounded.
+    """
+
+    def __init__(self, window_hours=24, capacity=100, relative_accuracy=0.01):
+        self.window_hours = window_hours
+        self.capacity = capacity
+        self.relative_accuracy = relative_accuracy
+        # Hour ('YYYY-MM-DD HH') -> UsageSketch of the readings of that hour
+        self.hours = {}
+
+    def _evict(self):
+        """ Drops the hourly sketches that are outside of the window. """
+        if self.hours:
+            latest = pd.Timestamp(max(self.hours) + ':00')
+            oldest = (latest - pd.Timedelta(hours=self.window_hours - 1)).strftime('%Y-%m-%d %H')
+            for hour in [hour for hour in self.hours if hour < oldest]:
+                del self.hours[hour]
+
+    def update(self, chunk):
+        """
+        Adds a chunk of dataset rows to the sketches of their hours.
+
+        Parameters:
+        - chunk (DataFrame): Rows with at least the timestamp, sensor_id, type, device_type and water_usage columns.
+        """
+        # Timestamps are 'YYYY-MM-DD HH:MM:SS' strings, so the hour is their first thirteen characters
+        codes, uniques = pd.factorize(np.asarray(chunk['timestamp']))
+        hour_of_code = np.asarray([timestamp[:13] for timestamp in uniques], dtype=object)
+        hour_codes, hours = pd.factorize(hour_of_code[codes])
+        for code, hour in enumerate(hours):
+            sketch = self.hours.get(hour)
+            if sketch is None:
+                sketch = self.hours[hour] = UsageSketch(self.capacity, self.relative_accuracy)
+            sketch.update(chunk[hour_codes == code])
+        self._evict()
+
+    def merge(self, other):
+        """
+        Merges another rolling sketch into this one, hour by hour.
+
+        Parameters:
+        - other (RollingUsageSketch): A rolling sketch of other shards, files or runs.
+        """
+        for hour, sketch in other.hours.items():
+            if hour in self.hours:
+                self.hours[hour].merge(sketch)
+            else:
+                self.hours[hour] = UsageSketch.from_dict(sketch.to_dict())
+        self._evict()
+
+    def window(self):
+        """
+        Merges the hourly sketches of the window.
+
+        Returns:
+        - UsageSketch: The sketch of all readings in the window.
+        """
+        merged = UsageSketch(self.capacity, self.relative_accuracy)
+        for hour in sorted(self.hours):
+            merged.merge(self.hours[hour])
+        return merged
+
+    def to_dict(self):
+        """ Returns the rolling sketch as a JSON-serializable dictionary. """
+        return {'kind': 'rolling', 'window_hours': self.window_hours, 'capacity': self.capacity,
+                'relative_accuracy': self.relative_accuracy,
+                'hours': {hour: sketch.to_dict() for hour, sketch in sorted(self.hours.items())}}
+
+    @classmethod
+    def from_dict(cls, state):
+        """ Restores a rolling sketch from `to_dict` output. """
+        sketch = cls(state['window_hours'], state['capacity'], state['relative_accuracy'])
+        sketch.hours = {hour: UsageSketch.from_dict(hour_state) for hour, hour_state in state['hours'].items()}
+        return sketch
+
+def save_sketch(sketch, path):
+    """
+    Writes a usage sketch or rolling usage sketch to a JSON file.
+
+    Parameters:
+    - sketch (UsageSketch or RollingUsageSketch): The sketch.
+    - path (str): Path of the JSON file.
+    """
+    with open(path, 'w') as sketch_file:
+        json.dump(dict(sketch.to_dict(), version=SKETCH_VERSION), sketch_file)
+
+def load_sketch(path):
+    """
+    Reads a sketch written by `save_sketch`.
+
+    Parameters:
+    - path (str): Path of the JSON file.
+
+    Returns:
+    - UsageSketch or RollingUsageSketch: The sketch.
+    """
+    with open(path) as sketch_file:
+        state = json.load(sketch_file)
+    if state.get('version') != SKETCH_VERSION:
+        raise ValueError(f"Unsupported sketch version in {path}")
+    return (RollingUsageSketch if state['kind'] == 'rolling' else UsageSketch).from_dict(state)
+
+def sketch_dataset(sketch, file_path, chunksize=100000):
+    """
+    Updates a sketch with the rows of a dataset in a single pass over its chunks.
+
+    Parameters:
+    - sketch (UsageSketch or RollingUsageSketch): The sketch to update.
+    - file_path (str): Path to the CSV dataset file or columnar dataset directory.
+    - chunksize (int): Number of rows read per chunk.
+
+    Returns:
+    - UsageSketch or RollingUsageSketch: The updated sketch.
+    """
+    for chunk in iter_dataset_chunks(file_path, chunksize, usecols=SKETCH_COLUMNS):
+        sketch.update(chunk)
+    return sketch
+
+def print_sketch_summary(sketch, top_k=10, qs=(0.5, 0.9, 0.99)):
+    """
+    Prints the top consumers and the usage quantiles per device type of a sketch.
+
+    Parameters:
+    - sketch (UsageSketch or RollingUsageSketch): The sketch; a rolling sketch is reported for its window.
+    - top_k (int): Number of top consumers.
+    - qs (Sequence[float]): The quantiles.
+    """
+    if isinstance(sketch, RollingUsageSketch):
+        print(f"Rolling window of {sketch.window_hours} hours ({len(sketch.hours)} hours with readings)")
+        sketch = sketch.window()
+    print(f"Endpoint readings: {sketch.rows} from {sketch.first_timestamp} to {sketch.last_timestamp}")
+    print(f"Top {top_k} consumers (usage is an upper bound, at most 'error' too high):")
+    print(sketch.heavy_hitters.top(top_k).to_string(index=False))
+    print("Usage quantiles per device type:")
+    print(sketch.quantiles(qs).to_string(index=False))
+
+def main(argv=None):
+    """
+    Main function to build usage sketches of datasets, merge them with saved sketches and report them.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+    """
+    parser = argparse.ArgumentParser(description="Summarize endpoint usage with mergeable heavy-hitter and quantile sketches.")
+    parser.add_argument('file_paths', nargs='*', help="Datasets to add to the sketch, in a single pass each.")
+    parser.add_argument('--merge', nargs='+', default=[], metavar='SKETCH', help="Saved sketches to merge in.")
+    parser.add_argument('--save', default=None, help="Write the resulting sketch to this JSON file.")
+    parser.add_argument('--window-hours', type=int, default=None,
+                        help="Only summarize the last hours of the data in a rolling window (default: all data).")
+    parser.add_argument('--capacity', type=int, default=100, help="Number of sensors kept by the heavy-hitter summary.")
+    parser.add_argument('--accuracy', type=float, default=0.01, help="Relative accuracy of the quantile sketches.")
+    parser.add_argument('--chunksize', type=int, default=100000, help="Number of rows read per chunk.")
+    parser.add_argument('--top-k', type=int, default=10, help="Number of top consumers reported.")
+    parser.add_argument('--quantiles', type=float, nargs='+', default=[0.5, 0.9, 0.99], help="Quantiles reported.")
+    args = parser.parse_args(argv)
+
+    if args.window_hours:
+        sketch = RollingUsageSketch(args.window_hours, args.capacity, args.accuracy)
+    else:
+        sketch = UsageSketch(args.capacity, args.accuracy)
+    for path in args.merge:
+        saved = load_sketch(path)
+        if type(saved) is not type(sketch):
+            raise ValueError(f"{path} is not a {'rolling ' if args.window_hours else ''}usage sketch")
+        sketch.merge(saved)
+    for file_path in args.file_paths:
+        sketch_dataset(sketch, file_path, args.chunksize)
+
+    if args.save:
+        save_sketch(sketch, args.save)
+    print_sketch_summary(sketch, args.top_k, args.quantiles)
+
+if __name__ == "__main__":
+    main()
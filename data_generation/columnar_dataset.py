@@ -0,0 +1,389 @@
+"""
+columnar_dataset.py
+
+Reads and writes water distribution datasets in a normalized, columnar binary format.
+
+A columnar dataset is a directory holding:
+- manifest.json: Format version, row count, compression flag and the label dictionaries.
+- timestamps.npy: Sorted unique timestamps as int64 epoch seconds.
+- timestamp_index.npy, sensor_id.npy, water_usage.npy: The readings table, one entry per reading
+  (int32 index into the timestamps table, int32 sensor ID, float32 usage). These files are memory-mapped on read.
+- topology.npz: One row per sensor with its path to master and its dictionary-encoded type and device type.
+
+With compression enabled the readings table is stored in a single compressed readings.npz instead,
+which is smaller on disk but has to be decompressed into memory when read.
+
+CSV datasets can be read through a sidecar cache: the first typed read of `<dataset>.csv` also
+writes the parsed table as a columnar dataset to `<dataset>.csv.cache/`, keyed by the CSV's size,
+modification time and SHA-256 content hash, and later reads memory-map it instead of parsing the text.
+The cache is rebuilt automatically when the CSV changes. Unlike a converted dataset it is lossless:
+usage is only stored as float32 when that represents every value exactly, and is read back with the
+dtype a CSV read would give, so results computed from the cache are identical to those from the CSV.
+
+Functions:
+- write_columnar_dataset: Writes rows or a DataFrame to a columnar dataset directory.
+- convert_csv_to_columnar: Converts a CSV dataset into a columnar dataset directory, reading it in chunks.
+- is_columnar_dataset: Checks whether a path is a columnar dataset directory.
+- read_columnar_dataset: Reads a columnar dataset into a DataFrame with the CSV layout.
+- cache_path_for: Returns the path of the sidecar cache of a CSV dataset.
+- write_dataset_cache: Writes the sidecar cache of a parsed CSV dataset.
+- read_dataset: Reads a CSV or columnar dataset into a DataFrame, optionally through the sidecar cache.
+- iter_dataset_chunks: Reads a CSV or columnar dataset in chunks of rows.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+FORMAT_NAME = 'water-distribution-columnar'
+FORMAT_VERSION = 1
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+COLUMNS = ['timestamp', 'sensor_id', 'path_to_master', 'type', 'device_type', 'water_usage']
+READING_ARRAYS = ['timestamp_index', 'sensor_id', 'water_usage']
+
+# Explicit schema for parsing CSV datasets, instead of inferring it and keeping the labels as object strings
+CSV_DTYPES = {'sensor_id': np.int32, 'path_to_master': 'category', 'type': 'category', 'device_type': 'category'}
+CACHE_VERSION = 1
+
+def _to_epoch(timestamps):
+    """ Converts timestamp strings to int64 epoch seconds. """
+    return pd.to_datetime(pd.Series(timestamps), format=TIMESTAMP_FORMAT).to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+def _from_epoch(epochs):
+    """ Converts int64 epoch seconds to timestamp strings. """
+    return pd.to_datetime(np.asarray(epochs), unit='s').strftime(TIMESTAMP_FORMAT)
+
+def _lossless_usage(water_usage):
+    """ Returns the usage as float32 if that represents every value exactly, otherwise unchanged. """
+    if np.issubdtype(water_usage.dtype, np.floating):
+        narrowed = water_usage.astype(np.float32)
+        if np.array_equal(narrowed.astype(water_usage.dtype), water_usage, equal_nan=True):
+            return narrowed
+    return water_usage
+
+def _encode_readings(data, lossless=False):
+    """ Splits a DataFrame with the CSV layout into reading arrays and its topology rows. """
+    epochs = _to_epoch(data['timestamp'])
+    water_usage = data['water_usage'].to_numpy()
+    readings = {
+        'epoch': epochs,
+        'sensor_id': data['sensor_id'].to_numpy(dtype=np.int32),
+        'water_usage': _lossless_usage(water_usage) if lossless else water_usage.astype(np.float32),
+    }
+    topology = data[['sensor_id', 'path_to_master', 'type', 'device_type']].drop_duplicates('sensor_id')
+    return readings, topology
+
+def _write_tables(directory, epochs, sensor_ids, water_usage, topology, compress):
+    """ Writes the readings table, the timestamps table, the topology and the manifest to a directory. """
+    os.makedirs(directory, exist_ok=True)
+
+    timestamps, timestamp_index = np.unique(epochs, return_inverse=True)
+    timestamp_index = timestamp_index.astype(np.int32)
+    np.save(os.path.join(directory, 'timestamps.npy'), timestamps.astype(np.int64))
+
+    if compress:
+        np.savez_compressed(os.path.join(directory, 'readings.npz'), timestamp_index=timestamp_index,
+                            sensor_id=sensor_ids, water_usage=water_usage)
+    else:
+        np.save(os.path.join(directory, 'timestamp_index.npy'), timestamp_index)
+        np.save(os.path.join(directory, 'sensor_id.npy'), sensor_ids)
+        np.save(os.path.join(directory, 'water_usage.npy'), water_usage)
+
+    # Dictionary-encode the labels so that every reading only refers to its sensor ID
+    topology = topology.drop_duplicates('sensor_id').sort_values('sensor_id')
+    type_codes, types = pd.factorize(topology['type'])
+    device_type_codes, device_types = pd.factorize(topology['device_type'])
+    np.savez(os.path.join(directory, 'topology.npz'),
+             sensor_id=topology['sensor_id'].to_numpy(dtype=np.int32),
+             path_to_master=topology['path_to_master'].to_numpy(dtype=str),
+             type=type_codes.astype(np.int8),
+             device_type=device_type_codes.astype(np.int8))
+
+    manifest = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'rows': int(len(sensor_ids)),
+        'compressed': bool(compress),
+        'types': [str(value) for value in types],
+        'device_types': [str(value) for value in device_types],
+    }
+    with open(os.path.join(directory, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+def write_columnar_dataset(data, directory, compress=False):
+    """
+    Writes simulated data to a columnar dataset directory.
+
+    Parameters:
+    - data (List[Dict] or DataFrame): Rows with the CSV dataset fields, as produced by `simulate_network`.
+    - directory (str): Path of the dataset directory to create.
+    - compress (bool): Store the readings table compressed instead of memory-mappable.
+    """
+    if not isinstance(data, pd.DataFrame):
+        data = pd.DataFrame(data, columns=COLUMNS)
+    readings, topology = _encode_readings(data)
+    _write_tables(directory, readings['epoch'], readings['sensor_id'], readings['water_usage'], topology, compress)
+
+def convert_csv_to_columnar(csv_path, directory, compress=False, chunksize=1000000):
+    """
+    Converts a CSV dataset into a columnar dataset directory.
+
+    Parameters:
+    - csv_path (str): Path to the CSV dataset.
+    - directory (str): Path of the dataset directory to create.
+    - compress (bool): Store the readings table compressed instead of memory-mappable.
+    - chunksize (int): Number of CSV rows parsed at a time.
+    """
+    epochs = []
+    sensor_ids = []
+    water_usage = []
+    topologies = []
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        readings, topology = _encode_readings(chunk)
+        epochs.append(readings['epoch'])
+        sensor_ids.append(readings['sensor_id'])
+        water_usage.append(readings['water_usage'])
+        topologies.append(topology)
+
+    if not topologies:
+        raise ValueError(f"The dataset {csv_path} does not contain any readings.")
+
+    _write_tables(directory, np.concatenate(epochs), np.concatenate(sensor_ids), np.concatenate(water_usage),
+                  pd.concat(topologies), compress)
+
+def is_columnar_dataset(path):
+    """
+    Checks whether a path is a columnar dataset directory.
+
+    Parameters:
+    - path (str): Path to check.
+
+    Returns:
+    - bool: True if the path is a directory with a columnar dataset manifest.
+    """
+    return os.path.isfile(os.path.join(path, 'manifest.json'))
+
+def _load_tables(directory, mmap=True):
+    """ Loads the manifest, timestamps table, reading arrays and topology of a columnar dataset. """
+    with open(os.path.join(directory, 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('format') != FORMAT_NAME or manifest.get('version') != FORMAT_VERSION:
+        raise ValueError(f"{directory} is not a version {FORMAT_VERSION} columnar dataset.")
+
+    mmap_mode = 'r' if mmap else None
+    timestamps = np.load(os.path.join(directory, 'timestamps.npy'))
+    if manifest['compressed']:
+        with np.load(os.path.join(directory, 'readings.npz')) as archive:
+            readings = {name: archive[name] for name in READING_ARRAYS}
+    else:
+        readings = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in READING_ARRAYS}
+    with np.load(os.path.join(directory, 'topology.npz')) as archive:
+        topology = {name: archive[name] for name in archive.files}
+
+    return manifest, timestamps, readings, topology
+
+def _decode_readings(manifest, timestamp_strings, readings, topology, rows=slice(None)):
+    """ Rebuilds a DataFrame with the CSV layout from a slice of the reading arrays. """
+    timestamp_index = np.asarray(readings['timestamp_index'][rows])
+    sensor_ids = np.asarray(readings['sensor_id'][rows])
+
+    # Look up every reading's sensor in the topology and expand the dictionary-encoded labels
+    positions = np.searchsorted(topology['sensor_id'], sensor_ids)
+    path_codes, paths = pd.factorize(topology['path_to_master'])
+
+    return pd.DataFrame({
+        'timestamp': timestamp_strings.take(timestamp_index),
+        'sensor_id': sensor_ids,
+        'path_to_master': pd.Categorical.from_codes(path_codes[positions], categories=paths),
+        'type': pd.Categorical.from_codes(topology['type'][positions], categories=manifest['types']),
+        'device_type': pd.Categorical.from_codes(topology['device_type'][positions], categories=manifest['device_types']),
+        'water_usage': np.asarray(readings['water_usage'][rows]),
+    })
+
+def read_columnar_dataset(directory, mmap=True):
+    """
+    Reads a columnar dataset into a DataFrame with the same columns as the CSV dataset.
+
+    Parameters:
+    - directory (str): Path of the dataset directory.
+    - mmap (bool): Memory-map the readings table instead of reading it into memory.
+
+    Returns:
+    - DataFrame: The dataset, with categorical labels and paths.
+    """
+    manifest, timestamps, readings, topology = _load_tables(directory, mmap)
+    return _decode_readings(manifest, pd.Index(_from_epoch(timestamps)), readings, topology)
+
+def cache_path_for(csv_path):
+    """
+    Returns the path of the sidecar cache of a CSV dataset.
+
+    Parameters:
+    - csv_path (str): Path to the CSV dataset.
+
+    Returns:
+    - str: Path of the cache directory.
+    """
+    return os.path.normpath(csv_path) + '.cache'
+
+def _source_key(csv_path):
+    """ Returns the size and modification time of a CSV dataset. """
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _content_hash(csv_path, block_size=1 << 20):
+    """ Returns the SHA-256 hash of the content of a file. """
+    digest = hashlib.sha256()
+    with open(csv_path, 'rb') as source:
+        while block := source.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _valid_cache(csv_path, verify=False):
+    """
+    Returns the path of the CSV dataset's cache if it matches the CSV, or None.
+
+    A cache whose size and modification time match is used as is, unless `verify` asks for the content
+    hash to be checked too. When only the modification time differs, e.g. after the file was copied or
+    touched, the content hash decides, and a matching cache is re-keyed to the new modification time.
+    """
+    cache_path = cache_path_for(csv_path)
+    try:
+        with open(os.path.join(cache_path, 'source.json')) as source_file:
+            source = json.load(source_file)
+    except (OSError, ValueError):
+        return None
+
+    key = _source_key(csv_path)
+    if source.get('version') != CACHE_VERSION or source.get('size') != key['size']:
+        return None
+    if source.get('mtime_ns') == key['mtime_ns'] and not verify:
+        return cache_path
+    if source.get('sha256') != _content_hash(csv_path):
+        return None
+    if source['mtime_ns'] != key['mtime_ns']:
+        source['mtime_ns'] = key['mtime_ns']
+        with open(os.path.join(cache_path, 'source.json'), 'w') as source_file:
+            json.dump(source, source_file, indent=2)
+    return cache_path
+
+def write_dataset_cache(data, csv_path):
+    """
+    Writes the sidecar cache of a parsed CSV dataset, keyed by the CSV's size, modification time and content hash.
+
+    The cache is written to a temporary directory first and then moved into place, so readers never see a partial cache.
+
+    Parameters:
+    - data (DataFrame): The dataset as parsed from the CSV.
+    - csv_path (str): Path to the CSV dataset.
+
+    Returns:
+    - str: Path of the cache directory.
+    """
+    cache_path = cache_path_for(csv_path)
+    key = _source_key(csv_path)
+    source = {'version': CACHE_VERSION, **key, 'sha256': _content_hash(csv_path),
+              'water_usage_dtype': data['water_usage'].dtype.str}
+
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    readings, topology = _encode_readings(data, lossless=True)
+    _write_tables(temp_path, readings['epoch'], readings['sensor_id'], readings['water_usage'], topology, compress=False)
+    with open(os.path.join(temp_path, 'source.json'), 'w') as source_file:
+        json.dump(source, source_file, indent=2)
+
+    if os.path.isdir(cache_path):
+        shutil.rmtree(cache_path)
+    os.replace(temp_path, cache_path)
+    return cache_path
+
+def _cached_usage_dtype(cache_path):
+    """ Returns the dtype the usage column of the cached CSV had when it was parsed. """
+    with open(os.path.join(cache_path, 'source.json')) as source_file:
+        return np.dtype(json.load(source_file)['water_usage_dtype'])
+
+def _read_cache(cache_path):
+    """ Reads a sidecar cache back into a DataFrame with the dtypes of a typed CSV read. """
+    usage_dtype = _cached_usage_dtype(cache_path)
+    data = read_columnar_dataset(cache_path)
+    if data['water_usage'].dtype != usage_dtype:
+        data['water_usage'] = data['water_usage'].astype(usage_dtype)
+    return data
+
+def read_dataset(path, cache=False, verify_cache=False):
+    """
+    Reads a dataset stored either as CSV or as a columnar dataset directory.
+
+    CSV datasets are parsed with an explicit schema: int32 sensor IDs and categorical paths, types and
+    device types. With `cache`, they are read from their sidecar cache when it is up to date, and the
+    cache is written after parsing otherwise.
+
+    Parameters:
+    - path (str): Path to the CSV file or the dataset directory.
+    - cache (bool): Read CSV datasets through their sidecar cache, creating or refreshing it as needed.
+    - verify_cache (bool): Check the CSV's content hash even when its size and modification time match the cache.
+
+    Returns:
+    - DataFrame: The dataset.
+    """
+    if is_columnar_dataset(path):
+        return read_columnar_dataset(path)
+    if cache:
+        cache_path = _valid_cache(path, verify_cache)
+        if cache_path is not None:
+            return _read_cache(cache_path)
+
+    data = pd.read_csv(path, dtype=CSV_DTYPES)
+    if cache:
+        try:
+            write_dataset_cache(data, path)
+        except (OSError, ValueError) as error:
+            # A read-only dataset location, or timestamps the cache format cannot encode, only cost the speed-up
+            print(f"Could not write the dataset cache for {path}: {error}")
+    return data
+
+def iter_dataset_chunks(path, chunksize, usecols=None):
+    """
+    Reads a dataset stored either as CSV or as a columnar dataset directory in chunks of rows.
+
+    Parameters:
+    - path (str): Path to the CSV file or the dataset directory.
+    - chunksize (int): Number of rows per chunk.
+    - usecols (List[str], optional): Columns to read.
+
+    Yields:
+    - DataFrame: The next chunk of rows.
+    """
+    if not is_columnar_dataset(path):
+        cache_path = _valid_cache(path)
+        if cache_path is None:
+            yield from pd.read_csv(path, chunksize=chunksize, usecols=usecols,
+                                   dtype={column: dtype for column, dtype in CSV_DTYPES.items() if usecols is None or column in usecols})
+            return
+        # An up-to-date sidecar cache is read instead of parsing the CSV again
+        usage_dtype = _cached_usage_dtype(cache_path)
+        path = cache_path
+    else:
+        usage_dtype = None
+
+    manifest, timestamps, readings, topology = _load_tables(path)
+    timestamp_strings = pd.Index(_from_epoch(timestamps))
+    for start in range(0, manifest['rows'], chunksize):
+        chunk = _decode_readings(manifest, timestamp_strings, readings, topology, slice(start, start + chunksize))
+        if usage_dtype is not None:
+            chunk['water_usage'] = chunk['water_usage'].astype(usage_dtype)
+        yield chunk if usecols is None else chunk[list(usecols)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a CSV dataset into a columnar dataset directory.")
+    parser.add_argument('csv_path', help="Path to the CSV dataset.")
+    parser.add_argument('directory', help="Path of the columnar dataset directory to create.")
+    parser.add_argument('--compress', action='store_true', help="Compress the readings table.")
+    parser.add_argument('--chunksize', type=int, default=1000000, help="Number of CSV rows parsed at a time.")
+    args = parser.parse_args()
+
+    convert_csv_to_columnar(args.csv_path, args.directory, compress=args.compress, chunksize=args.chunksize)
+    print(f"Columnar dataset written: {args.directory}")
@@ -10,15 +10,34 @@ Classes:
 
 Functions:
 - create_junctions_and_endpoints: Sets up the network structure with master and local junctions.
+- iter_simulate_network: Simulates the network, yielding the rows of one time step at a time.
 - simulate_network: Simulates the network operation over a given time, considering potential leakages.
-- output_dataset: Outputs the simulated data to a CSV file.
+- simulate_network_vectorized: Simulates the network with the vectorized NumPy kernel.
+- output_dataset: Outputs the simulated data (rows, row blocks or a DataFrame) to a CSV file or a columnar dataset directory.
 """
 
+import argparse
 import random
 import csv
 from datetime import datetime, timedelta
+import pandas as pd
+
+from data_generation.columnar_dataset import write_columnar_dataset
+from data_generation.instrumentation import add_metrics_arguments, count, metrics_session, stage, timed_iter
+from data_generation.parallel_generation import generate_dataset_parallel
+from data_generation.streaming_writer import write_csv_blocks
+from data_generation.network_topology import NetworkTopology, build_topology, parse_endpoint_mix
+from data_generation.vectorized_simulation import simulate_network_arrays
 
 class Endpoint:
+    # Usage probability and maximum usage per endpoint type
+    USAGE_PARAMETERS = {
+        'Home': (0.7, 100),
+        'Factory': (0.8, 500),
+        'Agricultural_Channel': (0.6, 400),
+        'Fire_Hydrant': (0.01, 1000)
+    }
+
     def __init__(self, endpoint_type, sensor_id, path_to_master):
         self.endpoint_type = endpoint_type
         self.sensor_id = sensor_id
@@ -27,13 +46,7 @@ class Endpoint:
         self.water_usage = 0
 
     def set_usage_parameters(self):
-        parameters = {
-            'Home': (0.7, 100),
-            'Factory': (0.8, 500),
-            'Agricultural_Channel': (0.6, 400),
-            'Fire_Hydrant': (0.01, 1000)
-        }
-        return parameters[self.endpoint_type]
+        return self.USAGE_PARAMETERS[self.endpoint_type]
 
     def simulate_water_usage(self):
         if random.random() < self.usage_probability:
@@ -108,12 +121,13 @@ def create_junctions_and_endpoints(master_sensor_id):
 
     return local_junctions, master_junction
 
-def simulate_network(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent):
+def iter_simulate_network(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent):
     local_junctions, master_junction = create_junctions_and_endpoints(master_sensor_id)
-    data = []
     current_time = start_time
 
     for _ in range(time_units):
+        block = []
+
         # Simulate water usage and calculate flow at local junctions and the master junction
         for lj in local_junctions:
             for endpoint in lj.connected_endpoints:
@@ -134,7 +148,7 @@ def simulate_network(time_units, start_time, master_sensor_id, leakage_probabili
                     'device_type': endpoint.endpoint_type,
                     'water_usage': endpoint.water_usage
                 }
-                data.append(endpoint_data)
+                block.append(endpoint_data)
 
             junction_data = {
                 'timestamp': current_time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -144,7 +158,7 @@ def simulate_network(time_units, start_time, master_sensor_id, leakage_probabili
                 'device_type': 'Local',
                 'water_usage': lj.outflow
             }
-            data.append(junction_data)
+            block.append(junction_data)
 
         # Record data for master junction
         master_data = {
@@ -155,29 +169,114 @@ def simulate_network(time_units, start_time, master_sensor_id, leakage_probabili
             'device_type': 'Master',
             'water_usage': master_junction.outflow
         }
-        data.append(master_data)
+        block.append(master_data)
 
         current_time += timedelta(hours=1)
+        yield block
 
-
+def simulate_network(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent):
+    # Collect the rows of every time step; use iter_simulate_network to keep memory constant on long runs
+    data = []
+    for block in iter_simulate_network(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent):
+        data.extend(block)
     return data
 
-def output_dataset(data, filename):
+def simulate_network_vectorized(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent, seed=None, topology=None):
+    if topology is None:
+        topology = NetworkTopology.from_junctions(*create_junctions_and_endpoints(master_sensor_id))
+    # Draw the whole time x endpoint usage matrix at once, with leakage injected at every junction level
+    return simulate_network_arrays(topology, Endpoint.USAGE_PARAMETERS, time_units, start_time, seed=seed,
+                                   leakage_probability=leakage_probability, max_leakage_percent=max_leakage_percent)
+
+def output_dataset(data, filename, output_format='csv', compress=False):
     fieldnames = ['timestamp', 'sensor_id', 'path_to_master', 'type', 'device_type', 'water_usage']
+    if output_format == 'columnar':
+        if not isinstance(data, (list, pd.DataFrame)):
+            data = [row for block in data for row in block]
+        # Write a directory with a binary readings table and a one-row-per-sensor topology
+        write_columnar_dataset(data, filename, compress=compress)
+        return len(data)
+
+    if isinstance(data, pd.DataFrame):
+        # Rows from the vectorized kernel are written in bulk
+        data.to_csv(filename, index=False, columns=fieldnames)
+        return len(data)
+
+    if not isinstance(data, list):
+        # Blocks from iter_simulate_network are written while the next ones are being simulated
+        return write_csv_blocks(data, filename, fieldnames)
+
     with open(filename, 'w', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
         for row in data:
             writer.writerow(row)
+    return len(data)
 
 if __name__ == "__main__":
-    filename = 'datasets/water_distribution_data_leak.csv'
+    parser = argparse.ArgumentParser(description="Generate a water distribution dataset with potential leakages.")
+    parser.add_argument('--output', default=None,
+                        help="Output CSV file or columnar dataset directory.")
+    parser.add_argument('--format', dest='output_format', choices=['csv', 'columnar'], default='csv',
+                        help="Dataset format to write.")
+    parser.add_argument('--compress', action='store_true', help="Compress the columnar readings table.")
+    parser.add_argument('--engine', choices=['object', 'vectorized'], default='object',
+                        help="Simulate with Endpoint/Junction objects or with the vectorized NumPy kernel.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the random number generators.")
+    parser.add_argument('--depth', type=int, default=None,
+                        help="Junction levels below the master junction; builds a configurable network (vectorized engine only).")
+    parser.add_argument('--fan-out', type=int, nargs='+', default=None,
+                        help="Child junctions per junction, as a fixed count or a 'min max' range (default 10).")
+    parser.add_argument('--endpoint-mix', type=parse_endpoint_mix, default=None,
+                        help="Endpoints per leaf junction, e.g. 'Home=3-5,Factory=1-2,Fire_Hydrant=1-10'.")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="Split the simulated time range into this many shards generated in parallel (vectorized engine, CSV only).")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes for --shards.")
+    parser.add_argument('--time-units', type=int, default=24, help="Number of hours to simulate.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.depth is not None and args.engine != 'vectorized':
+        parser.error("--depth requires --engine vectorized")
+    if args.depth is None and (args.fan_out is not None or args.endpoint_mix is not None):
+        parser.error("--fan-out/--endpoint-mix require --depth")
+    if args.shards is not None and (args.engine != 'vectorized' or args.output_format != 'csv'):
+        parser.error("--shards requires --engine vectorized and --format csv")
+
+    filename = args.output or ('datasets/water_distribution_data_leak.csv' if args.output_format == 'csv' else 'datasets/water_distribution_data_leak')
     start_time = datetime(2023, 1, 1, 0, 0)
-    time_units = 24
+    time_units = args.time_units
     master_sensor_id = 1000
     leakage_probability = 0.2
     max_leakage_percent = 0.3
 
-    data = simulate_network(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent)
-    output_dataset(data, filename)
+    topology = None
+    if args.depth is not None:
+        fan_out = args.fan_out or [10]
+        topology = build_topology(args.depth, tuple(fan_out) if len(fan_out) > 1 else fan_out[0],
+                                  args.endpoint_mix, master_sensor_id, seed=args.seed)
+
+    with metrics_session(args, 'data_maker_leak'):
+        if args.shards is not None:
+            if topology is None:
+                topology = NetworkTopology.from_junctions(*create_junctions_and_endpoints(master_sensor_id))
+            with stage('generate_and_write') as metrics:
+                generate_dataset_parallel(filename, topology, Endpoint.USAGE_PARAMETERS, time_units, start_time, args.shards,
+                                          seed=args.seed, leakage_probability=leakage_probability,
+                                          max_leakage_percent=max_leakage_percent, workers=args.workers)
+                metrics.add(rows=len(topology) * time_units, groups=time_units)
+        elif args.engine == 'vectorized':
+            with stage('generate') as metrics:
+                data = simulate_network_vectorized(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent, seed=args.seed, topology=topology)
+                metrics.add(rows=len(data), groups=time_units)
+            with stage('write') as metrics:
+                metrics.add(rows=output_dataset(data, filename, output_format=args.output_format, compress=args.compress))
+        else:
+            # Blocks are simulated while earlier ones are written, so 'write' includes the time spent in 'generate'
+            data = timed_iter('generate', iter_simulate_network(time_units, start_time, master_sensor_id, leakage_probability, max_leakage_percent))
+            with stage('write') as metrics:
+                metrics.add(rows=output_dataset(data, filename, output_format=args.output_format, compress=args.compress))
+            count('generate', groups=time_units)
     print(f"Dataset generated: {filename}")
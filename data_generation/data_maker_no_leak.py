@@ -11,16 +11,35 @@ Classes:
 
 Functions:
 - create_junctions_and_endpoints: Initializes the network with junctions and endpoints.
+- iter_simulate_network: Simulates the network, yielding the rows of one time step at a time.
 - simulate_network: Simulates water usage and flow in the network over a specified time period.
-- output_dataset: Writes the generated data to a CSV file.
+- simulate_network_vectorized: Simulates the network with the vectorized NumPy kernel.
+- output_dataset: Writes the generated data (rows, row blocks or a DataFrame) to a CSV file or a columnar dataset directory.
 """
 
+import argparse
 import random
 import csv
 from datetime import datetime, timedelta
+import pandas as pd
+
+from data_generation.columnar_dataset import write_columnar_dataset
+from data_generation.instrumentation import add_metrics_arguments, count, metrics_session, stage, timed_iter
+from data_generation.parallel_generation import generate_dataset_parallel
+from data_generation.streaming_writer import write_csv_blocks
+from data_generation.network_topology import NetworkTopology, build_topology, parse_endpoint_mix
+from data_generation.vectorized_simulation import simulate_network_arrays
 
 class Endpoint:
     """ Represents an endpoint in the water distribution network. """
+    # Usage probability and maximum usage per endpoint type
+    USAGE_PARAMETERS = {
+        'Home': (0.7, 100),
+        'Factory': (0.8, 500),
+        'Agricultural_Channel': (0.6, 400),
+        'Fire_Hydrant': (0.01, 1000)
+    }
+
     def __init__(self, endpoint_type, sensor_id, path_to_master):
         self.endpoint_type = endpoint_type
         self.sensor_id = sensor_id
@@ -30,13 +49,7 @@ class Endpoint:
 
     def set_usage_parameters(self):
         """ Sets water usage parameters based on the type of endpoint. """
-        parameters = {
-            'Home': (0.7, 100),
-            'Factory': (0.8, 500),
-            'Agricultural_Channel': (0.6, 400),
-            'Fire_Hydrant': (0.01, 1000)
-        }
-        return parameters[self.endpoint_type]
+        return self.USAGE_PARAMETERS[self.endpoint_type]
 
     def simulate_water_usage(self):
         """ Simulates water usage based on the endpoint's usage probability and maximum usage. """
@@ -103,14 +116,14 @@ def create_junctions_and_endpoints(master_sensor_id):
 
     return local_junctions, master_junction
 
-def simulate_network(time_units, start_time, master_sensor_id):
-    """ Simulates the water network operation over a given time period. """
+def iter_simulate_network(time_units, start_time, master_sensor_id):
+    """ Simulates the water network operation over a given time period, yielding the rows of one time step at a time. """
     local_junctions, master_junction = create_junctions_and_endpoints(master_sensor_id)
-    data = []
     current_time = start_time
 
     # Simulate water usage and calculate flow
     for _ in range(time_units):
+        block = []
 
         # Simulate water usage at endpoints, and calculate flow at local junctions
         for lj in local_junctions:
@@ -133,7 +146,7 @@ def simulate_network(time_units, start_time, master_sensor_id):
                     'device_type': endpoint.endpoint_type,
                     'water_usage': endpoint.water_usage
                 }
-                data.append(endpoint_data)
+                block.append(endpoint_data)
 
             junction_data = {
                 'timestamp': current_time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -143,7 +156,7 @@ def simulate_network(time_units, start_time, master_sensor_id):
                 'device_type': 'Local',
                 'water_usage': lj.outflow
             }
-            data.append(junction_data)
+            block.append(junction_data)
 
         # Record data for master junction
         master_data = {
@@ -154,27 +167,111 @@ def simulate_network(time_units, start_time, master_sensor_id):
             'device_type': 'Master',
             'water_usage': master_junction.outflow
         }
-        data.append(master_data)
+        block.append(master_data)
 
         current_time += timedelta(hours=1)
+        yield block
 
+def simulate_network(time_units, start_time, master_sensor_id):
+    """ Simulates the water network operation over a given time period and returns all rows as a list. """
+    data = []
+    for block in iter_simulate_network(time_units, start_time, master_sensor_id):
+        data.extend(block)
     return data
 
-def output_dataset(data, filename):
-    """ Outputs the simulated data to a CSV file. """
+def simulate_network_vectorized(time_units, start_time, master_sensor_id, seed=None, topology=None):
+    """ Simulates the water network operation over a given time period with the vectorized NumPy kernel. """
+    if topology is None:
+        topology = NetworkTopology.from_junctions(*create_junctions_and_endpoints(master_sensor_id))
+    return simulate_network_arrays(topology, Endpoint.USAGE_PARAMETERS, time_units, start_time, seed=seed)
+
+def output_dataset(data, filename, output_format='csv', compress=False):
+    """ Outputs the simulated rows, row blocks or DataFrame to a CSV file, or to a columnar dataset directory when output_format is 'columnar'. """
     fieldnames = ['timestamp', 'sensor_id', 'path_to_master', 'type', 'device_type', 'water_usage']
+    if output_format == 'columnar':
+        if not isinstance(data, (list, pd.DataFrame)):
+            data = [row for block in data for row in block]
+        # Write a directory with a binary readings table and a one-row-per-sensor topology
+        write_columnar_dataset(data, filename, compress=compress)
+        return len(data)
+
+    if isinstance(data, pd.DataFrame):
+        # Rows from the vectorized kernel are written in bulk
+        data.to_csv(filename, index=False, columns=fieldnames)
+        return len(data)
+
+    if not isinstance(data, list):
+        # Blocks from iter_simulate_network are written while the next ones are being simulated
+        return write_csv_blocks(data, filename, fieldnames)
+
     with open(filename, 'w', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
         for row in data:
             writer.writerow(row)
+    return len(data)
 
 if __name__ == "__main__":
     # Main script execution logic
-    filename = 'datasets/water_distribution_data.csv'
+    parser = argparse.ArgumentParser(description="Generate a water distribution dataset without leakages.")
+    parser.add_argument('--output', default=None,
+                        help="Output CSV file or columnar dataset directory.")
+    parser.add_argument('--format', dest='output_format', choices=['csv', 'columnar'], default='csv',
+                        help="Dataset format to write.")
+    parser.add_argument('--compress', action='store_true', help="Compress the columnar readings table.")
+    parser.add_argument('--engine', choices=['object', 'vectorized'], default='object',
+                        help="Simulate with Endpoint/Junction objects or with the vectorized NumPy kernel.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the random number generators.")
+    parser.add_argument('--depth', type=int, default=None,
+                        help="Junction levels below the master junction; builds a configurable network (vectorized engine only).")
+    parser.add_argument('--fan-out', type=int, nargs='+', default=None,
+                        help="Child junctions per junction, as a fixed count or a 'min max' range (default 10).")
+    parser.add_argument('--endpoint-mix', type=parse_endpoint_mix, default=None,
+                        help="Endpoints per leaf junction, e.g. 'Home=3-5,Factory=1-2,Fire_Hydrant=1-10'.")
+    parser.add_argument('--shards', type=int, default=None,
+                        help="Split the simulated time range into this many shards generated in parallel (vectorized engine, CSV only).")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes for --shards.")
+    parser.add_argument('--time-units', type=int, default=240, help="Number of hours to simulate.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.depth is not None and args.engine != 'vectorized':
+        parser.error("--depth requires --engine vectorized")
+    if args.depth is None and (args.fan_out is not None or args.endpoint_mix is not None):
+        parser.error("--fan-out/--endpoint-mix require --depth")
+    if args.shards is not None and (args.engine != 'vectorized' or args.output_format != 'csv'):
+        parser.error("--shards requires --engine vectorized and --format csv")
+
+    filename = args.output or ('datasets/water_distribution_data.csv' if args.output_format == 'csv' else 'datasets/water_distribution_data')
     start_time = datetime(2023, 1, 1, 0, 0)
-    time_units = 240
+    time_units = args.time_units
     master_sensor_id = 1000
-    data = simulate_network(time_units, start_time, master_sensor_id)
-    output_dataset(data, filename)
+    topology = None
+    if args.depth is not None:
+        fan_out = args.fan_out or [10]
+        topology = build_topology(args.depth, tuple(fan_out) if len(fan_out) > 1 else fan_out[0],
+                                  args.endpoint_mix, master_sensor_id, seed=args.seed)
+
+    with metrics_session(args, 'data_maker_no_leak'):
+        if args.shards is not None:
+            if topology is None:
+                topology = NetworkTopology.from_junctions(*create_junctions_and_endpoints(master_sensor_id))
+            with stage('generate_and_write') as metrics:
+                generate_dataset_parallel(filename, topology, Endpoint.USAGE_PARAMETERS, time_units, start_time, args.shards,
+                                          seed=args.seed, workers=args.workers)
+                metrics.add(rows=len(topology) * time_units, groups=time_units)
+        elif args.engine == 'vectorized':
+            with stage('generate') as metrics:
+                data = simulate_network_vectorized(time_units, start_time, master_sensor_id, seed=args.seed, topology=topology)
+                metrics.add(rows=len(data), groups=time_units)
+            with stage('write') as metrics:
+                metrics.add(rows=output_dataset(data, filename, output_format=args.output_format, compress=args.compress))
+        else:
+            # Blocks are simulated while earlier ones are written, so 'write' includes the time spent in 'generate'
+            data = timed_iter('generate', iter_simulate_network(time_units, start_time, master_sensor_id))
+            with stage('write') as metrics:
+                metrics.add(rows=output_dataset(data, filename, output_format=args.output_format, compress=args.compress))
+            count('generate', groups=time_units)
     print(f"Dataset generated: {filename}")
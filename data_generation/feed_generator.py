@@ -0,0 +1,307 @@
+"""
+feed_generator.py
+
+Streams simulated sensor readings to a live consumer, for load testing the tools that read a sensor feed
+(such as `data_analysis/realtime_detection.py`) instead of a finished dataset.
+
+Readings are simulated with the model of the data makers (the endpoint usage parameters and junction
+leakage of `data_maker_leak.py`, on the vectorized kernel), a few simulated hours at a time, and written
+as CSV lines with the dataset columns followed by an `emitted_at` column: the Unix time at which the line
+was written, from which a consumer on the same host can measure its end-to-end latency.
+
+The feed is paced in simulated time (`--speed realtime`, a multiplier such as `--speed 60`), at a fixed
+number of readings per second (`--rate`), or sent as fast as the sink accepts it (`--speed max`). Knobs
+make it look like a real network:
+
+- `--drop`: Fraction of readings that are never sent.
+- `--out-of-order`: Fraction of readings delivered up to `--reorder-distance` readings late.
+- `--jitter`: Random delay of up to this many seconds added to every reading's due time.
+- `--burst`: Fraction of time steps whose readings are held back and released with the next time step
+  (paced feeds only, as an unpaced feed sends every reading as soon as it can).
+
+Readings go to a TCP or Unix socket, a named pipe or standard output, or are appended to a file that
+a consumer tails.
+
+Functions:
+- iter_feed_chunks: Simulates the network a few hours at a time and yields the readings as CSV lines.
+- plan_delivery: Plans the order and due times of the readings of one chunk.
+- open_sink: Opens the socket, pipe or file the feed is written to.
+- emit_feed: Writes the planned readings to a sink, paced by their due times.
+- main: Entry point for running the feed generator.
+"""
+
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+
+from data_generation.data_maker_leak import Endpoint, create_junctions_and_endpoints
+from data_generation.instrumentation import add_metrics_arguments, metrics_session, stage
+from data_generation.network_topology import NetworkTopology, build_topology, parse_endpoint_mix
+from data_generation.vectorized_simulation import simulate_network_arrays
+
+FIELDNAMES = ['timestamp', 'sensor_id', 'path_to_master', 'type', 'device_type', 'water_usage', 'emitted_at']
+
+def iter_feed_chunks(topology, time_units, start_time, seed=None, leakage_probability=0.2,
+                     max_leakage_percent=0.3, chunk_hours=24):
+    """
+    Simulates the network a few hours at a time and yields the readings as CSV lines.
+
+    Every chunk is simulated with its own seed, spawned from the master seed, so a seeded feed is reproducible.
+
+    Parameters:
+    - topology (NetworkTopology): The network to simulate.
+    - time_units (int): Number of hours to simulate; 0 simulates until the consumer goes away.
+    - start_time (datetime): Timestamp of the first time step.
+    - seed (int or numpy.random.SeedSequence, optional): Master seed of the simulation.
+    - leakage_probability (float): Probability of a junction leaking during a time step.
+    - max_leakage_percent (float): Maximum leakage as a fraction of the junction outflow.
+    - chunk_hours (int): Number of hours simulated at once.
+
+    Yields:
+    - int: Index of the first time step of the chunk.
+    - List[str]: The readings of the chunk as CSV lines without a line ending, in time step order.
+    """
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    first_step = 0
+    while not time_units or first_step < time_units:
+        hours = chunk_hours if not time_units else min(chunk_hours, time_units - first_step)
+        data = simulate_network_arrays(topology, Endpoint.USAGE_PARAMETERS, hours,
+                                       start_time + timedelta(hours=first_step), seed=seed_sequence.spawn(1)[0],
+                                       leakage_probability=leakage_probability, max_leakage_percent=max_leakage_percent)
+        yield first_step, data.to_csv(index=False, header=False).splitlines()
+        first_step += hours
+
+def plan_delivery(first_step, rows, rows_per_step, rng, step_seconds=0.0, reading_seconds=0.0, drop=0.0,
+                  out_of_order=0.0, reorder_distance=100, jitter=0.0, burst=0.0):
+    """
+    Plans the order and due times of the readings of one chunk.
+
+    A reading is due at the start of its time step (`step_seconds` per step) plus its position in the
+    feed (`reading_seconds` per reading), both zero when the feed is unpaced. Readings of a burst step are
+    due with the first reading of the next step, and jitter delays every reading at random. Readings are
+    delivered in feed order, except that out-of-order ones move up to `reorder_distance` readings later
+    (within the chunk); a reading is sent once it is due and all readings before it have been sent.
+
+    Parameters:
+    - first_step (int): Index of the chunk's first time step in the feed.
+    - rows (int): Number of readings of the chunk.
+    - rows_per_step (int): Number of readings per time step.
+    - rng (numpy.random.Generator): Source of randomness of the delivery knobs.
+    - step_seconds (float): Seconds between the starts of consecutive time steps.
+    - reading_seconds (float): Seconds between consecutive readings.
+    - drop (float): Fraction of readings that are dropped.
+    - out_of_order (float): Fraction of readings that are delivered late.
+    - reorder_distance (int): Maximum number of readings an out-of-order reading is delivered late.
+    - jitter (float): Maximum random delay of a reading in seconds.
+    - burst (float): Fraction of time steps that are released together with the next time step.
+
+    Returns:
+    - ndarray: Positions in the chunk of the readings to send, in delivery order.
+    - ndarray: Due time of every reading to send, in seconds from the start of the feed, non-decreasing.
+    """
+    positions = np.arange(rows)
+    steps = first_step + positions // rows_per_step
+    feed_rows = first_step * rows_per_step + positions
+
+    held = rng.random(rows // rows_per_step) < burst
+    due_steps = steps + held[positions // rows_per_step]
+    due_rows = np.where(held[positions // rows_per_step], due_steps * rows_per_step, feed_rows)
+    due = due_steps * step_seconds + due_rows * reading_seconds
+    if jitter:
+        due = due + rng.uniform(0, jitter, rows)
+
+    keys = positions.astype(np.float64)
+    late = rng.random(rows) < out_of_order
+    keys[late] += rng.uniform(1, reorder_distance + 1, int(late.sum()))
+    kept = rng.random(rows) >= drop
+    order = positions[kept][np.argsort(keys[kept], kind='stable')]
+    return order, np.maximum.accumulate(due[order]) if len(order) else due[order]
+
+def open_sink(tcp=None, unix=None, pipe=None, file=None):
+    """
+    Opens the socket, pipe or file the feed is written to; exactly one destination is given.
+
+    Parameters:
+    - tcp (str, optional): 'HOST:PORT' of a TCP consumer to connect to.
+    - unix (str, optional): Path of a Unix socket to connect to.
+    - pipe (str, optional): Path of a named pipe to write to, or '-' for standard output.
+    - file (str, optional): Path of a file to append to; a new file starts with the CSV header.
+
+    Returns:
+    - BinaryIO: The writable binary stream.
+    """
+    if tcp is not None or unix is not None:
+        if tcp is not None:
+            host, port = tcp.rsplit(':', 1)
+            connection = socket.create_connection((host or '127.0.0.1', int(port)))
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(unix)
+        stream = connection.makefile('wb')
+        # The connection stays open until the stream is closed
+        connection.close()
+        return stream
+    if pipe is not None:
+        # Opening a named pipe blocks until a reader opens it
+        return sys.stdout.buffer if pipe == '-' else open(pipe, 'wb')
+    sink = open(file, 'ab')
+    if sink.tell() == 0:
+        sink.write((','.join(FIELDNAMES) + '\n').encode())
+    return sink
+
+def emit_feed(chunks, sink, rows_per_step, rng, step_seconds=0.0, reading_seconds=0.0, batch_size=1000, **knobs):
+    """
+    Writes the readings of every chunk to a sink, in planned order and no earlier than they are due.
+
+    Readings that are due are written in batches of up to `batch_size` lines, which share one `emitted_at`
+    time and are flushed together.
+
+    Parameters:
+    - chunks (Iterable[Tuple[int, List[str]]]): Chunks of readings, as yielded by `iter_feed_chunks`.
+    - sink (BinaryIO): The stream to write to, as returned by `open_sink`.
+    - rows_per_step (int): Number of readings per time step.
+    - rng (numpy.random.Generator): Source of randomness of the delivery knobs.
+    - step_seconds (float): Seconds between the starts of consecutive time steps, 0 for an unpaced feed.
+    - reading_seconds (float): Seconds between consecutive readings, 0 for an unpaced feed.
+    - batch_size (int): Maximum number of lines written at once.
+    - knobs: The `drop`, `out_of_order`, `reorder_distance`, `jitter` and `burst` options of `plan_delivery`.
+
+    Returns:
+    - Dict: The number of `generated` and `sent` readings, the number of `batches`, the `seconds` taken and
+      the achieved `readings_per_second`.
+    """
+    stats = {'generated': 0, 'sent': 0, 'batches': 0}
+    started = time.time()
+    for first_step, lines in chunks:
+        order, due = plan_delivery(first_step, len(lines), rows_per_step, rng, step_seconds, reading_seconds, **knobs)
+        stats['generated'] += len(lines)
+        start = 0
+        while start < len(order):
+            now = time.time() - started
+            if due[start] > now:
+                time.sleep(due[start] - now)
+                now = due[start]
+            end = min(start + batch_size, int(np.searchsorted(due, now, side='right')))
+            end = max(end, start + 1)
+            suffix = f",{time.time():.6f}\n"
+            sink.write((suffix.join([lines[position] for position in order[start:end]]) + suffix).encode())
+            sink.flush()
+            stats['sent'] += end - start
+            stats['batches'] += 1
+            start = end
+    stats['seconds'] = time.time() - started
+    stats['readings_per_second'] = stats['sent'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+def _parse_speed(value):
+    """ Parses 'realtime', 'max' or a speed multiplier such as '60' or '60x'. """
+    if value in ('realtime', 'max'):
+        return value
+    try:
+        speed = float(value.rstrip('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid speed '{value}', expected 'realtime', 'max' or a multiplier.")
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("The speed multiplier must be positive.")
+    return speed
+
+def main(argv=None):
+    """
+    Main function to stream a simulated sensor feed to a local consumer.
+
+    Parameters:
+    - argv (List[str], optional): Command line arguments, defaults to `sys.argv[1:]`.
+
+    Returns:
+    - int: Exit status, 1 if the consumer went away before the feed ended.
+    """
+    parser = argparse.ArgumentParser(description="Stream simulated sensor readings to a local socket, pipe or file.")
+    sinks = parser.add_mutually_exclusive_group(required=True)
+    sinks.add_argument('--tcp', default=None, metavar='HOST:PORT', help="Connect to a TCP consumer.")
+    sinks.add_argument('--unix', default=None, metavar='PATH', help="Connect to a Unix socket consumer.")
+    sinks.add_argument('--pipe', default=None, metavar='PATH', help="Write to a named pipe, or '-' for standard output.")
+    sinks.add_argument('--file', default=None, metavar='PATH', help="Append to a file that a consumer tails.")
+    parser.add_argument('--speed', type=_parse_speed, default='max',
+                        help="'realtime' (one simulated hour per hour), a multiplier such as 3600, or 'max' (default).")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Send this many readings per second instead of pacing by simulated time.")
+    parser.add_argument('--drop', type=float, default=0.0, help="Fraction of readings that are never sent.")
+    parser.add_argument('--out-of-order', type=float, default=0.0, help="Fraction of readings delivered late.")
+    parser.add_argument('--reorder-distance', type=int, default=100,
+                        help="Maximum number of readings an out-of-order reading is delivered late.")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Maximum random delay of a reading in seconds.")
+    parser.add_argument('--burst', type=float, default=0.0,
+                        help="Fraction of time steps held back and released together with the next time step "
+                             "(needs a paced feed: --speed other than max, or --rate).")
+    parser.add_argument('--time-units', type=int, default=24, help="Number of hours to simulate, 0 to stream until stopped.")
+    parser.add_argument('--chunk-hours', type=int, default=24, help="Number of hours simulated at once.")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Maximum number of lines written at once.")
+    parser.add_argument('--leakage-probability', type=float, default=0.2,
+                        help="Probability of a junction leaking during a time step.")
+    parser.add_argument('--max-leakage-percent', type=float, default=0.3,
+                        help="Maximum leakage as a fraction of the junction outflow.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the simulation and of the delivery knobs.")
+    parser.add_argument('--depth', type=int, default=None,
+                        help="Junction levels below the master junction; builds a configurable network.")
+    parser.add_argument('--fan-out', type=int, nargs='+', default=[10],
+                        help="Child junctions per junction, as a fixed count or a 'min max' range.")
+    parser.add_argument('--endpoint-mix', type=parse_endpoint_mix, default=None,
+                        help="Endpoints per leaf junction, e.g. 'Home=3-5,Factory=1-2,Fire_Hydrant=1-10'.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.burst and args.speed == 'max' and not args.rate:
+        parser.error("--burst requires a paced feed (--speed realtime, a speed multiplier, or --rate)")
+    if args.seed is not None:
+        # The default network draws its endpoint counts from the standard library generator
+        random.seed(args.seed)
+    master_sensor_id = 1000
+    if args.depth is not None:
+        topology = build_topology(args.depth, tuple(args.fan_out) if len(args.fan_out) > 1 else args.fan_out[0],
+                                  args.endpoint_mix, master_sensor_id, seed=args.seed)
+    else:
+        topology = NetworkTopology.from_junctions(*create_junctions_and_endpoints(master_sensor_id))
+
+    step_seconds = reading_seconds = 0.0
+    if args.rate:
+        reading_seconds = 1 / args.rate
+    elif args.speed != 'max':
+        step_seconds = 3600 / (1 if args.speed == 'realtime' else args.speed)
+
+    simulation_seed, delivery_seed = np.random.SeedSequence(args.seed).spawn(2)
+    chunks = iter_feed_chunks(topology, args.time_units, datetime(2023, 1, 1, 0, 0), simulation_seed,
+                              args.leakage_probability, args.max_leakage_percent, args.chunk_hours)
+    sink = open_sink(args.tcp, args.unix, args.pipe, args.file)
+    # Progress goes to standard error, so that standard output can carry the feed
+    print(f"Streaming {len(topology)} readings per time step", file=sys.stderr)
+    with metrics_session(args, 'feed_generator'):
+        with stage('emit') as metrics:
+            try:
+                stats = emit_feed(chunks, sink, len(topology), np.random.default_rng(delivery_seed), step_seconds,
+                                  reading_seconds, args.batch_size, drop=args.drop, out_of_order=args.out_of_order,
+                                  reorder_distance=args.reorder_distance, jitter=args.jitter, burst=args.burst)
+            except (BrokenPipeError, ConnectionResetError):
+                print("The consumer closed the feed.", file=sys.stderr)
+                if sink is sys.stdout.buffer:
+                    # Keep the interpreter from flushing into the closed pipe again at exit
+                    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                return 1
+            except KeyboardInterrupt:
+                return 0
+            finally:
+                try:
+                    sink.close()
+                except OSError:
+                    pass
+            metrics.add(rows=stats['sent'])
+    print(f"Sent {stats['sent']} of {stats['generated']} readings in {stats['seconds']:.2f}s "
+          f"({stats['readings_per_second']:.0f} readings/s, {stats['batches']} batches)", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
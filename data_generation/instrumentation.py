@@ -0,0 +1,287 @@
+"""
+instrumentation.py
+
+Opt-in, per-stage instrumentation for the data makers and the analysis scripts.
+
+Code marks its stages with `stage(name)` blocks and adds counters (rows, groups, leaks) to them. While
+instrumentation is disabled, which is the default, `stage` returns a shared no-op block after a single
+global check, so instrumented code runs at practically full speed. Once `enable` has been called, the
+wall time, number of calls and counters of every stage are accumulated and can be exported as JSON or
+as a Prometheus textfile for the node exporter's textfile collector.
+
+Classes:
+- StageMetrics: Accumulated wall time, calls and counters of one stage.
+- Instrumentation: The metrics of all stages of one run.
+
+Functions:
+- enable: Starts recording metrics.
+- disable: Stops recording metrics.
+- active: Returns the current recorder, if any.
+- stage: Marks a block of code as a stage.
+- count: Adds counters to a stage without timing it.
+- timed_iter: Times the production of every item of an iterable as a stage.
+- add_metrics_arguments: Adds the metrics export options to a command line parser.
+- metrics_session: Records metrics for the duration of a script run and exports them.
+"""
+
+import contextlib
+import json
+import os
+import re
+import time
+
+METRIC_PREFIX = 'water_pipeline'
+
+class StageMetrics:
+    """ Accumulated wall time, number of calls and counters of one stage. """
+    __slots__ = ('name', 'seconds', 'calls', 'counters', '_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.calls = 0
+        self.counters = {}
+        self._start = None
+
+    def add(self, **counts):
+        """ Adds to the stage's counters, e.g. `add(rows=len(data), leaks=3)`. """
+        for counter, value in counts.items():
+            self.counters[counter] = self.counters.get(counter, 0) + int(value)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time.perf_counter() - self._start
+        self.calls += 1
+        return False
+
+    def to_dict(self):
+        return {'seconds': self.seconds, 'calls': self.calls, **self.counters}
+
+class _DisabledStage:
+    """ Stage block used while instrumentation is disabled; it records nothing. """
+    __slots__ = ()
+
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_DISABLED_STAGE = _DisabledStage()
+
+class Instrumentation:
+    """ The metrics of every stage of one run of a script, in the order the stages first ran. """
+
+    def __init__(self, script):
+        self.script = script
+        self.started_at = time.time()
+        self.stages = {}
+
+    def stage(self, name):
+        """ Returns the metrics of a stage, creating them on first use. """
+        metrics = self.stages.get(name)
+        if metrics is None:
+            metrics = self.stages[name] = StageMetrics(name)
+        return metrics
+
+    def to_dict(self):
+        """
+        Returns the metrics as a JSON-serializable dictionary.
+
+        Returns:
+        - Dict: The script name, start time and, per stage, the seconds, calls and counters.
+        """
+        return {
+            'script': self.script,
+            'started_at': self.started_at,
+            'stages': {name: metrics.to_dict() for name, metrics in self.stages.items()},
+        }
+
+    def write_json(self, path):
+        """
+        Writes the metrics to a JSON file.
+
+        Parameters:
+        - path (str): Path of the JSON file.
+        """
+        with open(path, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+            metrics_file.write('\n')
+
+    def to_prometheus(self):
+        """
+        Formats the metrics in the Prometheus text exposition format.
+
+        Every stage becomes a set of gauges holding the values of the last run, labelled with the script
+        and stage names, e.g. `water_pipeline_stage_seconds{script="leakage_detection",stage="load"}`.
+
+        Returns:
+        - str: The metrics, one sample per line.
+        """
+        samples = {
+            'stage_seconds': ('Wall time spent in a pipeline stage during the last run.', {}),
+            'stage_calls': ('Number of times a pipeline stage ran during the last run.', {}),
+        }
+        for name, metrics in self.stages.items():
+            samples['stage_seconds'][1][name] = metrics.seconds
+            samples['stage_calls'][1][name] = metrics.calls
+            for counter, value in metrics.counters.items():
+                metric = f"stage_{re.sub(r'[^a-zA-Z0-9_]', '_', counter)}"
+                samples.setdefault(metric, (f"Number of {counter} processed by a pipeline stage during the last run.", {}))[1][name] = value
+
+        lines = []
+        for metric, (help_text, values) in samples.items():
+            lines.append(f"# HELP {METRIC_PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{metric} gauge")
+            for name, value in values.items():
+                lines.append(f'{METRIC_PREFIX}_{metric}{{script="{_escape_label(self.script)}",stage="{_escape_label(name)}"}} {value}')
+        lines.append(f"# HELP {METRIC_PREFIX}_run_started_timestamp_seconds Start time of the instrumented run.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_run_started_timestamp_seconds gauge")
+        lines.append(f'{METRIC_PREFIX}_run_started_timestamp_seconds{{script="{_escape_label(self.script)}"}} {self.started_at}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics to a Prometheus textfile.
+
+        The file is written next to its final path and then renamed, so the node exporter never reads a partial file.
+
+        Parameters:
+        - path (str): Path of the textfile, which should end in `.prom`.
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+def _escape_label(value):
+    """ Escapes a Prometheus label value. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+_active = None
+
+def enable(script):
+    """
+    Starts recording metrics, replacing any previous recorder.
+
+    Parameters:
+    - script (str): Name of the instrumented script, used as a label on every metric.
+
+    Returns:
+    - Instrumentation: The new recorder.
+    """
+    global _active
+    _active = Instrumentation(script)
+    return _active
+
+def disable():
+    """ Stops recording metrics. """
+    global _active
+    _active = None
+
+def active():
+    """ Returns the current recorder, or None when instrumentation is disabled. """
+    return _active
+
+def stage(name):
+    """
+    Marks a block of code as a stage: `with stage('load') as metrics: ...; metrics.add(rows=len(data))`.
+
+    Running the same stage several times accumulates its time, calls and counters.
+
+    Parameters:
+    - name (str): Name of the stage.
+
+    Returns:
+    - StageMetrics: The stage's metrics, usable as a context manager; a no-op stand-in while disabled.
+    """
+    if _active is None:
+        return _DISABLED_STAGE
+    return _active.stage(name)
+
+def count(name, **counts):
+    """
+    Adds counters to a stage without timing it.
+
+    Parameters:
+    - name (str): Name of the stage.
+    - counts (int): Counter values to add, by counter name.
+    """
+    if _active is not None:
+        _active.stage(name).add(**counts)
+
+def timed_iter(name, iterable, rows=len):
+    """
+    Times the production of every item of an iterable, e.g. the blocks of a generator, as a stage.
+
+    Only the time spent inside the iterable is recorded, not the time the consumer spends on the items;
+    every item counts as one call of the stage.
+
+    Parameters:
+    - name (str): Name of the stage.
+    - iterable (Iterable): The items to time.
+    - rows (Callable, optional): Counts the rows of an item; None to count items only.
+
+    Returns:
+    - Iterable: The items, unchanged; the iterable itself while instrumentation is disabled.
+    """
+    if _active is None:
+        return iterable
+    return _timed_items(_active.stage(name), iter(iterable), rows)
+
+def _timed_items(metrics, iterator, rows):
+    """ Yields the items of an iterator, adding the time spent producing each one to a stage. """
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.seconds += time.perf_counter() - start
+            return
+        metrics.seconds += time.perf_counter() - start
+        metrics.calls += 1
+        if rows is not None:
+            metrics.add(rows=rows(item))
+        yield item
+
+def add_metrics_arguments(parser):
+    """
+    Adds the metrics export options to a command line parser.
+
+    Parameters:
+    - parser (ArgumentParser): The script's parser.
+    """
+    parser.add_argument('--metrics-json', default=None, help="Record per-stage metrics and write them to this JSON file.")
+    parser.add_argument('--metrics-prometheus', default=None,
+                        help="Record per-stage metrics and write them to this Prometheus textfile (*.prom).")
+
+@contextlib.contextmanager
+def metrics_session(args, script):
+    """
+    Records metrics while the block runs, if the parsed arguments ask for an export, and writes them at the end.
+
+    Parameters:
+    - args (Namespace): Arguments parsed by a parser set up with `add_metrics_arguments`.
+    - script (str): Name of the instrumented script.
+
+    Yields:
+    - Instrumentation or None: The recorder, or None when no export was requested.
+    """
+    if not (args.metrics_json or args.metrics_prometheus):
+        yield None
+        return
+    recorder = enable(script)
+    try:
+        yield recorder
+    finally:
+        disable()
+        if args.metrics_json:
+            recorder.write_json(args.metrics_json)
+        if args.metrics_prometheus:
+            recorder.write_prometheus(args.metrics_prometheus)
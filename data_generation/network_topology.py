@@ -0,0 +1,224 @@
+"""
+network_topology.py
+
+Compact, array-based topology of a multi-level water distribution network.
+
+The network is a tree rooted at the master junction. Nodes are stored in flat NumPy arrays
+(sensor ID, parent, node kind and device type) with the children of every node kept in
+CSR-style offset arrays, so networks with 10^5-10^6 endpoints need a few bytes per node
+instead of a Python object each. `path_to_master` is derived from the parent pointers on
+demand rather than stored per node.
+
+Node numbering follows `create_junctions_and_endpoints`: junctions are numbered level by level
+starting at the master sensor ID, then the endpoints of every leaf junction in turn.
+
+Classes:
+- NetworkTopology: Array-based network tree.
+
+Functions:
+- build_topology: Builds a network with configurable depth, fan-out and endpoint mix.
+- parse_endpoint_mix: Parses an endpoint mix given as "Home=3-5,Factory=1-2".
+"""
+
+import numpy as np
+
+JUNCTION = 0
+ENDPOINT = 1
+DEVICE_TYPES = ['Master', 'Local', 'Home', 'Factory', 'Agricultural_Channel', 'Fire_Hydrant']
+
+# Endpoints attached to every leaf junction, as (min, max) counts per device type
+DEFAULT_ENDPOINT_MIX = {
+    'Home': (3, 5),
+    'Factory': (1, 2),
+    'Agricultural_Channel': (0, 5),
+    'Fire_Hydrant': (1, 10),
+}
+
+class NetworkTopology:
+    """ Array-based tree of junctions and endpoints rooted at the master junction (node 0). """
+    __slots__ = ('sensor_ids', 'parents', 'kinds', 'device_types', 'child_offsets', 'children')
+
+    def __init__(self, sensor_ids, parents, kinds, device_types):
+        self.sensor_ids = np.asarray(sensor_ids, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.kinds = np.asarray(kinds, dtype=np.int8)
+        self.device_types = np.asarray(device_types, dtype=np.int8)
+
+        # Children of node i are children[child_offsets[i]:child_offsets[i + 1]], in node order
+        has_parent = np.flatnonzero(self.parents >= 0)
+        order = has_parent[np.argsort(self.parents[has_parent], kind='stable')]
+        counts = np.bincount(self.parents[has_parent], minlength=len(self.parents))
+        self.child_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.children = order.astype(np.int32)
+
+    @classmethod
+    def from_junctions(cls, local_junctions, master_junction):
+        """
+        Builds a topology from the Junction and Endpoint objects of `create_junctions_and_endpoints`.
+
+        Parameters:
+        - local_junctions (List[Junction]): The local junctions, with their connected endpoints.
+        - master_junction (Junction): The master junction.
+
+        Returns:
+        - NetworkTopology: The equivalent array-based topology.
+        """
+        sensor_ids = [master_junction.sensor_id] + [lj.sensor_id for lj in local_junctions]
+        parents = [-1] + [0] * len(local_junctions)
+        kinds = [JUNCTION] * len(sensor_ids)
+        device_types = [DEVICE_TYPES.index('Master')] + [DEVICE_TYPES.index('Local')] * len(local_junctions)
+
+        for junction_index, lj in enumerate(local_junctions, start=1):
+            for endpoint in lj.connected_endpoints:
+                sensor_ids.append(endpoint.sensor_id)
+                parents.append(junction_index)
+                kinds.append(ENDPOINT)
+                device_types.append(DEVICE_TYPES.index(endpoint.endpoint_type))
+
+        return cls(sensor_ids, parents, kinds, device_types)
+
+    def __len__(self):
+        return len(self.sensor_ids)
+
+    def children_of(self, node):
+        """ Returns the child nodes of a node. """
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def depths(self):
+        """ Returns the depth of every node, the master junction being at depth 0. """
+        depths = np.zeros(len(self), dtype=np.int32)
+        has_parent = self.parents >= 0
+        # Each pass fixes one more level; the depths stop changing once the deepest level is reached
+        while True:
+            updated = np.where(has_parent, depths[self.parents] + 1, 0).astype(np.int32)
+            if np.array_equal(updated, depths):
+                return depths
+            depths = updated
+
+    def path_to_master(self, node):
+        """
+        Derives the path from the master junction to a node.
+
+        Parameters:
+        - node (int): Index of the node.
+
+        Returns:
+        - List[int]: Sensor IDs from the master junction down to the node.
+        """
+        path = []
+        while node >= 0:
+            path.append(int(self.sensor_ids[node]))
+            node = self.parents[node]
+        return path[::-1]
+
+    def path_strings(self):
+        """
+        Derives the `path_to_master` string of every node, in the '1000->1001->1011' format of the datasets.
+
+        Returns:
+        - List[str]: The path string of every node.
+        """
+        paths = [None] * len(self)
+        for node in range(len(self)):
+            parent = self.parents[node]
+            sensor_id = str(self.sensor_ids[node])
+            paths[node] = sensor_id if parent < 0 else f"{paths[parent]}->{sensor_id}"
+        return paths
+
+    def post_order(self):
+        """
+        Orders the nodes children-first, the order in which `simulate_network` records its rows.
+
+        The position of every node is computed level by level from the subtree sizes, without walking the tree.
+
+        Returns:
+        - ndarray: Node indices, every node after all of its descendants and the master junction last.
+        """
+        depths = self.depths()
+        levels = [np.flatnonzero(depths == depth) for depth in range(int(depths.max()) + 1)]
+
+        # Subtree sizes, accumulated bottom-up
+        sizes = np.ones(len(self), dtype=np.int64)
+        for nodes in levels[:0:-1]:
+            np.add.at(sizes, self.parents[nodes], sizes[nodes])
+
+        # First position of every subtree: its parent's first position plus the sizes of its earlier siblings
+        starts = np.zeros(len(self), dtype=np.int64)
+        for nodes in levels[1:]:
+            nodes = nodes[np.argsort(self.parents[nodes], kind='stable')]
+            parents = self.parents[nodes]
+            preceding = np.cumsum(sizes[nodes]) - sizes[nodes]
+            group_first = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+            group_offset = np.repeat(preceding[group_first], np.diff(np.r_[group_first, len(nodes)]))
+            starts[nodes] = starts[parents] + preceding - group_offset
+
+        return np.argsort(starts + sizes - 1, kind='stable')
+
+def build_topology(depth=1, fan_out=10, endpoint_mix=None, master_sensor_id=1000, seed=None):
+    """
+    Builds a network with a configurable number of junction levels, fan-out and endpoint mix.
+
+    With the defaults this produces the same shape as `create_junctions_and_endpoints`: a master
+    junction with 10 local junctions, each serving a random mix of endpoints.
+
+    Parameters:
+    - depth (int): Number of junction levels below the master junction.
+    - fan_out (int or Tuple[int, int]): Child junctions per junction, fixed or as an inclusive (min, max) range.
+    - endpoint_mix (Dict[str, Tuple[int, int]], optional): (min, max) endpoints per device type on every leaf junction.
+    - master_sensor_id (int): Sensor ID of the master junction; all other IDs follow it.
+    - seed (int, optional): Seed of the NumPy Generator drawing the random counts.
+
+    Returns:
+    - NetworkTopology: The generated network.
+    """
+    if depth < 1:
+        raise ValueError("A network needs at least one junction level below the master junction.")
+    rng = np.random.default_rng(seed)
+    endpoint_mix = DEFAULT_ENDPOINT_MIX if endpoint_mix is None else endpoint_mix
+    low, high = (fan_out, fan_out) if np.isscalar(fan_out) else fan_out
+
+    # Junction levels, numbered breadth first so that siblings are contiguous
+    parents = [np.array([-1], dtype=np.int64)]
+    level_start = 0
+    level_size = 1
+    for _ in range(depth):
+        counts = rng.integers(low, high + 1, size=level_size)
+        parents.append(np.repeat(np.arange(level_start, level_start + level_size), counts))
+        level_start += level_size
+        level_size = int(counts.sum())
+    junction_count = level_start + level_size
+
+    # Endpoints of every leaf junction, grouped by device type in the order of the endpoint mix
+    leaf_junctions = np.arange(level_start, junction_count)
+    mix_types = list(endpoint_mix)
+    counts = np.column_stack([rng.integers(endpoint_mix[t][0], endpoint_mix[t][1] + 1, size=level_size) for t in mix_types])
+    endpoint_parents = np.repeat(np.repeat(leaf_junctions, len(mix_types)), counts.ravel())
+    endpoint_types = np.repeat(np.tile([DEVICE_TYPES.index(t) for t in mix_types], level_size), counts.ravel())
+
+    all_parents = np.concatenate(parents + [endpoint_parents])
+    node_count = len(all_parents)
+    kinds = np.where(np.arange(node_count) < junction_count, JUNCTION, ENDPOINT)
+    device_types = np.concatenate([[DEVICE_TYPES.index('Master')],
+                                   np.full(junction_count - 1, DEVICE_TYPES.index('Local')),
+                                   endpoint_types])
+
+    return NetworkTopology(master_sensor_id + np.arange(node_count), all_parents, kinds, device_types)
+
+def parse_endpoint_mix(text):
+    """
+    Parses an endpoint mix given on the command line.
+
+    Parameters:
+    - text (str): Comma-separated device type ranges, e.g. "Home=3-5,Factory=1-2,Fire_Hydrant=1".
+
+    Returns:
+    - Dict[str, Tuple[int, int]]: The (min, max) endpoint count per device type.
+    """
+    endpoint_mix = {}
+    for item in text.split(','):
+        device_type, _, count_range = item.partition('=')
+        if device_type not in DEVICE_TYPES[2:]:
+            raise ValueError(f"Unknown endpoint type: {device_type}")
+        low, _, high = count_range.partition('-')
+        endpoint_mix[device_type] = (int(low), int(high or low))
+    return endpoint_mix
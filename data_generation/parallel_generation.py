@@ -0,0 +1,91 @@
+"""
+parallel_generation.py
+
+Generates a dataset in parallel by sharding the simulated time range across a process pool.
+
+Every shard simulates a contiguous range of hours with the vectorized kernel and its own NumPy
+Generator. The shard seeds are spawned from one master seed with `numpy.random.SeedSequence`, so
+the same seed and shard count always produce byte-identical output, whatever the number of workers.
+Shards write their rows to part files concurrently; the parts are then concatenated in time order.
+
+Functions:
+- shard_time_ranges: Splits a number of time steps into contiguous shards.
+- generate_dataset_parallel: Simulates and writes a CSV dataset with a process pool.
+"""
+
+import csv
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import numpy as np
+
+from data_generation.vectorized_simulation import simulate_network_arrays
+
+FIELDNAMES = ['timestamp', 'sensor_id', 'path_to_master', 'type', 'device_type', 'water_usage']
+
+def shard_time_ranges(time_units, shards):
+    """
+    Splits a number of time steps into contiguous shards of nearly equal length.
+
+    Parameters:
+    - time_units (int): Number of hourly time steps to simulate.
+    - shards (int): Number of shards.
+
+    Returns:
+    - List[Tuple[int, int]]: The (first time step, number of time steps) of every non-empty shard.
+    """
+    bounds = np.linspace(0, time_units, shards + 1).astype(int)
+    return [(int(start), int(end - start)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def _write_shard(part_path, topology, usage_parameters, time_units, start_time, seed_sequence,
+                 leakage_probability, max_leakage_percent):
+    """ Simulates one shard and writes its rows, without a header, to a part file. """
+    data = simulate_network_arrays(topology, usage_parameters, time_units, start_time, seed=seed_sequence,
+                                   leakage_probability=leakage_probability, max_leakage_percent=max_leakage_percent)
+    data.to_csv(part_path, index=False, header=False, columns=FIELDNAMES, lineterminator='\n')
+    return part_path
+
+def generate_dataset_parallel(filename, topology, usage_parameters, time_units, start_time, shards, seed=None,
+                              leakage_probability=0.0, max_leakage_percent=0.0, workers=None):
+    """
+    Simulates a network over a time range split into shards and writes one CSV dataset.
+
+    Parameters:
+    - filename (str): Path of the CSV file to write.
+    - topology (NetworkTopology): The network to simulate.
+    - usage_parameters (Dict[str, Tuple[float, int]]): (usage_probability, max_usage) per endpoint type.
+    - time_units (int): Number of hourly time steps to simulate.
+    - start_time (datetime): Timestamp of the first time step.
+    - shards (int): Number of time shards; together with the seed it determines the output.
+    - seed (int, optional): Master seed from which every shard's seed is derived.
+    - leakage_probability (float): Probability of a junction leaking during a time step.
+    - max_leakage_percent (float): Maximum leakage as a fraction of the junction outflow.
+    - workers (int, optional): Number of worker processes, defaults to the number of CPUs.
+    """
+    time_ranges = shard_time_ranges(time_units, shards)
+    seed_sequences = np.random.SeedSequence(seed).spawn(shards)
+    part_paths = [f"{filename}.part{index:04d}" for index in range(len(time_ranges))]
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_write_shard, part_path, topology, usage_parameters, shard_units,
+                                start_time + timedelta(hours=first_step), seed_sequence,
+                                leakage_probability, max_leakage_percent)
+                for part_path, (first_step, shard_units), seed_sequence in zip(part_paths, time_ranges, seed_sequences)
+            ]
+            for future in futures:
+                future.result()
+
+        # Concatenate the shards in time order behind a single header
+        with open(filename, 'w', newline='') as csvfile:
+            csv.writer(csvfile, lineterminator='\n').writerow(FIELDNAMES)
+        with open(filename, 'ab') as output_file:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, output_file)
+    finally:
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
@@ -0,0 +1,67 @@
+"""
+streaming_writer.py
+
+Writes simulated rows to CSV while they are still being generated.
+
+Blocks of rows (one per simulated time step) are handed to a background writer thread through
+a bounded queue, so the simulation of the next time step overlaps with writing the previous one
+and at most `queue_size` blocks are held in memory, whatever the simulated duration.
+
+Functions:
+- write_csv_blocks: Writes an iterable of row blocks to a CSV file on a background thread.
+"""
+
+import csv
+import queue
+import threading
+
+_END_OF_BLOCKS = object()
+
+def write_csv_blocks(blocks, filename, fieldnames, queue_size=8):
+    """
+    Writes an iterable of row blocks to a CSV file, one bulk `writerows` call per block.
+
+    Parameters:
+    - blocks (Iterable[List[Dict]]): Blocks of rows, e.g. from `iter_simulate_network`.
+    - filename (str): Path of the CSV file to write.
+    - fieldnames (List[str]): Columns of the CSV file.
+    - queue_size (int): Maximum number of blocks waiting to be written.
+
+    Returns:
+    - int: Number of rows written.
+    """
+    pending = queue.Queue(maxsize=queue_size)
+    errors = []
+    rows_written = [0]
+
+    def write():
+        try:
+            with open(filename, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+                writer.writeheader()
+                while True:
+                    block = pending.get()
+                    if block is _END_OF_BLOCKS:
+                        return
+                    writer.writerows(block)
+                    rows_written[0] += len(block)
+        except Exception as error:
+            errors.append(error)
+            # Keep draining so the producer never blocks on a full queue
+            while pending.get() is not _END_OF_BLOCKS:
+                pass
+
+    writer_thread = threading.Thread(target=write, name='csv-block-writer', daemon=True)
+    writer_thread.start()
+    try:
+        for block in blocks:
+            if errors:
+                break
+            pending.put(block)
+    finally:
+        pending.put(_END_OF_BLOCKS)
+        writer_thread.join()
+
+    if errors:
+        raise errors[0]
+    return rows_written[0]
@@ -0,0 +1,143 @@
+"""
+vectorized_simulation.py
+
+Vectorized NumPy kernel for simulating a water distribution network.
+
+Instead of asking every Endpoint object for its usage one hour at a time, the whole
+(time x endpoint) usage matrix is drawn at once from a seeded NumPy Generator, using the
+per-type (usage_probability, max_usage) table of `Endpoint.set_usage_parameters`.
+Junction outflows and leak injection follow `Junction.calculate_flow_with_leakage`, computed
+level by level, bottom-up, as array reductions over a `NetworkTopology` of any depth.
+
+Functions:
+- simulate_usage_arrays: Simulates endpoint usage and junction outflows for every time step.
+- simulate_network_arrays: Simulates a network and returns the rows as a DataFrame.
+"""
+
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+from data_generation.network_topology import DEVICE_TYPES, ENDPOINT
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _inject_leakage(outflow, rng, leakage_probability, max_leakage_percent):
+    """ Adds a random leakage to a (time x junction) outflow matrix, like calculate_flow_with_leakage, and returns which junctions leaked. """
+    if leakage_probability <= 0:
+        return outflow, np.zeros(outflow.shape, dtype=bool)
+    leaking = rng.random(outflow.shape) < leakage_probability
+    leakage_percent = rng.uniform(0, max_leakage_percent, outflow.shape)
+    return outflow + np.where(leaking, outflow * leakage_percent, 0.0), leaking
+
+def simulate_usage_arrays(topology, usage_parameters, time_units, rng, leakage_probability=0.0, max_leakage_percent=0.0):
+    """
+    Simulates endpoint usage and junction outflows for every time step.
+
+    Parameters:
+    - topology (NetworkTopology): The network to simulate.
+    - usage_parameters (Dict[str, Tuple[float, int]]): (usage_probability, max_usage) per endpoint type.
+    - time_units (int): Number of hourly time steps to simulate.
+    - rng (numpy.random.Generator): Source of randomness.
+    - leakage_probability (float): Probability of a junction leaking during a time step.
+    - max_leakage_percent (float): Maximum leakage as a fraction of the junction outflow.
+
+    Returns:
+    - ndarray: A (time_units x nodes) matrix of endpoint usage and junction outflow, in node order; int64
+      without leakage, like the integer readings of the object engine, and float64 with leakage.
+    - ndarray: A (time_units x nodes) boolean matrix of the readings that include a leak, the junction's
+      own or one further down the network. The object engine records these as floats and all other
+      readings as integers.
+    """
+    dtype = np.int64 if leakage_probability <= 0 else np.float64
+    values = np.zeros((time_units, len(topology)), dtype=dtype)
+    leaked = np.zeros((time_units, len(topology)), dtype=bool)
+
+    # Every endpoint uses water with its usage probability, between 10 and its max usage inclusive
+    endpoints = np.flatnonzero(topology.kinds == ENDPOINT)
+    probability_table = np.zeros(len(DEVICE_TYPES))
+    max_usage_table = np.full(len(DEVICE_TYPES), 10, dtype=np.int64)
+    for endpoint_type, (usage_probability, max_usage) in usage_parameters.items():
+        probability_table[DEVICE_TYPES.index(endpoint_type)] = usage_probability
+        max_usage_table[DEVICE_TYPES.index(endpoint_type)] = max_usage
+    endpoint_types = topology.device_types[endpoints]
+
+    shape = (time_units, len(endpoints))
+    in_use = rng.random(shape) < probability_table[endpoint_types]
+    amounts = rng.integers(10, max_usage_table[endpoint_types] + 1, size=shape)
+    values[:, endpoints] = np.where(in_use, amounts, 0)
+
+    # Junction outflow is the sum over its children, deepest level first so that child junctions are done
+    depths = topology.depths()
+    junction_depths = np.where(topology.kinds == ENDPOINT, -1, depths)
+    cumulative = np.zeros((time_units, len(topology.children) + 1), dtype=dtype)
+    leaks_below = np.zeros((time_units, len(topology.children) + 1), dtype=np.int32)
+    for depth in range(int(depths.max()), -1, -1):
+        junctions = np.flatnonzero(junction_depths == depth)
+        if not len(junctions):
+            continue
+        first, last = topology.child_offsets[junctions], topology.child_offsets[junctions + 1]
+        np.cumsum(values[:, topology.children], axis=1, out=cumulative[:, 1:])
+        outflow = cumulative[:, last] - cumulative[:, first]
+        below = np.zeros(outflow.shape, dtype=bool)
+        if leakage_probability > 0:
+            np.cumsum(leaked[:, topology.children], axis=1, out=leaks_below[:, 1:])
+            below = leaks_below[:, last] > leaks_below[:, first]
+            # Without a leak below, the outflow is a sum of integers, which the running sum over the
+            # leaked floats of other junctions can miss by a rounding error
+            outflow = np.where(below, outflow, np.rint(outflow))
+        values[:, junctions], leaking = _inject_leakage(outflow, rng, leakage_probability, max_leakage_percent)
+        leaked[:, junctions] = leaking | below
+
+    return values, leaked
+
+def simulate_network_arrays(topology, usage_parameters, time_units, start_time, seed=None,
+                            leakage_probability=0.0, max_leakage_percent=0.0):
+    """
+    Simulates a network with the vectorized kernel and returns the rows as a DataFrame.
+
+    The rows have the same columns as the list returned by `simulate_network`, with every
+    junction recorded after the nodes it serves and the master junction last.
+
+    Parameters:
+    - topology (NetworkTopology): The network to simulate.
+    - usage_parameters (Dict[str, Tuple[float, int]]): (usage_probability, max_usage) per endpoint type.
+    - time_units (int): Number of hourly time steps to simulate.
+    - start_time (datetime): Timestamp of the first time step.
+    - seed (int or numpy.random.SeedSequence, optional): Seed of the NumPy Generator.
+    - leakage_probability (float): Probability of a junction leaking during a time step.
+    - max_leakage_percent (float): Maximum leakage as a fraction of the junction outflow.
+
+    Returns:
+    - DataFrame: The simulated rows. With leakage, `water_usage` holds integers and floats, as object dtype.
+    """
+    rng = np.random.default_rng(seed)
+    values, leaked = simulate_usage_arrays(topology, usage_parameters, time_units, rng, leakage_probability, max_leakage_percent)
+
+    order = topology.post_order()
+    rows_per_step = len(order)
+    timestamps = pd.date_range(start_time, start_time + timedelta(hours=time_units - 1), freq='h').strftime(TIMESTAMP_FORMAT)
+    step_codes = np.repeat(np.arange(time_units), rows_per_step)
+    row_nodes = np.tile(order, time_units)
+
+    path_codes, paths = pd.factorize(pd.Index(topology.path_strings()))
+    type_names = np.where(topology.kinds == ENDPOINT, 1, 0)
+
+    water_usage = values[:, order].ravel()
+    if water_usage.dtype != np.int64:
+        # Like the object engine, only readings that include a leak are floats, so the CSV keeps
+        # writing endpoint usage and leak-free outflows as integers
+        leaked = leaked[:, order].ravel()
+        mixed = np.empty(len(water_usage), dtype=object)
+        mixed[leaked] = water_usage[leaked].tolist()
+        mixed[~leaked] = water_usage[~leaked].astype(np.int64).tolist()
+        water_usage = mixed
+
+    return pd.DataFrame({
+        'timestamp': timestamps.take(step_codes),
+        'sensor_id': topology.sensor_ids[row_nodes],
+        'path_to_master': pd.Categorical.from_codes(path_codes[row_nodes], categories=paths),
+        'type': pd.Categorical.from_codes(type_names[row_nodes], categories=['Junction', 'Endpoint']),
+        'device_type': pd.Categorical.from_codes(topology.device_types[row_nodes], categories=DEVICE_TYPES),
+        'water_usage': water_usage,
+    })